@@ -0,0 +1,155 @@
+# Synthetic libraries for the benchmarks. Everything is written straight to a
+# backend's client, in the shape Database writes it: docs with their note
+# counters, note trees, authors with their doc counts, and links recorded on
+# both ends. The same seed always gives the same library.
+#
+#     python -m benchmarks.corpus library.sqlite --docs 5000 --depth 2 --fan-out 4
+
+import argparse
+import random
+import time
+
+from database import BatchWriter
+from document_types import Note, author_doc_id, normalize_title
+
+SYLLABLES = [u'ka', u'lo', u'mi', u'ne', u'ru', u'sa', u'ti', u'vo', u'ze', u'an', u'el', u'or',
+             u'is', u'um', u'pra', u'sto', u'gli', u'dre', u'phi', u'chu', u'nth', u'qua']
+
+def generate(backend, docs=1000, authors=300, authors_per_doc=3, depth=2, fan_out=3,
+             link_density=0.05, seed=0, progress=None):
+    # Writes a library to backend and returns its counts.
+    #
+    # Every doc and note gets a random number of child notes, fan_out on
+    # average, down to depth levels (depth 0 means no notes). link_density
+    # is the number of links per doc or note, between random pairs of them.
+    rng = random.Random(seed)
+    vocabulary = _vocabulary(rng, 2000)
+    people = _people(rng, vocabulary, authors)
+    counts = {u'docs': docs, u'notes': 0, u'authors': 0, u'links': 0}
+
+    docs_data = {} # doc id -> data
+    notes_data = {} # doc id -> {note id: data}
+    for doc_index in range(docs):
+        doc_id = _new_id(rng)
+        doc_authors = rng.sample(people, min(rng.randint(1, authors_per_doc), len(people)))
+        title = _sentence(rng, vocabulary, 4, 12)
+        docs_data[doc_id] = {
+            u'doctype': u'papers',
+            u'title': title,
+            u'title_key': normalize_title(title),
+            u'authors': [{u'lastname': lastname, u'firstname': firstname} for lastname, firstname in doc_authors],
+            u'year': rng.randint(1980, 2020),
+            u'inlinks': [],
+            u'outlinks': [],
+            u'note_count': 0,
+            u'notetype_counts': {},
+            u'child_counts': {},
+        }
+        notes_data[doc_id] = {}
+        _add_notes(rng, vocabulary, docs_data[doc_id], notes_data[doc_id], doc_id, docs_data[doc_id], 1, depth, fan_out)
+        counts[u'notes'] += len(notes_data[doc_id])
+
+    # Links between random docs and notes, each one once.
+    nodes = [(doc_id, None) for doc_id in docs_data] + \
+            [(doc_id, note_id) for doc_id, doc_notes in notes_data.items() for note_id in doc_notes]
+    links = set()
+    for link_index in range(int(link_density * len(nodes))):
+        out_node, in_node = rng.sample(nodes, 2)
+        if (out_node, in_node) in links:
+            continue
+        links.add((out_node, in_node))
+        _node_data(docs_data, notes_data, out_node)[u'outlinks'].append(in_node[1] or in_node[0])
+        _node_data(docs_data, notes_data, in_node)[u'inlinks'].append(out_node[1] or out_node[0])
+    counts[u'links'] = len(links)
+
+    doc_counts = {}
+    for data in docs_data.values():
+        for author in data[u'authors']:
+            key = (author[u'lastname'], author[u'firstname'])
+            doc_counts[key] = doc_counts.get(key, 0) + 1
+    counts[u'authors'] = len(doc_counts)
+
+    client = backend.client
+    writer = BatchWriter(client, progress)
+    for (lastname, firstname), doc_count in doc_counts.items():
+        writer.set(client.collection(u'authors').document(author_doc_id(lastname, firstname)),
+                   {u'lastname': lastname, u'firstname': firstname, u'doc_count': doc_count})
+    for doc_id, data in docs_data.items():
+        doc_ref = client.collection(u'docs').document(doc_id)
+        data[u'updated_at'] = backend.SERVER_TIMESTAMP
+        writer.set(doc_ref, data)
+        for note_id, note_data in notes_data[doc_id].items():
+            note_data[u'updated_at'] = backend.SERVER_TIMESTAMP
+            writer.set(doc_ref.collection(u'notes').document(note_id), note_data)
+    writer.commit()
+    return counts
+
+def _add_notes(rng, vocabulary, doc_data, doc_notes, ref_id, parent_data, level, depth, fan_out):
+    if level > depth:
+        return
+    for child_index in range(rng.randint(0, 2 * fan_out)):
+        note_id = _new_id(rng)
+        notetype = rng.choice(Note.valid_notetypes)
+        note_data = {
+            u'ref_id': ref_id,
+            u'notetype': notetype,
+            u'body': _sentence(rng, vocabulary, 8, 40),
+            u'page': str(rng.randint(1, 300)),
+            u'inlinks': [],
+            u'outlinks': [],
+            u'child_counts': {},
+        }
+        doc_notes[note_id] = note_data
+        doc_data[u'note_count'] += 1
+        doc_data[u'notetype_counts'][notetype] = doc_data[u'notetype_counts'].get(notetype, 0) + 1
+        parent_data[u'child_counts'][notetype] = parent_data[u'child_counts'].get(notetype, 0) + 1
+        _add_notes(rng, vocabulary, doc_data, doc_notes, note_id, note_data, level + 1, depth, fan_out)
+
+def _node_data(docs_data, notes_data, node):
+    doc_id, note_id = node
+    if note_id is None:
+        return docs_data[doc_id]
+    return notes_data[doc_id][note_id]
+
+def _new_id(rng):
+    return u'{0:020x}'.format(rng.getrandbits(80))
+
+def _vocabulary(rng, size):
+    words = set()
+    while len(words) < size:
+        words.add(u''.join(rng.choice(SYLLABLES) for syllable in range(rng.randint(1, 4))))
+    return sorted(words)
+
+def _people(rng, vocabulary, count):
+    people = set()
+    while len(people) < count:
+        people.add((rng.choice(vocabulary).capitalize(), rng.choice(vocabulary).capitalize()))
+    return sorted(people)
+
+def _sentence(rng, vocabulary, shortest, longest):
+    # Word frequencies fall off roughly like real text.
+    words = [vocabulary[min(int(rng.paretovariate(1.2)) - 1, len(vocabulary) - 1)] if rng.random() < 0.5 \
+             else rng.choice(vocabulary) for word in range(rng.randint(shortest, longest))]
+    return u' '.join(words).capitalize()
+
+def main():
+    parser = argparse.ArgumentParser(description=u'Write a synthetic library to a SQLite file.')
+    parser.add_argument(u'path', help=u'SQLite library file to write')
+    parser.add_argument(u'--docs', type=int, default=1000)
+    parser.add_argument(u'--authors', type=int, default=300)
+    parser.add_argument(u'--depth', type=int, default=2, help=u'levels of notes under each doc')
+    parser.add_argument(u'--fan-out', type=int, default=3, help=u'average child notes per doc or note')
+    parser.add_argument(u'--links', type=float, default=0.05, help=u'links per doc or note')
+    parser.add_argument(u'--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    from sqlite_backend import SqliteBackend
+    start = time.perf_counter()
+    counts = generate(SqliteBackend(args.path), args.docs, args.authors, depth=args.depth, fan_out=args.fan_out,
+                      link_density=args.links, seed=args.seed,
+                      progress=lambda write_count: print(u'{0} records written...'.format(write_count)))
+    print(u'{docs} docs, {notes} notes, {authors} authors and {links} links'.format(**counts) +
+          u' written in {0:.1f}s.'.format(time.perf_counter() - start))
+
+if __name__ == u'__main__':
+    main()
@@ -0,0 +1,56 @@
+# A Firestore stand-in for the benchmarks: the SQLite backend, which already
+# has Firestore's collection/document/where/stream/add/update/batch API, with
+# the cost of a network round trip added to every read and commit. That makes
+# round trips show up in the timings the way they do against the real
+# service, without credentials or a network.
+#
+# The delays are added inside the client, below the objects Database wraps,
+# so stats.InstrumentedClient still counts reads, writes and round trips.
+
+import time
+
+import sqlite_backend
+
+# Roughly a Firestore round trip from a nearby region, and the extra time per
+# document streamed back.
+DEFAULT_LATENCY = 0.03
+DEFAULT_READ_LATENCY = 0.00002
+
+class LatencyClient(sqlite_backend.Client):
+    def __init__(self, path=u':memory:', latency=DEFAULT_LATENCY, read_latency=DEFAULT_READ_LATENCY):
+        super().__init__(path)
+        self.latency = latency
+        self.read_latency = read_latency
+
+    def _wait(self, document_count=0):
+        delay = self.latency + document_count * self.read_latency
+        if delay > 0:
+            time.sleep(delay)
+
+    # The sleeps happen outside the client's lock, so concurrent requests
+    # overlap like they would over the network.
+
+    def _get(self, reference):
+        self._wait(1)
+        return super()._get(reference)
+
+    def _run_query(self, query):
+        snapshots = super()._run_query(query)
+        self._wait(len(snapshots))
+        return snapshots
+
+    def _commit(self, writes):
+        self._wait()
+        return super()._commit(writes)
+
+class FakeFirestoreBackend(sqlite_backend.SqliteBackend):
+    def __init__(self, path=u':memory:', latency=DEFAULT_LATENCY, read_latency=DEFAULT_READ_LATENCY):
+        super().__init__(path)
+        self.client.close()
+        self.client = LatencyClient(path, latency, read_latency)
+        self.name = u'fake:' + path
+
+    def set_latency(self, latency, read_latency=0.0):
+        # Latency 0 is handy while writing a corpus.
+        self.client.latency = latency
+        self.client.read_latency = read_latency
@@ -0,0 +1,97 @@
+# Memory held by the in-memory docs, notes and authors, in bytes per object.
+# A synthetic library (see corpus.py) is read back into Doc, Note and Author
+# objects the way Database reads it, from snapshots, and tracemalloc counts
+# what those objects keep alive once the snapshots are gone. To compare two
+# commits:
+#
+#     python -m benchmarks.memory --docs 5000 --output before.json
+#     git checkout other-branch
+#     python -m benchmarks.memory --docs 5000 --compare before.json
+#
+# The snapshots come from the SQLite backend, whose snapshots are smaller
+# than Firestore's protobuf-backed ones, so objects that hold on to their
+# snapshot cost more against Firestore than shown here.
+
+import argparse
+import gc
+import json
+import sys
+import tracemalloc
+
+from benchmarks import corpus
+from benchmarks.operations import _git_commit
+from document_types import Author, Doc, Note
+from sqlite_backend import SqliteBackend
+
+def measure(make_objects):
+    # (object count, bytes per object) for the objects make_objects()
+    # returns, without the list holding them.
+    gc.collect()
+    tracemalloc.start()
+    objects = make_objects()
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0] - sys.getsizeof(objects)
+    tracemalloc.stop()
+    count = len(objects)
+    del objects
+    return count, retained / count if count else 0.0
+
+def run(args):
+    backend = SqliteBackend()
+    print(u'Writing a library of {0} docs...'.format(args.docs))
+    library = corpus.generate(backend, args.docs, args.authors, depth=args.depth, fan_out=args.fan_out,
+                              link_density=args.links, seed=args.seed)
+    print(u'{docs} docs, {notes} notes, {authors} authors, {links} links.'.format(**library))
+    client = backend.client
+
+    results = {}
+    for name, collection, load in [
+            (u'doc', lambda: client.collection(u'docs'), Doc.from_snapshot),
+            (u'note', lambda: client.collection_group(u'notes'), Note.from_snapshot),
+            (u'author', lambda: client.collection(u'authors'), Author.from_snapshot)]:
+        count, per_object = measure(lambda: [load(snapshot) for snapshot in collection().stream()])
+        results[name] = {u'count': count, u'bytes': per_object}
+        print(u'{0:<8} {1:8d} objects {2:10.0f} bytes each'.format(name, count, per_object))
+
+    return {
+        u'commit': _git_commit(),
+        u'parameters': {key: value for key, value in vars(args).items() if key not in (u'output', u'compare')},
+        u'library': library,
+        u'results': results,
+    }
+
+def compare(results, baseline):
+    print(u'')
+    print(u'{0:<8} {1:>14} {2:>14} {3:>8}'.format(u'', u'baseline bytes', u'now bytes', u'ratio'))
+    for name, result in results[u'results'].items():
+        if name not in baseline[u'results']:
+            continue
+        before = baseline[u'results'][name][u'bytes']
+        after = result[u'bytes']
+        print(u'{0:<8} {1:14.0f} {2:14.0f} {3:8.2f}'.format(name, before, after, \
+                                                          after / before if before else float(u'inf')))
+    if baseline.get(u'parameters') != results[u'parameters']:
+        print(u'Note: the baseline was run on another library.')
+
+def main():
+    parser = argparse.ArgumentParser(description=u'Measure the memory used per doc, note and author.')
+    parser.add_argument(u'--docs', type=int, default=2000)
+    parser.add_argument(u'--authors', type=int, default=300)
+    parser.add_argument(u'--depth', type=int, default=2, help=u'levels of notes under each doc')
+    parser.add_argument(u'--fan-out', type=int, default=3, help=u'average child notes per doc or note')
+    parser.add_argument(u'--links', type=float, default=0.05, help=u'links per doc or note')
+    parser.add_argument(u'--seed', type=int, default=0)
+    parser.add_argument(u'--output', help=u'write the results as JSON to this file')
+    parser.add_argument(u'--compare', help=u'JSON results of an earlier run to compare with')
+    args = parser.parse_args()
+
+    results = run(args)
+    if args.output:
+        with open(args.output, u'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            compare(results, json.load(baseline_file))
+
+if __name__ == u'__main__':
+    main()
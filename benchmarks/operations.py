@@ -0,0 +1,297 @@
+# Timing and memory benchmarks for model and shell operations, run on a
+# synthetic library (see corpus.py), optionally behind simulated network
+# latency (see fake_firestore.py). The results are written as JSON, so runs
+# on two commits can be compared:
+#
+#     python -m benchmarks.operations --docs 2000 --output before.json
+#     git checkout other-branch
+#     python -m benchmarks.operations --docs 2000 --output after.json --compare before.json
+#
+# Each operation is run --repeat times for the timings, then once more under
+# tracemalloc for the memory it allocates. Reads, writes and round trips
+# come from the model's Stats. The library, the operations' arguments and
+# their order only depend on --seed.
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+from benchmarks import corpus
+from benchmarks.fake_firestore import FakeFirestoreBackend
+from document_types import Doc, Note
+from model import Model
+from stats import Counters
+
+# name -> (function, setup, needs the shell). function(context) is timed,
+# setup(context) runs before each run and isn't.
+BENCHMARKS = {}
+
+def benchmark(name, setup=None, shell=False):
+    def register(function):
+        BENCHMARKS[name] = (function, setup, shell)
+        return function
+    return register
+
+class Context():
+    def __init__(self, backend, model, shell, seed):
+        self.backend = backend
+        self.model = model
+        self.shell = shell
+        self.rng = random.Random(seed)
+        self.counter = 0
+        docs = [doc for doc in model.get_docs() if doc.note_count]
+        self.sample_docs = self.rng.sample(docs, min(50, len(docs))) or model.get_docs()[:50]
+        self.linked_docs = [doc for doc in model.get_docs() if doc.inlinks or doc.outlinks][:50] or self.sample_docs
+        self.words = sorted(set(word for doc in self.sample_docs for word in doc.title.lower().split()))
+        self.export_path = os.path.join(tempfile.mkdtemp(), u'export.jsonl')
+
+    def next_doc(self, docs=None):
+        # Cycles through the docs so every run does the same work.
+        docs = docs or self.sample_docs
+        self.counter += 1
+        return docs[self.counter % len(docs)]
+
+# Model operations.
+
+@benchmark(u'load')
+def bench_load(context):
+    # A second model on the same backend, from nothing to loaded.
+    model = Model(backend=context.backend)
+    model.close()
+    return model.stats.totals
+
+@benchmark(u'reload_docs')
+def bench_reload_docs(context):
+    context.model.reload_docs()
+
+@benchmark(u'add_doc')
+def bench_add_doc(context):
+    doc = context.next_doc()
+    context.model.add_doc(Doc(doctype=u'papers', title=u'{0} {1}'.format(doc.title, context.counter),
+                              authors=doc.authors + [{u'lastname': u'New', u'firstname': str(context.counter)}]))
+
+@benchmark(u'add_note')
+def bench_add_note(context):
+    doc = context.next_doc()
+    context.model.add_note(Note(doc.id, u'ideas', u'Benchmark note {0}'.format(context.counter)), doc)
+
+def clear_note_cache(context):
+    context.model.note_cache.clear()
+
+@benchmark(u'get_doc_notes', setup=clear_note_cache)
+def bench_get_doc_notes(context):
+    context.model.get_doc_notes(context.next_doc())
+
+@benchmark(u'select_doc')
+def bench_select_doc(context):
+    context.model.set_current_obj(context.next_doc())
+
+@benchmark(u'create_link')
+def bench_create_link(context):
+    out_doc = context.next_doc()
+    context.model.create_link(out_doc, context.next_doc())
+
+@benchmark(u'search')
+def bench_search(context):
+    context.model.search(context.words[context.counter % len(context.words)])
+    context.counter += 1
+
+@benchmark(u'find_docs_by_title')
+def bench_find_docs_by_title(context):
+    title = context.next_doc().title
+    # A partial, misspelled title.
+    context.model.find_docs_by_title(title[:30].replace(u'a', u'e'))
+
+@benchmark(u'path')
+def bench_path(context):
+    from_doc = context.next_doc(context.linked_docs)
+    context.model.find_path(from_doc, context.next_doc(context.linked_docs))
+
+@benchmark(u'rank')
+def bench_rank(context):
+    # The first run builds the ranks, the others are served from the cache
+    # until the graph changes, so add a link each time.
+    out_doc = context.next_doc()
+    context.model.create_link(out_doc, context.next_doc())
+    context.model.rank_linked(10)
+
+@benchmark(u'related')
+def bench_related(context):
+    context.model.find_related([context.next_doc()], 10)
+
+@benchmark(u'export')
+def bench_export(context):
+    import exporter
+    exporter.export_file(context.model, context.export_path, progress=lambda message: None)
+
+# Shell operations. Their output is thrown away and input() gets EOF.
+
+def select_in_shell(context):
+    context.shell.set_current_obj(context.next_doc())
+
+@benchmark(u'shell_docs', shell=True)
+def bench_shell_docs(context):
+    context.shell.do_docs(u'')
+
+@benchmark(u'shell_note_tree', setup=select_in_shell, shell=True)
+def bench_shell_note_tree(context):
+    context.shell.do_note_tree(u'')
+
+@benchmark(u'shell_links', shell=True)
+def bench_shell_links(context):
+    context.shell.get_links(context.next_doc(context.linked_docs))
+
+@benchmark(u'shell_doc_info', setup=select_in_shell, shell=True)
+def bench_shell_doc_info(context):
+    context.shell.do_doc(u'')
+
+def measure(context, name, repeat):
+    function, setup, needs_shell = BENCHMARKS[name]
+    stats = context.model.stats
+    seconds = []
+    counters = None
+    for run in range(repeat + 1):
+        if setup is not None:
+            setup(context)
+        memory = run == repeat
+        if memory:
+            tracemalloc.start()
+        stats.begin(u'command', name)
+        start = time.perf_counter()
+        result = function(context)
+        elapsed = time.perf_counter() - start
+        command_counters = stats.end()
+        if memory:
+            retained, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        else:
+            seconds.append(elapsed)
+            counters = result if isinstance(result, Counters) else command_counters
+    return {
+        u'runs': repeat,
+        u'median': statistics.median(seconds),
+        u'min': min(seconds),
+        u'max': max(seconds),
+        u'peak_memory': peak,
+        u'retained_memory': retained,
+        u'reads': counters.reads,
+        u'writes': counters.writes,
+        u'round_trips': counters.round_trips,
+    }
+
+def run(args):
+    backend = FakeFirestoreBackend(latency=0.0, read_latency=0.0)
+    print(u'Writing a library of {0} docs...'.format(args.docs))
+    library = corpus.generate(backend, args.docs, args.authors, depth=args.depth, fan_out=args.fan_out,
+                              link_density=args.links, seed=args.seed)
+    print(u'{docs} docs, {notes} notes, {authors} authors, {links} links.'.format(**library))
+    backend.set_latency(args.latency, args.read_latency)
+
+    names = [name for name in BENCHMARKS if not args.only or name in args.only]
+    sink = io.StringIO()
+    shell = None
+    if any(BENCHMARKS[name][2] for name in names):
+        try:
+            import litreview
+        except ImportError as error:
+            print(u'Skipping the shell benchmarks: {0}'.format(error))
+            names = [name for name in names if not BENCHMARKS[name][2]]
+        else:
+            shell = litreview.LitreviewShell(backend=backend)
+            shell.model.wait_until_loaded()
+            # cmd2 writes paged output to its own stdout.
+            shell.stdout = sink
+    if u'related' in names:
+        import related
+        if not related.available():
+            print(u'Skipping related: numpy and scipy are not installed.')
+            names.remove(u'related')
+    model = shell.model if shell is not None else Model(backend=backend)
+    context = Context(backend, model, shell, args.seed)
+
+    results = {}
+    stdin = sys.stdin
+    sys.stdin = io.StringIO()
+    try:
+        for name in names:
+            with contextlib.redirect_stdout(sink):
+                results[name] = measure(context, name, args.repeat)
+            sink.seek(0)
+            sink.truncate()
+            print(u'{0:<20} {1:10.2f} ms {2:10.1f} KiB {3:6d} round trips'.format(
+                name, results[name][u'median'] * 1000, results[name][u'peak_memory'] / 1024.0,
+                results[name][u'round_trips']))
+    finally:
+        sys.stdin = stdin
+        model.close()
+
+    return {
+        u'commit': _git_commit(),
+        u'created': datetime.now().isoformat(),
+        u'python': platform.python_version(),
+        u'platform': platform.platform(),
+        u'parameters': {key: value for key, value in vars(args).items() if key not in (u'output', u'compare')},
+        u'library': library,
+        u'results': results,
+    }
+
+def compare(results, baseline):
+    print(u'')
+    print(u'{0:<20} {1:>12} {2:>12} {3:>8}'.format(u'', u'baseline ms', u'now ms', u'ratio'))
+    for name, result in results[u'results'].items():
+        if name not in baseline[u'results']:
+            continue
+        before = baseline[u'results'][name][u'median']
+        after = result[u'median']
+        print(u'{0:<20} {1:12.2f} {2:12.2f} {3:8.2f}'.format(name, before * 1000, after * 1000, \
+                                                           after / before if before else float(u'inf')))
+    # Which benchmarks ran and how often doesn't change what they measure.
+    ignored = (u'only', u'repeat')
+    if any(baseline[u'parameters'].get(key) != value for key, value in results[u'parameters'].items() \
+           if key not in ignored):
+        print(u'Note: the baseline was run on another library or latency.')
+
+def _git_commit():
+    try:
+        return subprocess.run([u'git', u'rev-parse', u'--short', u'HEAD'], stdout=subprocess.PIPE, \
+                              stderr=subprocess.DEVNULL, check=True).stdout.decode(u'utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description=u'Benchmark model and shell operations on a synthetic library.')
+    parser.add_argument(u'--docs', type=int, default=1000)
+    parser.add_argument(u'--authors', type=int, default=300)
+    parser.add_argument(u'--depth', type=int, default=2, help=u'levels of notes under each doc')
+    parser.add_argument(u'--fan-out', type=int, default=3, help=u'average child notes per doc or note')
+    parser.add_argument(u'--links', type=float, default=0.05, help=u'links per doc or note')
+    parser.add_argument(u'--latency', type=float, default=0.0, help=u'seconds added to every round trip')
+    parser.add_argument(u'--read-latency', type=float, default=0.0, help=u'seconds added per document read')
+    parser.add_argument(u'--repeat', type=int, default=5)
+    parser.add_argument(u'--seed', type=int, default=0)
+    parser.add_argument(u'--only', nargs=u'+', choices=sorted(BENCHMARKS), help=u'run only these')
+    parser.add_argument(u'--output', help=u'write the results as JSON to this file')
+    parser.add_argument(u'--compare', help=u'JSON results of an earlier run to compare with')
+    args = parser.parse_args()
+
+    results = run(args)
+    if args.output:
+        with open(args.output, u'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            compare(results, json.load(baseline_file))
+
+if __name__ == u'__main__':
+    main()
@@ -0,0 +1,80 @@
+# Startup timings for litreview.py: how long the imports take, how long until
+# the prompt could be drawn, until the backend is connected and until the
+# library is loaded. Every run happens in a fresh interpreter so the imports
+# are cold.
+#
+#     python -m benchmarks.startup --sqlite library.sqlite --runs 5
+#
+# Without --sqlite the Firestore backend is used, with the usual credentials.
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+def run_once(sqlite_path, cache_path):
+    start = time.perf_counter()
+    import litreview
+    import_done = time.perf_counter()
+
+    backend = None
+    if sqlite_path is not None:
+        from sqlite_backend import SqliteBackend
+        backend = SqliteBackend(sqlite_path)
+    shell = litreview.LitreviewShell(backend=backend, cache_path=cache_path)
+    # The prompt is drawn as soon as the shell exists.
+    first_render = time.perf_counter()
+    shell.model.connected.wait()
+    connected = time.perf_counter()
+    shell.model.wait_until_loaded()
+    loaded = time.perf_counter()
+
+    return {
+        u'import': import_done - start,
+        u'first_render': first_render - start,
+        u'connect': connected - start,
+        u'loaded': loaded - start,
+        u'docs': len(shell.model.all_doc_ids),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=u'Time litreview startup.')
+    parser.add_argument(u'--sqlite', help=u'use a local SQLite library instead of Firestore')
+    parser.add_argument(u'--cache', help=u'cache file to start from')
+    parser.add_argument(u'--runs', type=int, default=5)
+    parser.add_argument(u'--output', help=u'write the results as JSON to this file')
+    parser.add_argument(u'--child', action=u'store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        # Keep the shell's own messages out of the JSON on stdout.
+        stdout = sys.stdout
+        sys.stdout = sys.stderr
+        timings = run_once(args.sqlite, args.cache)
+        stdout.write(json.dumps(timings))
+        return
+
+    command = [sys.executable, u'-m', u'benchmarks.startup', u'--child']
+    if args.sqlite:
+        command += [u'--sqlite', args.sqlite]
+    if args.cache:
+        command += [u'--cache', args.cache]
+
+    runs = []
+    for run in range(args.runs):
+        output = subprocess.run(command, stdout=subprocess.PIPE, check=True).stdout
+        runs.append(json.loads(output.decode(u'utf-8')))
+
+    results = {u'runs': runs, u'median': {}}
+    for phase in (u'import', u'first_render', u'connect', u'loaded'):
+        results[u'median'][phase] = statistics.median(run[phase] for run in runs)
+        print(u'{0:<14} {1:8.1f} ms'.format(phase, results[u'median'][phase] * 1000))
+
+    if args.output:
+        with open(args.output, u'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+if __name__ == u'__main__':
+    main()
@@ -0,0 +1,132 @@
+import json
+import os
+import sqlite3
+from datetime import datetime, timezone
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser(u'~'), u'.litreview', u'cache.sqlite')
+
+class LibraryCache():
+    # An on-disk copy of the docs and notes, keyed by id, plus the updated_at
+    # watermark of the last sync. Model loads it at startup and then only asks
+    # the backend for what changed since the watermark.
+    #
+    # Each cache belongs to one backend (see the backends' name attribute);
+    # opening it for another one starts from empty.
+
+    def __init__(self, path, backend_name):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript(u'''
+            CREATE TABLE IF NOT EXISTS docs (
+                id TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                update_time REAL
+            );
+            CREATE TABLE IF NOT EXISTS notes (
+                id TEXT PRIMARY KEY,
+                doc_id TEXT NOT NULL,
+                data TEXT NOT NULL,
+                update_time REAL
+            );
+            CREATE INDEX IF NOT EXISTS notes_doc_id ON notes (doc_id);
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value
+            );
+        ''')
+        if self._get_meta(u'backend') != backend_name:
+            self.clear()
+            self._set_meta(u'backend', backend_name)
+            self.connection.commit()
+
+    def _get_meta(self, key):
+        row = self.connection.execute(u'SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def _set_meta(self, key, value):
+        self.connection.execute(u'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def clear(self):
+        with self.connection:
+            self.connection.execute(u'DELETE FROM docs')
+            self.connection.execute(u'DELETE FROM notes')
+            self.connection.execute(u'DELETE FROM meta')
+
+    def get_watermark(self):
+        # Aware UTC datetime, or None if the cache has never been synced.
+        value = self._get_meta(u'watermark')
+        if value is None:
+            return None
+        return datetime.fromtimestamp(value, timezone.utc)
+
+    def load_docs(self):
+        # Yields (id, data, update_time) for every cached doc.
+        for id, data, update_time in self.connection.execute(u'SELECT id, data, update_time FROM docs'):
+            yield id, json.loads(data), _from_timestamp(update_time)
+
+    def load_notes(self, doc_id=None):
+        # Yields (doc_id, id, data, update_time) for every cached note, or
+        # only for the notes of doc_id.
+        if doc_id is None:
+            rows = self.connection.execute(u'SELECT doc_id, id, data, update_time FROM notes')
+        else:
+            rows = self.connection.execute(u'SELECT doc_id, id, data, update_time FROM notes WHERE doc_id = ?', (doc_id,))
+        for doc_id, id, data, update_time in rows:
+            yield doc_id, id, json.loads(data), _from_timestamp(update_time)
+
+    def apply(self, doc_objs, notes_by_doc, tombstones, watermark, replace=False):
+        # Store the result of Database.get_changes in one transaction. With
+        # replace the cache is emptied first (used for a full load).
+        with self.connection:
+            if replace:
+                self.connection.execute(u'DELETE FROM docs')
+                self.connection.execute(u'DELETE FROM notes')
+            self.connection.executemany(
+                u'INSERT OR REPLACE INTO docs (id, data, update_time) VALUES (?, ?, ?)',
+                [(doc_obj.id, json.dumps(doc_obj.to_dict()), _to_timestamp(doc_obj.update_time))
+                 for doc_obj in doc_objs])
+            self.connection.executemany(
+                u'INSERT OR REPLACE INTO notes (id, doc_id, data, update_time) VALUES (?, ?, ?, ?)',
+                [(note_obj.id, doc_id, json.dumps(note_obj.to_dict()), _to_timestamp(note_obj.update_time))
+                 for doc_id, note_objs in notes_by_doc.items() for note_obj in note_objs])
+            for kind, doc_id, id in tombstones:
+                if kind == u'doc':
+                    self.connection.execute(u'DELETE FROM docs WHERE id = ?', (id,))
+                    self.connection.execute(u'DELETE FROM notes WHERE doc_id = ?', (id,))
+                else:
+                    self.connection.execute(u'DELETE FROM notes WHERE id = ?', (id,))
+            if watermark is not None:
+                self._set_meta(u'watermark', watermark.timestamp())
+
+    def remove_links(self, note_ids, linked_id):
+        # Takes linked_id out of the inlinks and outlinks of the cached notes
+        # with these ids, like the ArrayRemove writes Database.delete_doc
+        # makes.
+        with self.connection:
+            for note_id in note_ids:
+                row = self.connection.execute(u'SELECT data FROM notes WHERE id = ?', (note_id,)).fetchone()
+                if row is None:
+                    continue
+                data = json.loads(row[0])
+                for field in (u'inlinks', u'outlinks'):
+                    if linked_id in (data.get(field) or []):
+                        data[field] = [id for id in data[field] if id != linked_id]
+                self.connection.execute(u'UPDATE notes SET data = ? WHERE id = ?', (json.dumps(data), note_id))
+
+    def close(self):
+        self.connection.close()
+
+def _to_timestamp(update_time):
+    if update_time is None:
+        return None
+    return update_time.timestamp()
+
+def _from_timestamp(value):
+    # Doc and Note update times are naive local datetimes.
+    if value is None:
+        return None
+    return datetime.fromtimestamp(value)
@@ -1,30 +1,188 @@
-import firebase_admin
-from firebase_admin import credentials
-from firebase_admin import firestore
-from google.cloud.firestore_v1 import ArrayRemove, ArrayUnion
-import google.cloud.exceptions
+import random
+import time
 from document_types import *
+from fuzzy import TrigramIndex, DUPLICATE_SIMILARITY
+from stats import Stats, InstrumentedClient
+
+# Firestore rejects write batches with more than 500 operations.
+MAX_BATCH_WRITES = 500
+
+# import_docs commits at most this many entries at a time, and retries a
+# failed commit up to IMPORT_RETRIES times, waiting IMPORT_BACKOFF seconds
+# the first time and twice as long each time after that, up to
+# IMPORT_MAX_BACKOFF.
+IMPORT_CHUNK_SIZE = 100
+IMPORT_RETRIES = 5
+IMPORT_BACKOFF = 0.5
+IMPORT_MAX_BACKOFF = 30.0
+
+# The fields a doc listing shows, the only ones list_docs reads.
+LISTING_FIELDS = [u'title', u'year', u'authors']
+
+def _later(watermark, timestamp):
+    if timestamp is None:
+        return watermark
+    if watermark is None or timestamp > watermark:
+        return timestamp
+    return watermark
+
+class BatchWriter():
+    # Collects writes and commits them in batches of up to MAX_BATCH_WRITES.
+    # It has the same set/update/delete methods as a write batch, so it can
+    # be passed anywhere a batch is expected.
+    def __init__(self, db, progress=None):
+        self.db = db
+        self.batch = db.batch()
+        self.pending_writes = 0
+        self.committed_writes = 0
+        self.commit_count = 0
+        self.write_results = []
+        # progress(committed_writes) is called after each commit once the
+        # writes no longer fit in a single batch.
+        self.progress = progress
+
+    def reserve(self, write_count):
+        # Make sure the next write_count writes land in the same batch.
+        if self.pending_writes + write_count > MAX_BATCH_WRITES:
+            self.commit()
+
+    def set(self, reference, document_data, merge=False):
+        self.reserve(1)
+        self.batch.set(reference, document_data, merge=merge)
+        self.pending_writes += 1
+
+    def update(self, reference, field_updates):
+        self.reserve(1)
+        self.batch.update(reference, field_updates)
+        self.pending_writes += 1
+
+    def delete(self, reference, option=None):
+        self.reserve(1)
+        self.batch.delete(reference, option=option)
+        self.pending_writes += 1
+
+    def commit(self):
+        if self.pending_writes == 0:
+            return self.write_results
+        self.write_results = self.batch.commit()
+        self.committed_writes += self.pending_writes
+        self.commit_count += 1
+        self.batch = self.db.batch()
+        self.pending_writes = 0
+        if self.progress is not None and (self.commit_count > 1 or self.committed_writes == MAX_BATCH_WRITES):
+            self.progress(self.committed_writes)
+        return self.write_results
+
+class WriteList():
+    # Records set/update/delete calls so that the same writes can be
+    # replayed into a new batch when a commit has to be retried.
+    def __init__(self):
+        self.writes = []
+
+    def __len__(self):
+        return len(self.writes)
+
+    def set(self, reference, document_data, merge=False):
+        self.writes.append((u'set', reference, document_data, {u'merge': merge}))
+
+    def create(self, reference, document_data):
+        self.writes.append((u'create', reference, document_data, {}))
+
+    def update(self, reference, field_updates, option=None):
+        self.writes.append((u'update', reference, field_updates, {u'option': option}))
+
+    def delete(self, reference, option=None):
+        self.writes.append((u'delete', reference, None, {u'option': option}))
+
+    def extend(self, other):
+        self.writes.extend(other.writes)
+
+    def slice(self, start, stop):
+        part = WriteList()
+        part.writes = self.writes[start:stop]
+        return part
+
+    def first_reference(self):
+        return self.writes[0][1]
+
+    def replay(self, batch):
+        for kind, reference, data, kwargs in self.writes:
+            if kind == u'delete':
+                batch.delete(reference, **kwargs)
+            else:
+                getattr(batch, kind)(reference, data, **kwargs)
 
 class DatabaseDocMixin():
     def __init__(self):
-        pass
+        # Local indexes used for duplicate checks so that add_doc doesn't
+        # have to stream the whole docs collection.
+        # normalized title -> doc id, normalized doi -> doc id
+        self.title_index = {}
+        self.doi_index = {}
+        # Trigrams of every title, for near-duplicates and typo-tolerant
+        # lookups.
+        self.title_trigrams = TrigramIndex()
 
     def add_doc(self, doc):
-        doc_obj = self._get_doc_by_title(doc.title)
-        if doc_obj is not None:
+        doc_id = self._find_doc_id(doc)
+        if doc_id is not None:
             print("Doc already in database.")
+            return None
         else:
             print("Adding doc to database.")
+            # The author upserts and the doc itself go out in one commit.
+            batch = self.db.batch()
             for author in doc.authors:
-                new_author = Author(**author)
-                self._add_author(new_author)
-                author_snapshot = self._get_author(new_author)
-                self._inc_author_doc_count(author_snapshot)
-            self._get_docs().add(doc.to_dict())
+                self._batch_inc_author_doc_count(batch, Author(**author))
+            doc_ref = self._get_docs().document()
+            doc.note_count = 0
+            doc.notetype_counts = {}
+            doc.child_counts = {}
+            batch.set(doc_ref, self._stamped(doc.to_dict()))
+            write_results = batch.commit()
+            update_time = write_results[-1].update_time
+            self._index_doc(doc_ref.id, doc.title, doc.doi)
+
+            # Fill in the doc from the write result so callers don't have
+            # to read it back.
+            doc.id = doc_ref.id
+            doc.update_time = timestamp_to_datetime(update_time)
+            doc.db_reference = doc_ref
+            return doc
 
     def _get_docs(self):
         return self.db.collection(u'docs')
 
+    def _get_tombstones(self):
+        return self.db.collection(u'tombstones')
+
+    def doc_reference(self, doc_id):
+        return self._get_docs().document(doc_id)
+
+    def note_reference(self, doc_id, note_id):
+        return self.doc_reference(doc_id).collection(u'notes').document(note_id)
+
+    def _stamped(self, data):
+        # Every write to a doc or note records updated_at, which get_changes
+        # uses to find what changed since the last sync.
+        data = dict(data)
+        data[u'updated_at'] = self.backend.SERVER_TIMESTAMP
+        return data
+
+    def _increments(self, amounts):
+        # {field path: amount} -> stamped Increment updates, for counters.
+        return self._stamped({field: self.backend.Increment(amount) \
+                              for field, amount in amounts.items() if amount != 0})
+
+    def _batch_tombstone(self, batch, kind, doc_id, id):
+        # Deletes leave a tombstone behind so that get_changes can report them.
+        batch.set(self._get_tombstones().document(), {
+            u'kind': kind,
+            u'doc_id': doc_id,
+            u'id': id,
+            u'updated_at': self.backend.SERVER_TIMESTAMP,
+        })
+
     # def _get_doc(self, doc):
     #     # This function checks the database for a doc with the same id.
     #     # If the doc hasn't been added, its ID is None.
@@ -35,38 +193,452 @@ class DatabaseDocMixin():
     #     except google.cloud.exceptions.NotFound:
     #         return None
 
+    def _index_doc(self, doc_id, title, doi=None):
+        title_key = normalize_title(title)
+        if title_key is not None:
+            self.title_index[title_key] = doc_id
+        self.title_trigrams.add(doc_id, title)
+        doi_key = normalize_doi(doi)
+        if doi_key is not None:
+            self.doi_index[doi_key] = doc_id
+
+    def _unindex_doc(self, doc):
+        title_key = normalize_title(doc.title)
+        if self.title_index.get(title_key) == doc.id:
+            del self.title_index[title_key]
+        self.title_trigrams.remove(doc.id)
+        doi_key = normalize_doi(doc.doi)
+        if doi_key is not None and self.doi_index.get(doi_key) == doc.id:
+            del self.doi_index[doi_key]
+
+    def _find_doc_id(self, doc):
+        # Check the local indexes first. They are filled by get_docs, so they
+        # also cover older docs that were stored without title_key/doi_key.
+        title_key = normalize_title(doc.title)
+        doi_key = normalize_doi(doc.doi)
+        if title_key in self.title_index:
+            return self.title_index[title_key]
+        if doi_key is not None and doi_key in self.doi_index:
+            return self.doi_index[doi_key]
+
+        # Fall back to a single indexed query for docs added elsewhere.
+        existing = self._get_doc_by_title(doc.title)
+        if existing is None and doi_key is not None:
+            existing = self._get_doc_by_doi(doc.doi)
+        if existing is None:
+            return None
+        self._index_doc(existing.id, existing.title, existing.doi)
+        return existing.id
+
+    def similar_titles(self, title, threshold=DUPLICATE_SIMILARITY, limit=None, containment=False):
+        # [(similarity, doc_id)] for the docs whose titles are close to
+        # title, best first. See TrigramIndex.search.
+        return self.title_trigrams.search(title, threshold, limit, containment)
+
+    def _find_local_doc_id(self, doc):
+        # Same as _find_doc_id without asking the server, for bulk imports.
+        # Titles that only differ in punctuation, like "The X effect" and
+        # "The X-Effect:", don't count: "C++ Primer" and "C Primer" look the
+        # same to the trigram index. Those are left to dedupe.
+        title_key = normalize_title(doc.title)
+        doi_key = normalize_doi(doc.doi)
+        if title_key in self.title_index:
+            return self.title_index[title_key]
+        if doi_key is not None and doi_key in self.doi_index:
+            return self.doi_index[doi_key]
+        return None
+
+    def import_docs(self, entries, on_commit=None, chunk_size=IMPORT_CHUNK_SIZE):
+        # Bulk version of add_doc plus add_note. entries yields (doc, notes)
+        # pairs; the notes get attached to the doc. Duplicates are checked
+        # against the local indexes only, which get_docs has filled, and are
+        # skipped. Each entry's writes go in the same commit, and a commit
+        # holds up to chunk_size entries. An entry with more writes than fit
+        # in one batch, like a paper with hundreds of authors, is committed
+        # on its own, over as many batches as it takes. After each commit
+        # on_commit(entry_count, added) is called, entry_count being how
+        # many entries are done (written or skipped) and added the
+        # (doc, notes) pairs that were just written, with ids filled in.
+        # Returns (entry_count, added_count, duplicate_count, similar_count),
+        # similar_count being how many of the added docs have a title that
+        # only differs in punctuation from one already in the library.
+        writes = WriteList()
+        pending = []
+        entry_count = 0
+        added_count = 0
+        duplicate_count = 0
+        similar_count = 0
+        for doc, notes in entries:
+            if self._find_local_doc_id(doc) is not None:
+                duplicate_count += 1
+                entry_count += 1
+                continue
+            if self.title_trigrams.find_key(doc.title):
+                similar_count += 1
+
+            entry_writes = self._entry_writes(doc, notes)
+            if pending and (len(writes) + len(entry_writes) > MAX_BATCH_WRITES or len(pending) >= chunk_size):
+                self._commit_entries(writes, pending, entry_count, on_commit)
+                added_count += len(pending)
+                writes = WriteList()
+                pending = []
+            writes.extend(entry_writes)
+            pending.append((doc, notes))
+            # Index right away so duplicates within the import are caught.
+            self._index_doc(doc.id, doc.title, doc.doi)
+            entry_count += 1
+            if len(writes) > MAX_BATCH_WRITES:
+                self._commit_entries(writes, pending, entry_count, on_commit)
+                added_count += len(pending)
+                writes = WriteList()
+                pending = []
+
+        self._commit_entries(writes, pending, entry_count, on_commit)
+        added_count += len(pending)
+        return entry_count, added_count, duplicate_count, similar_count
+
+    def _entry_writes(self, doc, notes):
+        # The writes that add doc, its authors and its notes, the doc first.
+        # Fills in the ids and references. The doc and notes are created
+        # rather than set, so a batch that already went through fails as a
+        # whole when it's sent again (see _commit_with_retries).
+        entry_writes = WriteList()
+        doc_ref = self._get_docs().document()
+        doc.id = doc_ref.id
+        doc.db_reference = doc_ref
+        doc.note_count = len(notes)
+        doc.notetype_counts = {}
+        for note in notes:
+            doc.notetype_counts[note.notetype] = doc.notetype_counts.get(note.notetype, 0) + 1
+        doc.child_counts = dict(doc.notetype_counts)
+        doc_data = doc.to_dict()
+        del doc_data[u'id']
+        entry_writes.create(doc_ref, self._stamped(doc_data))
+        for author in doc.authors:
+            self._batch_inc_author_doc_count(entry_writes, Author(**author), quiet=True)
+        for note in notes:
+            note_ref = doc_ref.collection(u'notes').document()
+            note.ref_id = doc_ref.id
+            note.id = note_ref.id
+            note.db_reference = note_ref
+            note_data = note.to_dict()
+            del note_data[u'id']
+            entry_writes.create(note_ref, self._stamped(note_data))
+        return entry_writes
+
+    def _commit_entries(self, writes, pending, entry_count, on_commit):
+        if not pending:
+            return
+        try:
+            # Only a single oversized entry takes more than one batch. Its
+            # first batch creates the doc, and each one after that also
+            # updates the doc on the condition that it hasn't changed since
+            # the batch before, which makes those batches safe to send again
+            # too. If a later batch fails, the earlier ones stay written.
+            update_time = self._commit_with_retries(writes.slice(0, MAX_BATCH_WRITES))
+            doc_ref = writes.first_reference()
+            for start in range(MAX_BATCH_WRITES, len(writes), MAX_BATCH_WRITES - 1):
+                chunk = WriteList()
+                chunk.update(doc_ref, self._stamped({}), option=self.db.write_option(last_update_time=update_time))
+                chunk.extend(writes.slice(start, start + MAX_BATCH_WRITES - 1))
+                update_time = self._commit_with_retries(chunk)
+        except Exception:
+            for doc, notes in pending:
+                self._unindex_doc(doc)
+            # The author counts were bumped locally, read them again.
+            self.author_index = None
+            raise
+        update_time = timestamp_to_datetime(update_time)
+        for doc, notes in pending:
+            doc.update_time = update_time
+            for note in notes:
+                note.update_time = update_time
+        if on_commit is not None:
+            on_commit(entry_count, pending)
+
+    def _commit_with_retries(self, writes):
+        # Commits writes and returns the commit's update time. Transient
+        # errors are retried with exponential backoff and jitter. The first
+        # write creates a doc, or updates one with a last_update_time
+        # precondition, so if an attempt went through but its response was
+        # lost, the retry fails as a whole and nothing, the author doc_count
+        # increments included, is applied twice.
+        attempt = 0
+        while True:
+            batch = self.db.batch()
+            writes.replay(batch)
+            try:
+                return batch.commit()[0].update_time
+            except (self.backend.AlreadyExists, self.backend.FailedPrecondition):
+                if attempt == 0:
+                    raise
+                # An earlier attempt went through. Every write of a batch has
+                # the same update time.
+                return writes.first_reference().get().update_time
+            except self.backend.TRANSIENT_ERRORS as error:
+                if attempt >= IMPORT_RETRIES:
+                    raise
+                delay = min(IMPORT_BACKOFF * 2 ** attempt, IMPORT_MAX_BACKOFF)
+                print("Commit failed ({0}), retrying in {1:.1f}s...".format(error, delay))
+                time.sleep(delay * random.uniform(0.5, 1.0))
+                attempt += 1
+
     def _get_doc_by_title(self, title):
-        docs = self._get_docs()
+        docs = self._get_docs().where(u'title_key', u'==', normalize_title(title)).limit(1)
         for p in docs.stream():
-            if p.to_dict()[u'title'].lower() == title.lower():
-                return Doc.from_snapshot(p)
+            return Doc.from_snapshot(p)
+        return None
+
+    def _get_doc_by_doi(self, doi):
+        docs = self._get_docs().where(u'doi_key', u'==', normalize_doi(doi)).limit(1)
+        for p in docs.stream():
+            return Doc.from_snapshot(p)
         return None
 
     def get_docs(self):
+        # Notes are loaded per doc with get_notes when they are needed.
+        doc_objs, notes_by_doc, tombstones, watermark = self.get_changes(with_notes=False)
+        return doc_objs
+
+    def get_changes(self, since=None, with_notes=True):
+        # Returns (doc_objs, notes_by_doc, tombstones, watermark) for
+        # everything written at or after since, or for the whole library if
+        # since is None. tombstones are (kind, doc_id, id) tuples with kind
+        # 'doc' or 'note', and watermark is the latest updated_at seen.
+        # notes_by_doc is empty unless with_notes is set.
         docs = self._get_docs()
-        doc_objs = [Doc.from_snapshot(p) for p in docs.stream()]
+        notes = self.db.collection_group(u'notes')
+        if since is not None:
+            docs = docs.where(u'updated_at', u'>=', since)
+            notes = notes.where(u'updated_at', u'>=', since)
+        watermark = since
+
+        doc_objs = []
+        for doc_snapshot in docs.stream():
+            doc_obj = Doc.from_snapshot(doc_snapshot)
+            self._index_doc(doc_obj.id, doc_obj.title, doc_obj.doi)
+            doc_objs.append(doc_obj)
+            watermark = _later(watermark, doc_snapshot.to_dict().get(u'updated_at'))
         doc_objs.sort()
+        self.migrate_note_counts(doc_objs)
+
+        notes_by_doc = {}
+        for note_snapshot in (notes.stream() if with_notes else []):
+            doc_id = note_snapshot.reference.parent.parent.id
+            notes_by_doc.setdefault(doc_id, []).append(Note.from_snapshot(note_snapshot))
+            watermark = _later(watermark, note_snapshot.to_dict().get(u'updated_at'))
+
+        tombstones = []
+        if since is not None:
+            for tombstone in self._get_tombstones().where(u'updated_at', u'>=', since).stream():
+                source = tombstone.to_dict()
+                tombstones.append((source[u'kind'], source[u'doc_id'], source[u'id']))
+                watermark = _later(watermark, source.get(u'updated_at'))
+
+        return doc_objs, notes_by_doc, tombstones, watermark
+
+    def migrate_note_counts(self, doc_objs):
+        # Docs written before the note counters existed get them filled in
+        # once, from a single pass over the notes collection group, and so do
+        # the notes of those docs that have notes attached. A note added by
+        # someone else during the pass can throw a count off by one.
+        doc_objs = [doc_obj for doc_obj in doc_objs if doc_obj.note_count is None \
+                    or doc_obj.notetype_counts is None or doc_obj.child_counts is None]
+        if not doc_objs:
+            return
+        doc_ids = set(doc_obj.id for doc_obj in doc_objs)
+        doc_counts = {} # doc id -> {notetype_counts: {}, child_counts: {}}
+        note_child_counts = {} # (doc id, note id) -> {notetype: count}
+        note_keys = set()
+        notes = self.db.collection_group(u'notes').select([u'ref_id', u'notetype'])
+        for note_snapshot in notes.stream():
+            doc_id = note_snapshot.reference.parent.parent.id
+            if doc_id not in doc_ids:
+                continue
+            note_keys.add((doc_id, note_snapshot.id))
+            notetype = note_snapshot.get(u'notetype')
+            counts = doc_counts.setdefault(doc_id, {u'notetype_counts': {}, u'child_counts': {}})
+            counts[u'notetype_counts'][notetype] = counts[u'notetype_counts'].get(notetype, 0) + 1
+            if note_snapshot.get(u'ref_id') == doc_id:
+                child_counts = counts[u'child_counts']
+            else:
+                child_counts = note_child_counts.setdefault((doc_id, note_snapshot.get(u'ref_id')), {})
+            child_counts[notetype] = child_counts.get(notetype, 0) + 1
+
+        writer = BatchWriter(self.db)
         for doc_obj in doc_objs:
-            doc_obj.set_attached_notes(self.get_notes(doc_obj))
-        return doc_objs
-
-    def delete_doc(self, doc):
+            counts = doc_counts.get(doc_obj.id, {u'notetype_counts': {}, u'child_counts': {}})
+            counts[u'note_count'] = sum(counts[u'notetype_counts'].values())
+            doc_obj.note_count = counts[u'note_count']
+            doc_obj.notetype_counts = counts[u'notetype_counts']
+            doc_obj.child_counts = counts[u'child_counts']
+            writer.update(doc_obj.db_reference, self._stamped(counts))
+        for (doc_id, note_id), child_counts in note_child_counts.items():
+            # Skip ref_ids that point at notes which no longer exist.
+            if (doc_id, note_id) in note_keys:
+                writer.update(self.note_reference(doc_id, note_id), self._stamped({u'child_counts': child_counts}))
+        writer.commit()
+
+    def index_docs(self, doc_objs):
+        # Fill the duplicate-check indexes from docs loaded elsewhere.
+        for doc_obj in doc_objs:
+            self._index_doc(doc_obj.id, doc_obj.title, doc_obj.doi)
+
+    def unindex_doc(self, doc_obj):
+        self._unindex_doc(doc_obj)
+
+    def get_all_notes(self):
+        # Read every note in a single collection group query and group the
+        # results by the doc that owns them, instead of one query per doc.
+        notes_by_doc = {}
+        for note_snapshot in self.db.collection_group(u'notes').stream():
+            doc_id = note_snapshot.reference.parent.parent.id
+            notes_by_doc.setdefault(doc_id, []).append(Note.from_snapshot(note_snapshot))
+        return notes_by_doc
+
+    def list_docs(self, limit, start_after=None):
+        # One page of up to limit docs in document name order, with only
+        # the listed fields: ([(id, data)], the last snapshot or None).
+        # Pass the last snapshot as start_after to get the next page.
+        query = self._get_docs().order_by(u'__name__').select(LISTING_FIELDS).limit(limit)
+        if start_after is not None:
+            query = query.start_after(start_after)
+        snapshots = list(query.stream())
+        return [(snapshot.id, snapshot.to_dict()) for snapshot in snapshots], (snapshots[-1] if snapshots else None)
+
+    def stream_library(self):
+        # Yields (doc_data, notes_data) for every doc, as plain dicts with
+        # their id under 'id' and, for notes, the doc's id under 'doc_id'.
+        # Docs and the notes collection group are both read in document name
+        # order, so a doc's notes come right after each other and the two
+        # streams can be merged holding one doc's notes at a time.
+        docs = self._get_docs().order_by(u'__name__').stream()
+        notes = self.db.collection_group(u'notes').order_by(u'__name__').stream()
+        note_snapshot = next(notes, None)
+        for doc_snapshot in docs:
+            doc_data = doc_snapshot.to_dict()
+            doc_data[u'id'] = doc_snapshot.id
+            notes_data = []
+            while note_snapshot is not None:
+                doc_id = note_snapshot.reference.parent.parent.id
+                if doc_id > doc_snapshot.id:
+                    break
+                # Notes of a doc that is gone are left out.
+                if doc_id == doc_snapshot.id:
+                    note_data = note_snapshot.to_dict()
+                    note_data[u'id'] = note_snapshot.id
+                    note_data[u'doc_id'] = doc_id
+                    notes_data.append(note_data)
+                note_snapshot = next(notes, None)
+            yield doc_data, notes_data
+
+    def stream_note_links(self):
+        # Yields (doc_id, note_id, inlinks, outlinks) for every note that
+        # has links, reading only the link fields.
+        notes = self.db.collection_group(u'notes').select([u'inlinks', u'outlinks'])
+        for note_snapshot in notes.stream():
+            source = note_snapshot.to_dict()
+            if source.get(u'inlinks') or source.get(u'outlinks'):
+                yield note_snapshot.reference.parent.parent.id, note_snapshot.id, \
+                      source.get(u'inlinks') or [], source.get(u'outlinks') or []
+
+    def watch_docs(self, callback):
+        # Listen for changes to the docs collection. callback is called from
+        # the listener's background thread with a list of
+        # (change_type, doc_obj) tuples, change_type being one of 'ADDED',
+        # 'MODIFIED' or 'REMOVED'. The first call holds every existing doc.
+        def on_snapshot(snapshots, changes, read_time):
+            doc_changes = []
+            for change in changes:
+                doc_obj = Doc.from_snapshot(change.document)
+                if change.type.name == u'REMOVED':
+                    self._unindex_doc(doc_obj)
+                else:
+                    self._index_doc(doc_obj.id, doc_obj.title, doc_obj.doi)
+                doc_changes.append((change.type.name, doc_obj))
+            callback(doc_changes)
+        return self._get_docs().on_snapshot(on_snapshot)
+
+    def watch_notes(self, callback):
+        # Same as watch_docs, but for the notes collection group. The tuples
+        # are (change_type, doc_id, note_obj).
+        def on_snapshot(snapshots, changes, read_time):
+            note_changes = []
+            for change in changes:
+                doc_id = change.document.reference.parent.parent.id
+                note_changes.append((change.type.name, doc_id, Note.from_snapshot(change.document)))
+            callback(note_changes)
+        return self.db.collection_group(u'notes').on_snapshot(on_snapshot)
+
+    def delete_doc(self, doc, progress=None):
+        # Returns [(id, inlinks, outlinks)] for the doc and each of its notes
+        # that had links, so callers can drop the links on their side too,
+        # or None if the doc isn't in the database.
         doc_ref = doc.db_reference
         if doc_ref is None:
-            return False
-
-        # Delete all attached notes
-        note_snapshots = doc_ref.collection(u'notes').steam()
-        for note_snapshot in note_snapshots:
-            note_snapshot.reference.delete()
-
-        for author in doc.authors:
-            new_author = Author(**author)
-            author_snapshot = self._get_author(new_author)
-            self._dec_author_doc_count(author_snapshot)
+            return None
 
-        doc_ref.delete()
-        return True
+        if progress is None:
+            progress = lambda write_count: print("Deleted {0} records...".format(write_count))
+        writer = BatchWriter(self.db, progress)
+
+        # (id, inlinks, outlinks) for the doc and each linked note.
+        linked_ids = [(doc.id, list(doc.inlinks or []), list(doc.outlinks or []))]
+
+        # Delete all attached notes, one page per batch.
+        notes_query = doc_ref.collection(u'notes').order_by(u'__name__').limit(MAX_BATCH_WRITES)
+        last_snapshot = None
+        while True:
+            query = notes_query
+            if last_snapshot is not None:
+                query = notes_query.start_after(last_snapshot)
+            note_snapshots = list(query.select([u'inlinks', u'outlinks']).stream())
+            for note_snapshot in note_snapshots:
+                writer.delete(note_snapshot.reference)
+                source = note_snapshot.to_dict()
+                if source.get(u'inlinks') or source.get(u'outlinks'):
+                    linked_ids.append((note_snapshot.id, source.get(u'inlinks') or [], source.get(u'outlinks') or []))
+            if len(note_snapshots) < MAX_BATCH_WRITES:
+                break
+            last_snapshot = note_snapshots[-1]
+
+        # Remove links on other docs and notes that point to this doc or to
+        # one of its notes.
+        for linked_id, inlinks, outlinks in linked_ids:
+            if inlinks:
+                for ref in self._find_linking_refs(u'outlinks', linked_id, doc.id):
+                    writer.update(ref, self._stamped({u'outlinks': self.backend.ArrayRemove([linked_id])}))
+            if outlinks:
+                for ref in self._find_linking_refs(u'inlinks', linked_id, doc.id):
+                    writer.update(ref, self._stamped({u'inlinks': self.backend.ArrayRemove([linked_id])}))
+
+        # The author counts and the doc go out together in the last batch,
+        # so a failure before this point can simply be retried.
+        writer.reserve(len(doc.authors) + 2)
+        authors = [self._batch_dec_author_doc_count(writer, Author(**author)) for author in doc.authors]
+        writer.delete(doc_ref)
+        self._batch_tombstone(writer, u'doc', doc.id, doc.id)
+        writer.commit()
+        self._unindex_doc(doc)
+        for author in authors:
+            if author is not None:
+                author.doc_count -= 1
+        self._delete_unused_authors()
+        return linked_ids
+
+    def _find_linking_refs(self, field, linked_id, doc_id):
+        # References to every doc and note whose field array contains
+        # linked_id, leaving out the doc being deleted and its own notes.
+        queries = [self._get_docs().where(field, u'array_contains', linked_id),
+                   self.db.collection_group(u'notes').where(field, u'array_contains', linked_id)]
+        refs = []
+        for query in queries:
+            for snapshot in query.select([field]).stream():
+                ref = snapshot.reference
+                if ref.id == doc_id or ref.parent.parent is not None and ref.parent.parent.id == doc_id:
+                    continue
+                refs.append(ref)
+        return refs
 
     def add_link(self, out_obj, in_obj):
         # out_obj -> in_obj
@@ -79,52 +651,55 @@ class DatabaseDocMixin():
 
         if out_ref is None or in_ref is None:
             print("No doc selected. Quitting.")
-            return
+            return False
 
-        # Update out_obj.out_refs with in_obj.ref
+        # Both sides are updated in one atomic batch without reading first.
+        batch = self.db.batch()
+        batch.update(out_ref, self._stamped({u'outlinks': self.backend.ArrayUnion([str(in_ref.id)])}))
+        batch.update(in_ref, self._stamped({u'inlinks': self.backend.ArrayUnion([str(out_ref.id)])}))
         try:
-            out_refs = out_ref.get().get(u'outlinks')
-            out_refs.append(str(in_ref.id))
-            out_ref.update({u'outlinks':out_refs})
-        except KeyError:
-            out_refs = [str(in_ref.id)]
-            out_ref.update({u'outlinks':out_refs})
-
-        # Update in_obj.in_refs with out_obj.ref
-        try:
-            in_refs = in_ref.get().get(u'inlinks')
-            in_refs.append(str(out_ref.id))
-            in_ref.update({u'inlinks':in_refs})
-        except KeyError:
-            in_refs = [str(out_ref.id)]
-            in_ref.update({u'inlinks':in_refs})
+            batch.commit()
+        except self.backend.NotFound:
+            return False
+
+        return True
+
+    def add_links(self, pairs):
+        # Bulk version of add_link. pairs is an iterable of (out_obj, in_obj).
+        # Every link takes two writes, and they are packed into batches of
+        # up to MAX_BATCH_WRITES. Returns the number of links written.
+        writer = BatchWriter(self.db)
+        link_count = 0
+        for out_obj, in_obj in pairs:
+            out_ref = out_obj.db_reference
+            in_ref = in_obj.db_reference
+            if out_ref is None or in_ref is None:
+                continue
+
+            writer.reserve(2)
+            writer.update(out_ref, self._stamped({u'outlinks': self.backend.ArrayUnion([str(in_ref.id)])}))
+            writer.update(in_ref, self._stamped({u'inlinks': self.backend.ArrayUnion([str(out_ref.id)])}))
+            link_count += 1
+
+        writer.commit()
+        return link_count
 
     def delete_link(self, out_obj, in_obj):
-        # When a doc is deleted any links that point to that doc should
-        # also be removed. However, the program doesn't display these dangling
-        # references to the user, so for now I'm not worrying about it.
+        # Links pointing to a deleted doc are cleaned up by delete_doc.
 
         out_ref = out_obj.db_reference
         in_ref = in_obj.db_reference
 
         if out_ref is None or in_ref is None:
             print("No doc selected. Quitting.")
-            return
-
-        # Update out_obj.out_refs with in_obj.ref
-        try:
-            out_refs = out_ref.get().get(u'outlinks')
-            out_refs.remove(str(in_ref.id))
-            out_ref.update({u'outlinks':out_refs})
-        except KeyError:
             return False
 
-        # Update in_obj.in_refs with out_obj.ref
+        batch = self.db.batch()
+        batch.update(out_ref, self._stamped({u'outlinks': self.backend.ArrayRemove([str(in_ref.id)])}))
+        batch.update(in_ref, self._stamped({u'inlinks': self.backend.ArrayRemove([str(out_ref.id)])}))
         try:
-            in_refs = in_ref.get().get(u'inlinks')
-            in_refs.remove(str(out_ref.id))
-            in_ref.update({u'inlinks':in_refs})
-        except KeyError:
+            batch.commit()
+        except self.backend.NotFound:
             return False
 
         return True
@@ -135,8 +710,28 @@ class DatabaseDocMixin():
             print("Please add current doc to database before adding notes.")
             return
 
+        # The note and the counters on the doc and on the note it's
+        # attached to go out in one commit.
         note_refs = doc_ref.collection(u'notes')
-        note_refs.add(note.to_dict())
+        note_ref = note_refs.document()
+        doc_counts = {u'note_count': 1, u'notetype_counts.' + note.notetype: 1}
+        batch = self.db.batch()
+        batch.set(note_ref, self._stamped(note.to_dict()))
+        if note.ref_id == doc_ref.id:
+            doc_counts[u'child_counts.' + note.notetype] = 1
+        else:
+            batch.update(note_refs.document(note.ref_id), self._increments({u'child_counts.' + note.notetype: 1}))
+        batch.update(doc_ref, self._increments(doc_counts))
+        try:
+            write_results = batch.commit()
+        except self.backend.NotFound:
+            print("The doc or note this note is attached to is no longer in the database.")
+            return
+
+        note.id = note_ref.id
+        note.update_time = timestamp_to_datetime(write_results[0].update_time)
+        note.db_reference = note_ref
+        return note
 
     def get_notes(self, doc):
         doc_ref = doc.db_reference
@@ -147,68 +742,128 @@ class DatabaseDocMixin():
         note_refs = doc_ref.collection(u'notes').get()
         return [Note.from_snapshot(note) for note in note_refs]
 
-    def delete_note(self, note, doc):
+    def delete_note(self, note, doc, children=None):
+        # children are (id, notetype) pairs for the notes whose ref_id is
+        # note.id. Callers that already know them can pass them in to skip
+        # the query.
         doc_ref = doc.db_reference
         if doc_ref is None:
             return False
-        note_snapshots = doc_ref.collection(u'notes').get()
-        success = False
-        for note_snapshot in note_snapshots:
-            if note_snapshot.id == note.id:
-                note_snapshot.reference.delete()
-                success = True
-                break
-        if success == False:
-            return success
+        note_refs = doc_ref.collection(u'notes')
 
-        # Find any notes that referred to the note that was deleted and
-        # reattach their reference to the doc.
-        note_snapshots = doc_ref.collection(u'notes').get()
-        for note_snapshot in note_snapshots:
-            if note_snapshot.to_dict()[u'ref_id'] == note.id:
-                note_snapshot.reference.update({u'ref_id':doc_ref.id})
-        return success
+        # Find any notes that referred to the note being deleted so their
+        # reference can be reattached to the doc.
+        if children is None:
+            query = note_refs.where(u'ref_id', u'==', note.id).select([u'notetype'])
+            children = [(note_snapshot.id, note_snapshot.get(u'notetype')) for note_snapshot in query.stream()]
+
+        # Counter changes: the note leaves its doc and its parent, and its
+        # children move to the doc.
+        doc_counts = {u'note_count': -1, u'notetype_counts.' + note.notetype: -1}
+        parent_counts = doc_counts if note.ref_id == doc_ref.id else {}
+        parent_counts[u'child_counts.' + note.notetype] = -1
+        for child_id, notetype in children:
+            field = u'child_counts.' + notetype
+            doc_counts[field] = doc_counts.get(field, 0) + 1
+
+        # The delete, the counters and the re-parenting commit together. The
+        # exists precondition makes the whole batch fail if the note is gone.
+        writer = BatchWriter(self.db)
+        writer.reserve(len(children) + 4)
+        writer.delete(note_refs.document(note.id), option=self.db.write_option(exists=True))
+        writer.update(doc_ref, self._increments(doc_counts))
+        if parent_counts is not doc_counts:
+            writer.update(note_refs.document(note.ref_id), self._increments(parent_counts))
+        self._batch_tombstone(writer, u'note', doc_ref.id, note.id)
+        for child_id, notetype in children:
+            writer.update(note_refs.document(child_id), self._stamped({u'ref_id': doc_ref.id}))
+        try:
+            writer.commit()
+        except self.backend.NotFound:
+            return False
+        return True
 
 class DatabaseAuthorMixin():
     def __init__(self):
-        pass
-
-    def _add_author(self, new_author):
-        author_snapshot = self._get_author(new_author)
-        if author_snapshot is not None:
-            print("Author alredy in database.")
-            return
-        else:
-            print("Adding author to database.")
-            self._get_authors().add(new_author.to_dict())
-            return
+        # (lastname, firstname) -> Author. Filled by _load_authors the first
+        # time an author is looked up.
+        self.author_index = None
 
     def _get_authors(self):
         return self.db.collection(u'authors')
 
+    def stream_authors(self):
+        # Yields every author as a dict with its id under 'id'.
+        for author_snapshot in self._get_authors().stream():
+            author_data = author_snapshot.to_dict()
+            author_data[u'id'] = author_snapshot.id
+            yield author_data
+
+    def _load_authors(self):
+        self.author_index = {}
+        writer = BatchWriter(self.db)
+        for author_snapshot in self._get_authors().stream():
+            author = Author.from_snapshot(author_snapshot)
+            self.author_index[(author.lastname, author.firstname)] = author
+
+            # doc_count used to be stored as a string, which can't be
+            # incremented atomically. Convert those once.
+            if isinstance(author_snapshot.get(u'doc_count'), str):
+                writer.update(author_snapshot.reference, {u'doc_count': author.doc_count})
+        writer.commit()
+
     def _get_author(self, author):
         # Search by last name and first name.
-        authors = list(self._get_authors().where(u'lastname', u'==', author.lastname).where(u'firstname', u'==', author.firstname).stream())
-        if len(authors) == 0:
-            return None
+        if self.author_index is None:
+            self._load_authors()
+        return self.author_index.get((author.lastname, author.firstname))
+
+    def _batch_inc_author_doc_count(self, batch, new_author, quiet=False):
+        author = self._get_author(new_author)
+        if author is None:
+            if not quiet:
+                print("Adding author to database.")
+            # New authors get an id derived from their name, so two sessions
+            # adding the same author write to the same document.
+            author_data = new_author.to_dict()
+            author_ref = self._get_authors().document(author_doc_id(new_author.lastname, new_author.firstname))
+            new_author.id = author_ref.id
+            new_author.db_reference = author_ref
+            new_author.doc_count = 0
+            self.author_index[(new_author.lastname, new_author.firstname)] = new_author
+            author = new_author
         else:
-            return authors[0]
-
-    def _inc_author_doc_count(self, author_snapshot):
-        count = author_snapshot.get(u'doc_count')
-        new_count = int(count) + 1
-        author_snapshot.reference.update({u'doc_count': str(new_count)})
-
-    def _dec_author_doc_count(self, author_snapshot):
-        count = author_snapshot.get(u'doc_count')
-        if int(count) == 1:
-            self._delete_author(author_snapshot.reference)
-        else:
-            new_count = int(count) - 1
-            author_snapshot.reference.update({u'doc_count': str(new_count)})
-
-    def _delete_author(self, author_ref):
-        author_ref.delete()
+            author_data = {u'lastname': author.lastname, u'firstname': author.firstname}
+
+        author_data[u'doc_count'] = self.backend.Increment(1)
+        batch.set(author.db_reference, author_data, merge=True)
+        author.doc_count += 1
+
+    def _batch_dec_author_doc_count(self, batch, new_author):
+        # Returns the indexed author, or None. The cached doc_count may be
+        # stale, so the author is never deleted here; once the batch has gone
+        # through, _delete_unused_authors looks at the server's count. The
+        # author may already be gone on the server, so this is a merge rather
+        # than an update, which would fail the whole batch.
+        author = self._get_author(new_author)
+        if author is None:
+            return None
+        batch.set(author.db_reference, {u'lastname': author.lastname, u'firstname': author.firstname,
+                                        u'doc_count': self.backend.Increment(-1)}, merge=True)
+        return author
+
+    def _delete_unused_authors(self):
+        # Delete the authors whose doc_count has dropped to zero. Each delete
+        # only goes through if the author hasn't been written since it was
+        # read, so a doc added in another session meanwhile keeps it.
+        for author_snapshot in self._get_authors().where(u'doc_count', u'<=', 0).stream():
+            option = self.db.write_option(last_update_time=author_snapshot.update_time)
+            try:
+                author_snapshot.reference.delete(option=option)
+            except (self.backend.NotFound, self.backend.FailedPrecondition):
+                continue
+            if self.author_index is not None:
+                self.author_index.pop((author_snapshot.get(u'lastname'), author_snapshot.get(u'firstname')), None)
 
 # class DatabaseNoteMixin():
 #     def __init__(self):
@@ -233,7 +888,49 @@ class DatabaseAuthorMixin():
 #             all_notes += note_list
 #         return all_notes
 
-class Database(DatabaseAuthorMixin, DatabaseDocMixin):
+class FirestoreBackend():
+    # Cloud Firestore through firebase_admin. A backend provides a client with
+    # the Firestore API plus the write transforms and the NotFound exception
+    # that go with it; see sqlite_backend.SqliteBackend for the local one.
     def __init__(self):
+        # Imported here so the local backend works without these installed.
+        import firebase_admin
+        from firebase_admin import firestore
+        from google.cloud.firestore_v1 import ArrayRemove, ArrayUnion, Increment, SERVER_TIMESTAMP
+        import google.cloud.exceptions
+
         firebase_admin.initialize_app()
-        self.db = firestore.client()
+        self.client = firestore.client()
+        self.name = u'firestore:' + self.client.project
+        self.ArrayUnion = ArrayUnion
+        self.ArrayRemove = ArrayRemove
+        self.Increment = Increment
+        self.SERVER_TIMESTAMP = SERVER_TIMESTAMP
+        self.NotFound = google.cloud.exceptions.NotFound
+        from google.api_core import exceptions
+        # Raised when a last_update_time write option doesn't hold, and when
+        # a doc to create is already there.
+        self.FailedPrecondition = exceptions.FailedPrecondition
+        self.AlreadyExists = exceptions.AlreadyExists
+        # Errors worth retrying a commit for.
+        self.TRANSIENT_ERRORS = (exceptions.ServiceUnavailable, exceptions.DeadlineExceeded, \
+                                 exceptions.InternalServerError, exceptions.TooManyRequests, \
+                                 exceptions.Aborted)
+
+class Database(DatabaseAuthorMixin, DatabaseDocMixin):
+    def __init__(self, backend=None, stats=None):
+        DatabaseAuthorMixin.__init__(self)
+        DatabaseDocMixin.__init__(self)
+        if backend is None:
+            backend = FirestoreBackend()
+        self.backend = backend
+
+        # Every read, write and round trip goes through self.stats, and each
+        # public mixin method is timed as a call.
+        if stats is None:
+            stats = Stats()
+        self.stats = stats
+        self.db = InstrumentedClient(self.backend.client, self.stats)
+        public_methods = [name for mixin in (DatabaseDocMixin, DatabaseAuthorMixin) \
+                          for name in vars(mixin) if not name.startswith('_')]
+        self.stats.instrument(self, public_methods)
@@ -1,29 +1,102 @@
 from datetime import datetime
+import hashlib
+import sys
+
+# Links are replaced, never changed in place, so objects without links can
+# all share one empty tuple.
+NO_LINKS = ()
+
+def normalize_title(title):
+    # Case- and whitespace-insensitive key used for duplicate checks.
+    if title is None:
+        return None
+    return u' '.join(title.casefold().split())
+
+def normalize_doi(doi):
+    # DOIs are case-insensitive and are often pasted as resolver URLs.
+    if doi is None:
+        return None
+    doi = doi.strip().lower()
+    for prefix in (u'https://doi.org/', u'http://doi.org/', u'https://dx.doi.org/', u'http://dx.doi.org/', u'doi:'):
+        if doi.startswith(prefix):
+            doi = doi[len(prefix):]
+    if doi == u'':
+        return None
+    return doi
+
+def timestamp_to_datetime(timestamp):
+    # Snapshots and write results carry a protobuf Timestamp (seconds/nanos)
+    # or, in newer client versions, a timezone-aware datetime.
+    if timestamp is None:
+        return None
+    if isinstance(timestamp, datetime):
+        return datetime.fromtimestamp(timestamp.timestamp())
+    return datetime.fromtimestamp(timestamp.seconds + timestamp.nanos/1e9)
+
+def intern(value):
+    # Ids, notetypes, pages and author names repeat across objects (a
+    # note's ref_id is another object's id, every link is one), so equal
+    # strings are stored once.
+    if type(value) is str:
+        return sys.intern(value)
+    return value
+
+def intern_links(links):
+    if not links:
+        return NO_LINKS
+    return [intern(link) for link in links]
+
+def intern_counts(counts):
+    if counts is None:
+        return None
+    return {intern(key): value for key, value in counts.items()}
+
+def intern_authors(authors):
+    if authors is None:
+        return None
+    return [{intern(key): intern(value) for key, value in author.items()} for author in authors]
+
+def author_doc_id(lastname, firstname):
+    # Stable document id for an author, derived from their name.
+    name = u'{0}\n{1}'.format(lastname, firstname)
+    return hashlib.sha1(name.encode('utf-8')).hexdigest()
 
 class Doc():
     valid_doctypes = ["papers", "notebooks"]
-    def __init__(self, doctype="docs", title=None, authors=None, year=None, doi=None, inlinks=[], outlinks=[], id=None, update_time=None, db_snapshot=None):
-        self.doctype = doctype
+    # No per-object __dict__. Only the reference is kept from a snapshot,
+    # not the snapshot and its raw data.
+    __slots__ = ('doctype', 'title', 'authors', 'year', 'doi', 'inlinks', 'outlinks', 'note_count', \
+                 'notetype_counts', 'child_counts', 'id', 'update_time', 'attached_notes', 'db_reference')
+
+    def __init__(self, doctype="docs", title=None, authors=None, year=None, doi=None, inlinks=NO_LINKS, outlinks=NO_LINKS, note_count=None, notetype_counts=None, child_counts=None, id=None, update_time=None, db_snapshot=None):
+        self.doctype = intern(doctype)
         self.title = title
-        self.authors = authors
+        self.authors = intern_authors(authors)
         self.year = year
         if self.year is not None:
             self.year = int(year)
         self.doi = doi
         if self.doi is not None:
             self.doi = doi.lower()
-        self.inlinks = inlinks
-        self.outlinks = outlinks
-        self.id = id
+        self.inlinks = intern_links(inlinks)
+        self.outlinks = intern_links(outlinks)
+        # Counters kept up to date by the database so that the notes don't
+        # have to be loaded to summarize them: the number of notes on the
+        # doc, their number by notetype, and the number of notes attached
+        # directly to the doc by notetype. None for docs written before the
+        # fields existed.
+        self.note_count = note_count
+        self.notetype_counts = intern_counts(notetype_counts)
+        self.child_counts = intern_counts(child_counts)
+        self.id = intern(id)
         self.update_time = update_time
         self.attached_notes = []
         self.db_reference = None
-        self.db_snapshot = db_snapshot
-        if self.db_snapshot is not None:
-            self.db_reference = self.db_snapshot.reference
+        if db_snapshot is not None:
+            self.db_reference = db_snapshot.reference
 
     def __lt__(self, other):
-        return (getattr(self, 'update_time')) < (getattr(other, 'update_time'))
+        return self.update_time < other.update_time
 
     # def __eq__(self, other):
     #     mine = getattr(self, 'update_time')
@@ -32,13 +105,19 @@ class Doc():
 
     @staticmethod
     def from_snapshot(snapshot):
-        source = snapshot.to_dict()
+        return Doc.from_dict(snapshot.to_dict(), \
+                             id=snapshot.id, \
+                             update_time=timestamp_to_datetime(snapshot.update_time), \
+                             db_reference=snapshot.reference)
+
+    @staticmethod
+    def from_dict(source, id=None, update_time=None, db_reference=None):
         doc = Doc(doctype=source[u'doctype'], \
                   title=source[u'title'], \
                   authors=source[u'authors'], \
-                  id=snapshot.id, \
-                  update_time=datetime.fromtimestamp(snapshot.update_time.seconds + snapshot.update_time.nanos/1e9), \
-                  db_snapshot=snapshot)
+                  id=id, \
+                  update_time=update_time)
+        doc.db_reference = db_reference
 
         if u'year' in source:
             doc.year = source[u'year']
@@ -47,10 +126,19 @@ class Doc():
             doc.doi = source[u'doi']
 
         if u'inlinks' in source:
-            doc.inlinks = source[u'inlinks']
+            doc.inlinks = intern_links(source[u'inlinks'])
 
         if u'outlinks' in source:
-            doc.outlinks = source[u'outlinks']
+            doc.outlinks = intern_links(source[u'outlinks'])
+
+        if u'note_count' in source:
+            doc.note_count = int(source[u'note_count'])
+
+        if u'notetype_counts' in source:
+            doc.notetype_counts = intern_counts(source[u'notetype_counts'])
+
+        if u'child_counts' in source:
+            doc.child_counts = intern_counts(source[u'child_counts'])
 
         return doc
 
@@ -58,6 +146,7 @@ class Doc():
         doc = {
             u'doctype':self.doctype,
             u'title': self.title,
+            u'title_key': normalize_title(self.title),
             u'authors': self.authors,
         }
 
@@ -66,12 +155,24 @@ class Doc():
 
         if self.doi is not None:
             doc[u'doi'] = self.doi
+            doi_key = normalize_doi(self.doi)
+            if doi_key is not None:
+                doc[u'doi_key'] = doi_key
 
         if self.inlinks is not None:
-            doc[u'inlinks'] = self.inlinks
+            doc[u'inlinks'] = list(self.inlinks)
 
         if self.outlinks is not None:
-            doc[u'outlinks'] = self.outlinks
+            doc[u'outlinks'] = list(self.outlinks)
+
+        if self.note_count is not None:
+            doc[u'note_count'] = self.note_count
+
+        if self.notetype_counts is not None:
+            doc[u'notetype_counts'] = self.notetype_counts
+
+        if self.child_counts is not None:
+            doc[u'child_counts'] = self.child_counts
 
         if self.id is not None:
             doc[u'id'] = self.id
@@ -85,28 +186,28 @@ class Doc():
         self.attached_notes = note_list
 
 class Author():
+    __slots__ = ('lastname', 'firstname', 'doc_count', 'affiliation', 'email', 'id', 'update_time', 'db_reference')
+
     def __init__(self, lastname, firstname, doc_count=0, affiliation=None, email=None, id=None, update_time=None, db_snapshot=None):
-        self.lastname = lastname
-        self.firstname = firstname
+        self.lastname = intern(lastname)
+        self.firstname = intern(firstname)
         self.doc_count = doc_count
         self.affiliation = affiliation
         self.email = email
-        self.id = id
+        self.id = intern(id)
         self.update_time = update_time
         self.db_reference = None
-        self.db_snapshot = db_snapshot
-        if self.db_snapshot is not None:
-            self.db_reference = self.db_snapshot.reference
+        if db_snapshot is not None:
+            self.db_reference = db_snapshot.reference
 
     @staticmethod
     def from_snapshot(snapshot):
         source = snapshot.to_dict()
         author = Author(source[u'lastname'], \
                         source[u'firstname'], \
-                        source[u'doc_count'], \
+                        int(source[u'doc_count']), \
                         id=snapshot.id, \
-                        update_time=datetime.fromtimestamp(snapshot.update_time.seconds + \
-                                                           snapshot.update_time.nanos/1e9), \
+                        update_time=timestamp_to_datetime(snapshot.update_time), \
                         db_snapshot=snapshot)
 
         if u'affiliation' in source:
@@ -135,36 +236,65 @@ class Author():
 
         return author
 
+def _page_number(page):
+    # Pages are free text. Anything that isn't a number sorts as page 0.
+    try:
+        return int(page or 0)
+    except (TypeError, ValueError):
+        return 0
+
 class Note():
     valid_notetypes = ["notes", "selections", "ideas", \
                        "todos", "measures", "designs", \
                        "procedures", "results", "summaries",
                        "challenges", "RQs", "theories", \
                        "hypotheses", "reflections"]
-
-    def __init__(self, ref_id, notetype, body, id=None, page=None, inlinks=[], outlinks=[], update_time=None, db_snapshot=None):
-        self.ref_id = ref_id
-        self.notetype = notetype
+    # page is only set on notes that have one. sort_key is (page number,
+    # update_time), kept up to date by the page and update_time setters, so
+    # sorting notes doesn't parse pages on every comparison.
+    __slots__ = ('ref_id', 'notetype', 'body', 'id', '_page', 'inlinks', 'outlinks', 'child_counts', \
+                 '_update_time', 'sort_key', 'db_reference')
+
+    def __init__(self, ref_id, notetype, body, id=None, page=None, inlinks=NO_LINKS, outlinks=NO_LINKS, child_counts=None, update_time=None, db_snapshot=None):
+        self.ref_id = intern(ref_id)
+        self.notetype = intern(notetype)
         self.body = body
-        self.id = id
+        self.id = intern(id)
+        self._update_time = update_time
+        self.sort_key = (0, update_time or datetime.min)
         if page is not None:
-            self.page = page
-        self.inlinks = inlinks
-        self.outlinks = outlinks
+            self.page = intern(page)
+        self.inlinks = intern_links(inlinks)
+        self.outlinks = intern_links(outlinks)
+        # Number of notes attached to this one, by notetype.
+        self.child_counts = intern_counts(child_counts)
         if self.notetype not in Note.valid_notetypes:
             raise ValueError(u'{0} is not a valid notetype'.format(notetype))
-        self.update_time = update_time
         self.db_reference = None
-        self.db_snapshot = db_snapshot
-        if self.db_snapshot is not None:
-            self.db_reference = self.db_snapshot.reference
+        if db_snapshot is not None:
+            self.db_reference = db_snapshot.reference
+
+    @property
+    def page(self):
+        # AttributeError if the note has no page, like before.
+        return self._page
+
+    @page.setter
+    def page(self, page):
+        self._page = page
+        self.sort_key = (_page_number(page), self.sort_key[1])
+
+    @property
+    def update_time(self):
+        return self._update_time
+
+    @update_time.setter
+    def update_time(self, update_time):
+        self._update_time = update_time
+        self.sort_key = (self.sort_key[0], update_time or datetime.min)
 
     def __lt__(self, other):
-        mypage = int(getattr(self, 'page', '0'))
-        otherpage = int(getattr(other, 'page', '0'))
-        mytime = getattr(self, 'update_time')
-        othertime = getattr(other, 'update_time')
-        return (mypage, mytime) < (otherpage, othertime)
+        return self.sort_key < other.sort_key
 
     # def __eq__(self, other):
     #     mypage = getattr(self, 'page', '0')
@@ -173,20 +303,27 @@ class Note():
 
     @staticmethod
     def from_snapshot(snapshot):
-        source = snapshot.to_dict()
+        return Note.from_dict(snapshot.to_dict(), \
+                              id=snapshot.id, \
+                              update_time=timestamp_to_datetime(snapshot.update_time), \
+                              db_reference=snapshot.reference)
+
+    @staticmethod
+    def from_dict(source, id=None, update_time=None, db_reference=None):
         note = Note(source[u'ref_id'], \
                     source[u'notetype'], \
                     source[u'body'], \
-                    id=snapshot.id, \
-                    update_time=datetime.fromtimestamp(snapshot.update_time.seconds + \
-                                                       snapshot.update_time.nanos/1e9), \
-                    db_snapshot=snapshot)
+                    id=id, \
+                    update_time=update_time)
+        note.db_reference = db_reference
         if u'page' in source:
-            note.page = source[u'page']
+            note.page = intern(source[u'page'])
         if u'inlinks' in source:
-            note.inlinks = source[u'inlinks']
+            note.inlinks = intern_links(source[u'inlinks'])
         if u'outlinks' in source:
-            note.outlinks = source[u'outlinks']
+            note.outlinks = intern_links(source[u'outlinks'])
+        if u'child_counts' in source:
+            note.child_counts = intern_counts(source[u'child_counts'])
         return note
 
     def to_dict(self):
@@ -203,9 +340,12 @@ class Note():
             note[u'page'] = self.page
 
         if getattr(self, 'inlinks', None) is not None:
-            note[u'inlinks'] = self.inlinks
+            note[u'inlinks'] = list(self.inlinks)
 
         if getattr(self, 'outlinks', None) is not None:
-            note[u'outlinks'] = self.outlinks
+            note[u'outlinks'] = list(self.outlinks)
+
+        if getattr(self, 'child_counts', None) is not None:
+            note[u'child_counts'] = self.child_counts
 
         return note
@@ -0,0 +1,231 @@
+import html
+import json
+import multiprocessing
+import os
+import re
+import time
+from collections import deque
+from datetime import datetime
+
+# Writes the whole library to a file, one doc at a time. Database streams the
+# docs with their notes (see Database.stream_library), a render function
+# turns each (doc_data, notes_data) record into text, and the text goes
+# through a large write buffer. With processes > 1 the rendering is spread
+# over a process pool, a bounded number of chunks at a time, so memory stays
+# flat whatever the size of the library.
+
+# Size of the output file's write buffer.
+WRITE_BUFFER = 1024 * 1024
+
+# Docs per task sent to the process pool, and tasks in flight at a time.
+POOL_CHUNK = 64
+POOL_WINDOW = 16
+
+# Seconds between progress reports.
+REPORT_INTERVAL = 2.0
+
+def render_jsonl(record):
+    # One line per doc, then one per note.
+    doc_data, notes_data = record
+    lines = [_json_line(u'doc', doc_data)]
+    for note_data in notes_data:
+        lines.append(_json_line(u'note', note_data))
+    return u''.join(lines)
+
+def _json_line(kind, data):
+    data = dict(data)
+    data[u'type'] = kind
+    return json.dumps(data, default=_json_default, ensure_ascii=False, sort_keys=True) + u'\n'
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(u'Cannot export {0!r}'.format(value))
+
+HTML_HEADER = u'<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n<title>Literature review</title>\n</head>\n<body>\n'
+HTML_FOOTER = u'</body>\n</html>\n'
+
+def render_html(record):
+    # The doc's note tree as nested lists, like "note_tree clean".
+    doc_data, notes_data = record
+    parts = [u'<section id="{0}">\n<h2>{1}</h2>\n'.format(html.escape(doc_data[u'id']), \
+                                                        html.escape(doc_data.get(u'title') or u''))]
+    authors = u'; '.join(_author_name(author) for author in doc_data.get(u'authors') or [])
+    details = [text for text in (authors, str(doc_data.get(u'year') or u''), doc_data.get(u'doi') or u'') if text]
+    if details:
+        parts.append(u'<p>{0}</p>\n'.format(html.escape(u', '.join(details))))
+
+    if not notes_data:
+        parts.append(u'</section>\n')
+        return u''.join(parts)
+    children = _children_by_ref_id(doc_data[u'id'], notes_data)
+    # Walk the tree with a stack rather than recursion, trees can be deep.
+    stack = [iter(children.get(doc_data[u'id'], []))]
+    parts.append(u'<ul>\n')
+    while stack:
+        note_data = next(stack[-1], None)
+        if note_data is None:
+            stack.pop()
+            # Below the top level the list sits inside its parent's <li>.
+            parts.append(u'</ul>\n</li>\n' if stack else u'</ul>\n')
+            continue
+        parts.append(u'<li>{0} ({1})'.format(html.escape(note_data.get(u'body') or u''), \
+                                             html.escape(note_data.get(u'notetype') or u'')))
+        if note_data[u'id'] in children:
+            parts.append(u'\n<ul>\n')
+            stack.append(iter(children[note_data[u'id']]))
+        else:
+            parts.append(u'</li>\n')
+    parts.append(u'</section>\n')
+    return u''.join(parts)
+
+def _children_by_ref_id(doc_id, notes_data):
+    # ref id -> notes attached to it, in the order Note sorts them. Notes
+    # whose parent is gone are attached to the doc.
+    note_ids = set(note_data[u'id'] for note_data in notes_data)
+    children = {}
+    for note_data in notes_data:
+        ref_id = note_data.get(u'ref_id')
+        if ref_id != doc_id and ref_id not in note_ids:
+            ref_id = doc_id
+        children.setdefault(ref_id, []).append(note_data)
+    for siblings in children.values():
+        siblings.sort(key=_note_sort_key)
+    return children
+
+def _note_sort_key(note_data):
+    try:
+        page = int(note_data.get(u'page') or 0)
+    except ValueError:
+        page = 0
+    updated_at = note_data.get(u'updated_at')
+    return page, updated_at.timestamp() if isinstance(updated_at, datetime) else 0.0
+
+def render_bibtex(record):
+    # Summaries become the abstract and plain notes the note field, which
+    # is how importer reads them back.
+    doc_data, notes_data = record
+    authors = doc_data.get(u'authors') or []
+    fields = [(u'title', _bibtex_escape(doc_data.get(u'title'))),
+              (u'author', u' and '.join(_bibtex_author(author) for author in authors)),
+              (u'year', _bibtex_escape(doc_data.get(u'year'))),
+              (u'doi', _bibtex_escape(doc_data.get(u'doi'))),
+              (u'abstract', _bibtex_escape(u' '.join(note_data[u'body'] for note_data in notes_data \
+                                                     if note_data.get(u'notetype') == u'summaries'))),
+              (u'note', _bibtex_escape(u' '.join(note_data[u'body'] for note_data in notes_data \
+                                                 if note_data.get(u'notetype') == u'notes')))]
+
+    key = u'{0}{1}-{2}'.format(authors[0].get(u'lastname', u'') if authors else u'', \
+                               doc_data.get(u'year') or u'', doc_data[u'id'][:8])
+    key = re.sub(r'[^\w-]', u'', key)
+    entry_type = u'article' if doc_data.get(u'doctype') == u'papers' else u'misc'
+    lines = [u'@{0}{{{1},'.format(entry_type, key)]
+    for name, value in fields:
+        if value:
+            lines.append(u'  {0} = {{{1}}},'.format(name, value))
+    lines.append(u'}\n\n')
+    return u'\n'.join(lines)
+
+def _bibtex_escape(value):
+    if value is None:
+        return u''
+    return re.sub(r'([&%$#_{}])', r'\\\1', str(value))
+
+def _bibtex_author(author):
+    # Names without a first name, usually organizations, are braced so
+    # they aren't split into first and last names when read back.
+    lastname = _bibtex_escape(author.get(u'lastname'))
+    firstname = _bibtex_escape(author.get(u'firstname'))
+    if not firstname:
+        return u'{{{0}}}'.format(lastname)
+    return u'{0}, {1}'.format(lastname, firstname)
+
+def _author_name(author):
+    return u' '.join(name for name in (author.get(u'firstname'), author.get(u'lastname')) if name)
+
+# format -> (render, header, footer)
+FORMATS = {
+    u'jsonl': (render_jsonl, u'', u''),
+    u'html': (render_html, HTML_HEADER, HTML_FOOTER),
+    u'bibtex': (render_bibtex, u'', u''),
+}
+
+_EXTENSIONS = {u'.jsonl': u'jsonl', u'.html': u'html', u'.htm': u'html', u'.bib': u'bibtex'}
+
+def detect_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in _EXTENSIONS:
+        raise ValueError(u'Unknown export file type {0}, give the format: {1}.'.format(
+            extension, u', '.join(sorted(FORMATS))))
+    return _EXTENSIONS[extension]
+
+def export_file(model, path, format=None, processes=1, progress=print):
+    # Writes the library to path. The file is written under a temporary name
+    # and moved into place at the end, so a failed export leaves the last
+    # one alone. Returns a dict of counts.
+    if format is None:
+        format = detect_format(path)
+    render, header, footer = FORMATS[format]
+    model.wait_until_loaded()
+    database = model.db
+
+    start_time = time.perf_counter()
+    counts = {u'docs': 0, u'notes': 0, u'authors': 0}
+    last_report = [start_time]
+    def counted(records):
+        for record in records:
+            counts[u'docs'] += 1
+            counts[u'notes'] += len(record[1])
+            now = time.perf_counter()
+            if now - last_report[0] >= REPORT_INTERVAL:
+                last_report[0] = now
+                progress(u'{0} docs, {1} notes exported, {2:.0f} docs/s'.format(
+                    counts[u'docs'], counts[u'notes'], counts[u'docs'] / (now - start_time)))
+            yield record
+
+    temporary_path = path + u'.tmp'
+    with open(temporary_path, u'w', encoding=u'utf-8', buffering=WRITE_BUFFER) as export_file:
+        export_file.write(header)
+        records = counted(database.stream_library())
+        if processes > 1:
+            with multiprocessing.Pool(processes) as pool:
+                export_file.writelines(_ordered_map(pool, render, records))
+        else:
+            export_file.writelines(render(record) for record in records)
+        if format == u'jsonl':
+            for author_data in database.stream_authors():
+                counts[u'authors'] += 1
+                export_file.write(_json_line(u'author', author_data))
+        export_file.write(footer)
+    os.replace(temporary_path, path)
+
+    seconds = time.perf_counter() - start_time
+    result = dict(counts)
+    result[u'seconds'] = seconds
+    progress(u'Exported {0} docs and {1} notes to {2} in {3:.1f}s.'.format(
+        counts[u'docs'], counts[u'notes'], path, seconds))
+    return result
+
+def _ordered_map(pool, render, records):
+    # Like pool.imap, but only POOL_WINDOW chunks are read ahead, where imap
+    # would pull in every record as fast as they come.
+    pending = deque()
+    for chunk in _chunks(records, POOL_CHUNK):
+        pending.append(pool.apply_async(_render_chunk, (render, chunk)))
+        if len(pending) >= POOL_WINDOW:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def _render_chunk(render, chunk):
+    return u''.join(render(record) for record in chunk)
+
+def _chunks(records, size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
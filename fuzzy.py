@@ -0,0 +1,114 @@
+import math
+import re
+import threading
+
+# Jaccard similarity of two titles' trigram sets above which they are
+# reported as likely duplicates.
+DUPLICATE_SIMILARITY = 0.7
+
+# Share of a lookup's trigrams that a title must contain to match it.
+LOOKUP_SIMILARITY = 0.5
+
+def fuzzy_key(text):
+    # Lowercased words with punctuation dropped, so "The X-Effect:" and
+    # "the x effect" get the same key.
+    if text is None:
+        return u''
+    return u' '.join(re.sub(r'[\W_]+', u' ', text.casefold()).split())
+
+def trigrams(key):
+    # Each word is padded the way pg_trgm does it, so short words and word
+    # starts still produce trigrams.
+    grams = set()
+    for word in key.split():
+        padded = u'  ' + word + u' '
+        for start in range(len(padded) - 2):
+            grams.add(padded[start:start + 3])
+    return grams
+
+class TrigramIndex():
+    # Maps trigrams to the ids of the titles that contain them. A lookup only
+    # visits titles that share one of the query's rarest trigrams: for a
+    # title to reach similarity t it must share at least ceil(t * n) of the
+    # query's n trigrams, so it has to contain one of the n - ceil(t * n) + 1
+    # rarest ones. The others are never looked at.
+    #
+    # Snapshot listeners update it from their own thread, hence the lock.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.postings = {} # trigram -> set of ids
+        self.grams = {} # id -> frozenset of trigrams
+        self.keys = {} # id -> fuzzy key
+        self.ids_by_key = {} # fuzzy key -> set of ids
+
+    def __len__(self):
+        return len(self.grams)
+
+    def add(self, id, text):
+        with self.lock:
+            self._remove(id)
+            self._add(id, text)
+
+    def remove(self, id):
+        with self.lock:
+            self._remove(id)
+
+    def _add(self, id, text):
+        key = fuzzy_key(text)
+        grams = frozenset(trigrams(key))
+        self.grams[id] = grams
+        self.keys[id] = key
+        self.ids_by_key.setdefault(key, set()).add(id)
+        for gram in grams:
+            self.postings.setdefault(gram, set()).add(id)
+
+    def _remove(self, id):
+        grams = self.grams.pop(id, None)
+        if grams is None:
+            return
+        key = self.keys.pop(id)
+        self.ids_by_key[key].discard(id)
+        if not self.ids_by_key[key]:
+            del self.ids_by_key[key]
+        for gram in grams:
+            self.postings[gram].discard(id)
+            if not self.postings[gram]:
+                del self.postings[gram]
+
+    def find_key(self, text):
+        # Ids whose text has the same fuzzy key as text.
+        key = fuzzy_key(text)
+        if not key:
+            return set()
+        with self.lock:
+            return set(self.ids_by_key.get(key, ()))
+
+    def search(self, text, threshold, limit=None, containment=False):
+        # Returns [(similarity, id)] for everything at or above threshold,
+        # best first. Similarity is the Jaccard index of the trigram sets,
+        # or with containment the share of text's trigrams found in the
+        # other title, which suits short, partial lookups.
+        query = trigrams(fuzzy_key(text))
+        if not query or threshold <= 0:
+            return []
+        required = int(math.ceil(threshold * len(query)))
+        matches = []
+        with self.lock:
+            rarest = sorted(query, key=lambda gram: len(self.postings.get(gram, ())))
+            candidates = set()
+            for gram in rarest[:len(query) - required + 1]:
+                candidates.update(self.postings.get(gram, ()))
+
+            for id in candidates:
+                shared = len(query & self.grams[id])
+                if containment:
+                    similarity = shared / len(query)
+                else:
+                    similarity = shared / (len(query) + len(self.grams[id]) - shared)
+                if similarity >= threshold:
+                    matches.append((similarity, id))
+        matches.sort(key=lambda match: (-match[0], match[1]))
+        if limit is not None:
+            matches = matches[:limit]
+        return matches
@@ -0,0 +1,345 @@
+import threading
+from array import array
+from collections import deque
+
+# Edited rows are kept aside until they reach this share of the nodes, then
+# the arrays are rebuilt.
+COMPACT_FRACTION = 0.05
+MIN_COMPACT = 256
+
+PAGERANK_DAMPING = 0.85
+# Stop once the ranks move less than this per node, summed over all nodes.
+PAGERANK_TOLERANCE = 1e-6
+PAGERANK_ITERATIONS = 100
+
+# Directions a traversal can follow links in.
+OUT = u'out'
+IN = u'in'
+BOTH = u'both'
+DIRECTIONS = (OUT, IN, BOTH)
+
+class LinkGraph():
+    # The links between docs and notes as a directed graph, edge u -> v when
+    # v is in u's outlinks.
+    #
+    # Ids are interned to node numbers, and the edges are kept in compressed
+    # sparse row form: node n's out-neighbors are
+    # out_targets[out_offsets[n]:out_offsets[n + 1]], and the same for
+    # in-neighbors, all in flat arrays of ints. That's a few bytes per edge
+    # instead of a list of id strings on every object, and a neighbor lookup
+    # is a slice.
+    #
+    # Changes don't rebuild the arrays. A changed node's out-row is replaced
+    # by a set in self.changed, and self.extra_in holds the in-edges those
+    # sets add, so each change costs about the size of the row. When enough
+    # rows have changed the arrays are rebuilt from scratch.
+    #
+    # Every node belongs to a doc (docs to themselves). Removing a doc
+    # removes its notes along with it, and nodes that are only known as link
+    # targets (owner -1) are left out of every result.
+    #
+    # Snapshot listeners update it from their own thread, hence the lock.
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.version = 0
+        self._clear()
+
+    def _clear(self):
+        self.index = {} # id -> node
+        self.ids = [] # node -> id
+        self.owners = array('l') # node -> node of its doc, or -1
+        self.removed = set()
+        self.base_size = 0 # nodes covered by the arrays
+        self.out_offsets = array('l', [0])
+        self.out_targets = array('l')
+        self.in_offsets = array('l', [0])
+        self.in_targets = array('l')
+        self.changed = {} # node -> set of out-neighbors
+        self.extra_in = {} # node -> set of in-neighbors from changed rows
+        self.rank_cache = None
+
+    def __len__(self):
+        with self.lock:
+            return sum(1 for node in range(len(self.ids)) if self._alive(node))
+
+    def edge_count(self):
+        with self.lock:
+            return sum(1 for node in range(len(self.ids)) if self._alive(node) \
+                       for target in self._out(node) if self._alive(target))
+
+    def build(self, rows):
+        # Replaces the graph with rows of (id, doc_id, outlinks).
+        with self.lock:
+            self._clear()
+            sources = array('l')
+            targets = array('l')
+            for id, doc_id, outlinks in rows:
+                node = self._node(id)
+                self.owners[node] = self._node(doc_id)
+                for target_id in set(outlinks or []):
+                    sources.append(node)
+                    targets.append(self._node(target_id))
+            self._load(sources, targets)
+            self.version += 1
+
+    def _node(self, id):
+        node = self.index.get(id)
+        if node is None:
+            node = len(self.ids)
+            self.index[id] = node
+            self.ids.append(id)
+            self.owners.append(-1)
+        return node
+
+    def _load(self, sources, targets):
+        self.base_size = len(self.ids)
+        self.out_offsets, self.out_targets = _compress(self.base_size, sources, targets)
+        self.in_offsets, self.in_targets = _compress(self.base_size, targets, sources)
+        self.changed = {}
+        self.extra_in = {}
+
+    def _compact(self):
+        sources = array('l')
+        targets = array('l')
+        for node in range(len(self.ids)):
+            if not self._alive(node):
+                continue
+            for target in self._out(node):
+                sources.append(node)
+                targets.append(target)
+        self._load(sources, targets)
+
+    def set_links(self, id, doc_id, outlinks, inlinks=None):
+        # Adds or updates a node. doc_id None keeps the node's doc. A note
+        # without links is only added if it is already a link target, so the
+        # graph holds every doc but only the notes that are linked.
+        with self.lock:
+            if id not in self.index and id != doc_id and not outlinks and not inlinks:
+                return
+            node = self._node(id)
+            if doc_id is not None:
+                self.owners[node] = self._node(doc_id)
+            self.removed.discard(node)
+            self._set_out(node, set(self._node(target_id) for target_id in outlinks or []))
+            self.version += 1
+
+    def remove(self, id):
+        # Removes a doc with all its notes, or a note.
+        with self.lock:
+            node = self.index.get(id)
+            if node is None or node in self.removed:
+                return
+            self.removed.add(node)
+            self._set_out(node, set())
+            self.version += 1
+
+    def _set_out(self, node, new_targets):
+        old_targets = set(self._out(node))
+        if new_targets == old_targets:
+            return
+        base_targets = set(self._base_out(node))
+        for target in old_targets - new_targets:
+            if target not in base_targets:
+                self.extra_in[target].discard(node)
+        for target in new_targets - old_targets:
+            if target not in base_targets:
+                self.extra_in.setdefault(target, set()).add(node)
+        self.changed[node] = new_targets
+        if len(self.changed) > max(MIN_COMPACT, COMPACT_FRACTION * len(self.ids)):
+            self._compact()
+
+    def _base_out(self, node):
+        if node >= self.base_size:
+            return ()
+        return self.out_targets[self.out_offsets[node]:self.out_offsets[node + 1]]
+
+    def _out(self, node):
+        if node in self.changed:
+            return self.changed[node]
+        return self._base_out(node)
+
+    def _in(self, node):
+        sources = []
+        if node < self.base_size:
+            changed = self.changed
+            for source in self.in_targets[self.in_offsets[node]:self.in_offsets[node + 1]]:
+                if source not in changed or node in changed[source]:
+                    sources.append(source)
+        sources.extend(self.extra_in.get(node, ()))
+        return sources
+
+    def _alive(self, node):
+        owner = self.owners[node]
+        return owner >= 0 and node not in self.removed and owner not in self.removed
+
+    def _neighbors(self, node, direction):
+        if direction == OUT:
+            neighbors = self._out(node)
+        elif direction == IN:
+            neighbors = self._in(node)
+        else:
+            neighbors = list(self._out(node)) + self._in(node)
+        return [neighbor for neighbor in neighbors if self._alive(neighbor)]
+
+    def owner(self, id):
+        # The id of the doc a node belongs to, or None.
+        with self.lock:
+            node = self.index.get(id)
+            if node is None or not self._alive(node):
+                return None
+            return self.ids[self.owners[node]]
+
+    def shortest_path(self, source_id, target_id, direction=BOTH):
+        # The ids along a shortest path from source to target, both ends
+        # included, or None. Searches from both ends at once, always
+        # widening the smaller frontier, so it only visits around the square
+        # root of what a one-sided search would.
+        with self.lock:
+            source = self.index.get(source_id)
+            target = self.index.get(target_id)
+            if source is None or target is None or not self._alive(source) or not self._alive(target):
+                return None
+            if source == target:
+                return [source_id]
+            backward_direction = {OUT: IN, IN: OUT, BOTH: BOTH}[direction]
+            forward_parents = {source: None}
+            backward_parents = {target: None}
+            forward_frontier = [source]
+            backward_frontier = [target]
+            while forward_frontier and backward_frontier:
+                if len(forward_frontier) <= len(backward_frontier):
+                    forward_frontier, meeting = self._widen(forward_frontier, direction, \
+                                                            forward_parents, backward_parents)
+                else:
+                    backward_frontier, meeting = self._widen(backward_frontier, backward_direction, \
+                                                             backward_parents, forward_parents)
+                if meeting is not None:
+                    path = []
+                    node = meeting
+                    while node is not None:
+                        path.append(node)
+                        node = forward_parents[node]
+                    path.reverse()
+                    node = backward_parents[meeting]
+                    while node is not None:
+                        path.append(node)
+                        node = backward_parents[node]
+                    return [self.ids[node] for node in path]
+            return None
+
+    def _widen(self, frontier, direction, parents, other_parents):
+        # One BFS level. Returns the next frontier and the first node seen
+        # from the other side, if any.
+        next_frontier = []
+        for node in frontier:
+            for neighbor in self._neighbors(node, direction):
+                if neighbor in parents:
+                    continue
+                parents[neighbor] = node
+                if neighbor in other_parents:
+                    return next_frontier, neighbor
+                next_frontier.append(neighbor)
+        return next_frontier, None
+
+    def neighborhood(self, id, hops=1, direction=BOTH):
+        # [(distance, id)] for everything within hops links of id, nearest
+        # first, id itself left out.
+        with self.lock:
+            start = self.index.get(id)
+            if start is None or not self._alive(start):
+                return []
+            distances = {start: 0}
+            frontier = [start]
+            found = []
+            for distance in range(1, hops + 1):
+                next_frontier = []
+                for node in frontier:
+                    for neighbor in self._neighbors(node, direction):
+                        if neighbor not in distances:
+                            distances[neighbor] = distance
+                            next_frontier.append(neighbor)
+                            found.append((distance, self.ids[neighbor]))
+                if not next_frontier:
+                    break
+                frontier = next_frontier
+            return found
+
+    def components(self):
+        # The weakly connected components with more than one node, as lists
+        # of ids, biggest first.
+        with self.lock:
+            seen = set()
+            components = []
+            for start in range(len(self.ids)):
+                if start in seen or not self._alive(start):
+                    continue
+                seen.add(start)
+                component = [start]
+                queue = deque(component)
+                while queue:
+                    for neighbor in self._neighbors(queue.popleft(), BOTH):
+                        if neighbor not in seen:
+                            seen.add(neighbor)
+                            component.append(neighbor)
+                            queue.append(neighbor)
+                if len(component) > 1:
+                    components.append([self.ids[node] for node in component])
+            components.sort(key=len, reverse=True)
+            return components
+
+    def rank(self, damping=PAGERANK_DAMPING, tolerance=PAGERANK_TOLERANCE, iterations=PAGERANK_ITERATIONS):
+        # PageRank of every node as {id: score}, the scores summing to 1.
+        # Rank from nodes without outlinks is spread over all nodes. The
+        # result is kept until the graph changes.
+        with self.lock:
+            key = (self.version, damping, tolerance, iterations)
+            if self.rank_cache is not None and self.rank_cache[0] == key:
+                return self.rank_cache[1]
+
+            nodes = [node for node in range(len(self.ids)) if self._alive(node)]
+            count = len(nodes)
+            if count == 0:
+                return {}
+            # Renumber the live nodes 0..count-1 and pull each one's
+            # in-neighbors into a row of its own.
+            positions = {node: position for position, node in enumerate(nodes)}
+            in_rows = [array('l') for node in nodes]
+            out_degrees = [0] * count
+            for position, node in enumerate(nodes):
+                for target in self._out(node):
+                    target_position = positions.get(target)
+                    if target_position is not None:
+                        in_rows[target_position].append(position)
+                        out_degrees[position] += 1
+
+        dangling = [position for position in range(count) if out_degrees[position] == 0]
+        ranks = [1.0 / count] * count
+        for iteration in range(iterations):
+            shares = [rank / degree if degree else 0.0 for rank, degree in zip(ranks, out_degrees)]
+            base = (1.0 - damping + damping * sum(ranks[position] for position in dangling)) / count
+            new_ranks = [base + damping * sum(map(shares.__getitem__, row)) if row else base for row in in_rows]
+            change = sum(abs(new - old) for new, old in zip(new_ranks, ranks))
+            ranks = new_ranks
+            if change < tolerance * count:
+                break
+
+        with self.lock:
+            result = {self.ids[node]: rank for node, rank in zip(nodes, ranks)}
+            if self.version == key[0]:
+                self.rank_cache = (key, result)
+        return result
+
+def _compress(size, sources, targets):
+    # CSR arrays (offsets, targets) for the edges sources[i] -> targets[i].
+    offsets = array('l', [0]) * (size + 1)
+    for source in sources:
+        offsets[source + 1] += 1
+    for node in range(size):
+        offsets[node + 1] += offsets[node]
+    positions = offsets[:-1]
+    row_targets = array('l', [0]) * len(targets)
+    for source, target in zip(sources, targets):
+        row_targets[positions[source]] = target
+        positions[source] += 1
+    return offsets, row_targets
@@ -0,0 +1,410 @@
+import json
+import os
+import re
+import time
+import unicodedata
+from document_types import *
+
+# The parsers read their file a piece at a time and yield one entry dict per
+# reference:
+#
+#     {'title': ..., 'authors': [{'lastname': ..., 'firstname': ...}],
+#      'year': int or None, 'doi': ..., 'abstract': ..., 'notes': [...]}
+#
+# import_file turns those into docs (with the abstract and notes as notes)
+# and hands them to Model.import_docs, keeping a checkpoint next to the file
+# so an interrupted import can pick up where it stopped.
+
+CHECKPOINT_SUFFIX = u'.import-checkpoint'
+
+# Seconds between progress reports.
+REPORT_INTERVAL = 2.0
+
+READ_SIZE = 64 * 1024
+
+def parse_bibtex(stream):
+    strings = dict(_MONTHS)
+    for text in _bibtex_entries(stream):
+        match = re.match(r'\s*@\s*(\w+)\s*[{(]', text)
+        entry_type = match.group(1).lower()
+        body = text[match.end():].rstrip()[:-1]
+        if entry_type in (u'comment', u'preamble'):
+            continue
+        if entry_type == u'string':
+            strings.update(_bibtex_fields(body, strings))
+            continue
+        key, comma, fields = body.partition(u',')
+        fields = _bibtex_fields(fields, strings)
+        notes = [_clean_latex(fields[name]) for name in (u'annote', u'note') if fields.get(name)]
+        yield {
+            u'title': _clean_latex(fields.get(u'title', u'')),
+            u'authors': [_bibtex_name(name) for name in _split_authors(fields.get(u'author', u''))],
+            u'year': _to_year(fields.get(u'year')),
+            u'doi': fields.get(u'doi', u'').strip() or None,
+            u'abstract': _clean_latex(fields.get(u'abstract', u'')),
+            u'notes': notes,
+        }
+
+def _bibtex_entries(stream):
+    # The text of each @entry{...}, found by counting its delimiters, so
+    # only one entry is held at a time.
+    lines = []
+    depth = 0
+    opener = closer = None
+    for line in stream:
+        if opener is None:
+            match = re.match(r'\s*@\s*\w+\s*([{(])', line)
+            if match is None:
+                continue
+            opener = match.group(1)
+            closer = u'}' if opener == u'{' else u')'
+            depth = 0
+        lines.append(line)
+        depth += line.count(opener) - line.count(closer)
+        if depth <= 0:
+            yield u''.join(lines)
+            lines = []
+            opener = None
+    if lines:
+        yield u''.join(lines) + closer
+
+_FIELD_NAME = re.compile(r'\s*([^\s=,{}"#]+)\s*=\s*')
+
+def _bibtex_fields(text, strings):
+    fields = {}
+    position = 0
+    while True:
+        match = _FIELD_NAME.match(text, position)
+        if match is None:
+            return fields
+        value, position = _bibtex_value(text, match.end(), strings)
+        fields[match.group(1).lower()] = value
+        comma = text.find(u',', position)
+        if comma < 0:
+            return fields
+        position = comma + 1
+
+def _bibtex_value(text, position, strings):
+    # A value is one or more {braced}, "quoted", number or @string parts
+    # joined with #.
+    parts = []
+    while position < len(text):
+        while position < len(text) and text[position].isspace():
+            position += 1
+        if position >= len(text):
+            break
+        char = text[position]
+        if char == u'{':
+            end = _closing_brace(text, position)
+            parts.append(text[position + 1:end])
+            position = end + 1
+        elif char == u'"':
+            end = position + 1
+            depth = 0
+            while end < len(text) and not (text[end] == u'"' and depth == 0):
+                if text[end] == u'{':
+                    depth += 1
+                elif text[end] == u'}':
+                    depth -= 1
+                end += 1
+            parts.append(text[position + 1:end])
+            position = end + 1
+        else:
+            match = re.compile(r'[^\s,#}]+').match(text, position)
+            if match is None:
+                break
+            word = match.group(0)
+            parts.append(strings.get(word.lower(), word))
+            position = match.end()
+        while position < len(text) and text[position].isspace():
+            position += 1
+        if position < len(text) and text[position] == u'#':
+            position += 1
+        else:
+            break
+    return u''.join(parts), position
+
+def _closing_brace(text, position):
+    depth = 0
+    for index in range(position, len(text)):
+        if text[index] == u'{':
+            depth += 1
+        elif text[index] == u'}':
+            depth -= 1
+            if depth == 0:
+                return index
+    return len(text)
+
+def _split_authors(text):
+    # Splits on "and" outside braces.
+    names = []
+    depth = 0
+    start = 0
+    for match in re.finditer(r'[{}]|\s+and\s+', text):
+        token = match.group(0)
+        if token == u'{':
+            depth += 1
+        elif token == u'}':
+            depth -= 1
+        elif depth == 0:
+            names.append(text[start:match.start()])
+            start = match.end()
+    names.append(text[start:])
+    return [name.strip() for name in names if name.strip()]
+
+def _bibtex_name(name):
+    # "Last, First", "Last, Jr, First" or "First von Last". A {braced}
+    # name, like an organization, is all last name.
+    if u',' in name:
+        parts = [part.strip() for part in name.split(u',')]
+        return _name(parts[0], parts[-1] if len(parts) > 1 else u'')
+    words = re.findall(r'\{[^{}]*\}|\S+', name)
+    last = [words.pop()] if words else []
+    while words and words[-1][:1].islower():
+        last.insert(0, words.pop())
+    return _name(u' '.join(last), u' '.join(words))
+
+def _name(lastname, firstname):
+    return {u'lastname': _clean_latex(lastname), u'firstname': _clean_latex(firstname)}
+
+_ACCENTS = {u'`': u'\u0300', u"'": u'\u0301', u'^': u'\u0302', u'~': u'\u0303', u'=': u'\u0304',
+            u'.': u'\u0307', u'"': u'\u0308', u'c': u'\u0327', u'v': u'\u030c', u'u': u'\u0306'}
+
+def _clean_latex(text):
+    # Enough LaTeX for titles and names: accents, escaped characters and
+    # formatting commands. Braces are dropped.
+    text = re.sub(r'\\([`\'^~=."])\s*\{?([A-Za-z])\}?', lambda match: match.group(2) + _ACCENTS[match.group(1)], text)
+    text = re.sub(r'\\([cvu])\s*\{([A-Za-z])\}', lambda match: match.group(2) + _ACCENTS[match.group(1)], text)
+    text = re.sub(r'\\([&%$#_{}])', r'\1', text)
+    text = re.sub(r'\\[A-Za-z]+\s*', u'', text)
+    text = text.replace(u'{', u'').replace(u'}', u'').replace(u'~', u' ')
+    return u' '.join(unicodedata.normalize(u'NFC', text).split())
+
+_MONTHS = {month: str(index + 1) for index, month in enumerate(
+    [u'jan', u'feb', u'mar', u'apr', u'may', u'jun', u'jul', u'aug', u'sep', u'oct', u'nov', u'dec'])}
+
+def parse_ris(stream):
+    entry = None
+    tag = None
+    for line in stream:
+        line = line.rstrip(u'\r\n')
+        match = re.match(r'([A-Z][A-Z0-9])  -\s?(.*)', line)
+        if match is None:
+            # A value that goes on over several lines.
+            if entry is not None and tag is not None and line.strip():
+                _ris_append(entry, tag, line.strip(), continued=True)
+            continue
+        tag, value = match.group(1), match.group(2).strip()
+        if tag == u'TY':
+            entry = {u'title': u'', u'authors': [], u'year': None, u'doi': None, u'abstract': u'', u'notes': []}
+        elif tag == u'ER':
+            if entry is not None:
+                yield entry
+            entry = None
+            tag = None
+        elif entry is not None:
+            _ris_append(entry, tag, value)
+
+def _ris_append(entry, tag, value, continued=False):
+    if tag in (u'TI', u'T1') and (continued or not entry[u'title']):
+        entry[u'title'] = (entry[u'title'] + u' ' + value).strip() if continued else value
+    elif tag in (u'AU', u'A1') and not continued:
+        lastname, comma, firstname = value.partition(u',')
+        entry[u'authors'].append({u'lastname': lastname.strip(), u'firstname': firstname.strip()})
+    elif tag in (u'PY', u'Y1', u'DA') and entry[u'year'] is None:
+        entry[u'year'] = _to_year(value)
+    elif tag == u'DO' and not continued:
+        entry[u'doi'] = value or None
+    elif tag in (u'AB', u'N2') and (continued or not entry[u'abstract']):
+        entry[u'abstract'] = (entry[u'abstract'] + u' ' + value).strip()
+    elif tag == u'N1':
+        if continued and entry[u'notes']:
+            entry[u'notes'][-1] += u' ' + value
+        else:
+            entry[u'notes'].append(value)
+
+def parse_csl_json(stream):
+    for item in _json_array_items(stream):
+        authors = []
+        for author in item.get(u'author', []):
+            if u'literal' in author:
+                authors.append({u'lastname': author[u'literal'], u'firstname': u''})
+            else:
+                authors.append({u'lastname': author.get(u'family', u''), u'firstname': author.get(u'given', u'')})
+        year = None
+        issued = item.get(u'issued') or {}
+        date_parts = issued.get(u'date-parts') or [[]]
+        if date_parts and date_parts[0]:
+            year = _to_year(date_parts[0][0])
+        elif issued.get(u'raw') or issued.get(u'literal'):
+            year = _to_year(issued.get(u'raw') or issued.get(u'literal'))
+        notes = [item[u'note']] if item.get(u'note') else []
+        yield {
+            u'title': u' '.join(item.get(u'title', u'').split()),
+            u'authors': authors,
+            u'year': year,
+            u'doi': item.get(u'DOI') or None,
+            u'abstract': item.get(u'abstract', u''),
+            u'notes': notes,
+        }
+
+def _json_array_items(stream):
+    # Decodes the items of a top-level JSON array one at a time.
+    decoder = json.JSONDecoder()
+    buffer = u''
+    position = 0
+    started = False
+    at_end = False
+    while True:
+        while position < len(buffer) and (buffer[position].isspace() or (started and buffer[position] == u',')):
+            position += 1
+        if position < len(buffer):
+            if not started:
+                if buffer[position] != u'[':
+                    raise ValueError(u'CSL-JSON files hold an array of items.')
+                started = True
+                position += 1
+                continue
+            if buffer[position] == u']':
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                if at_end:
+                    raise
+            else:
+                yield item
+                position = end
+                continue
+        elif at_end:
+            return
+        chunk = stream.read(READ_SIZE)
+        at_end = chunk == u''
+        buffer = buffer[position:] + chunk
+        position = 0
+
+def _to_year(value):
+    match = re.search(r'\d{4}', str(value or u''))
+    if match is None:
+        return None
+    return int(match.group(0))
+
+FORMATS = {
+    u'bibtex': parse_bibtex,
+    u'ris': parse_ris,
+    u'csl-json': parse_csl_json,
+}
+
+_EXTENSIONS = {u'.bib': u'bibtex', u'.bibtex': u'bibtex', u'.ris': u'ris', u'.json': u'csl-json'}
+
+def detect_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in _EXTENSIONS:
+        raise ValueError(u'Unknown reference file type {0}, give the format: {1}.'.format(
+            extension, u', '.join(sorted(FORMATS))))
+    return _EXTENSIONS[extension]
+
+def read_entries(path, format=None):
+    if format is None:
+        format = detect_format(path)
+    with open(path, encoding=u'utf-8-sig') as stream:
+        for entry in FORMATS[format](stream):
+            yield entry
+
+def entry_to_doc(entry):
+    # (doc, notes) for an entry, or None if it has no title.
+    if not entry.get(u'title'):
+        return None
+    doc = Doc(doctype=u'papers', title=entry[u'title'], authors=entry.get(u'authors', []), \
+              year=entry.get(u'year'), doi=entry.get(u'doi'))
+    notes = []
+    if entry.get(u'abstract'):
+        notes.append(Note(None, u'summaries', entry[u'abstract']))
+    for text in entry.get(u'notes', []):
+        notes.append(Note(None, u'notes', text))
+    return doc, notes
+
+def import_file(model, path, format=None, restart=False, progress=print):
+    # Imports every entry of the reference file at path. Unless restart is
+    # set, an import that was interrupted carries on after the last entry
+    # that was committed. Returns a dict of counts.
+    checkpoint_path = path + CHECKPOINT_SUFFIX
+    checkpoint = None
+    if not restart:
+        checkpoint = _load_checkpoint(checkpoint_path, path)
+    skip = 0
+    added_before = 0
+    if checkpoint is not None:
+        skip = checkpoint[u'entries']
+        added_before = checkpoint[u'added']
+        progress(u'Resuming after entry {0}.'.format(skip))
+
+    invalid_count = [0]
+    def entries():
+        for index, entry in enumerate(read_entries(path, format)):
+            if index < skip:
+                continue
+            item = entry_to_doc(entry)
+            if item is None:
+                invalid_count[0] += 1
+            else:
+                yield item
+
+    start_time = time.perf_counter()
+    last_report = [start_time]
+    added_count = [0]
+    def committed(entry_count, added):
+        added_count[0] += len(added)
+        done = skip + entry_count + invalid_count[0]
+        _save_checkpoint(checkpoint_path, path, done, added_before + added_count[0])
+        now = time.perf_counter()
+        if now - last_report[0] >= REPORT_INTERVAL:
+            last_report[0] = now
+            progress(u'{0} entries done, {1} docs added, {2:.0f} entries/s'.format(
+                done, added_before + added_count[0], (entry_count + invalid_count[0]) / (now - start_time)))
+
+    entry_count, added, duplicate_count, similar_count = model.import_docs(entries(), committed)
+    seconds = time.perf_counter() - start_time
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    entry_count += invalid_count[0]
+    result = {
+        u'entries': entry_count,
+        u'added': added,
+        u'duplicates': duplicate_count,
+        u'similar': similar_count,
+        u'invalid': invalid_count[0],
+        u'seconds': seconds,
+        u'entries_per_second': entry_count / seconds if seconds > 0 else 0.0,
+    }
+    progress(u'Imported {0} docs from {1} entries ({2} duplicates, {3} without a title) '
+             u'in {4:.1f}s, {5:.0f} entries/s.'.format(added, entry_count, duplicate_count, \
+             invalid_count[0], seconds, result[u'entries_per_second']))
+    if similar_count:
+        progress(u'Docs imported with a title like one already in the library: {0}. '
+                 u'Run dedupe to review them.'.format(similar_count))
+    return result
+
+def _load_checkpoint(checkpoint_path, path):
+    # The checkpoint only counts if the file hasn't changed since.
+    try:
+        with open(checkpoint_path) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+    except (IOError, ValueError):
+        return None
+    if checkpoint.get(u'size') != os.path.getsize(path) or checkpoint.get(u'mtime') != os.path.getmtime(path):
+        return None
+    return checkpoint
+
+def _save_checkpoint(checkpoint_path, path, entries, added):
+    temporary_path = checkpoint_path + u'.tmp'
+    with open(temporary_path, u'w') as checkpoint_file:
+        json.dump({
+            u'path': os.path.abspath(path),
+            u'size': os.path.getsize(path),
+            u'mtime': os.path.getmtime(path),
+            u'entries': entries,
+            u'added': added,
+        }, checkpoint_file)
+    os.replace(temporary_path, checkpoint_path)
@@ -1,12 +1,23 @@
 from datetime import datetime
 from time import sleep
+import shlex
+import sys
 from model import Model
+from cache import DEFAULT_CACHE_PATH
+from search import DEFAULT_SEARCH_PATH
+import importer
+import exporter
+from graph import BOTH, DIRECTIONS
 from document_types import *
 import cmd2
+from cmd2.rl_utils import vt100_support
 import textwrap
 
+# Docs per page in the docs listing and when picking a doc.
+DOCS_PER_PAGE = 50
+
 class LitreviewShell(cmd2.Cmd):
-    def __init__(self):
+    def __init__(self, live=False, backend=None, cache_path=None, search_path=None):
         shortcuts = dict(self.DEFAULT_SHORTCUTS)
         shortcuts.update({'&': 'speak'})
         # Set use_ipython to True to enable the "ipy" command which embeds and interactive IPython shell
@@ -15,8 +26,37 @@ class LitreviewShell(cmd2.Cmd):
         self.INDENT = 5
         self.intro = u'\nWelcome to the Literature Review Shell. Type help or ? to list commands.\n'
         self.prompt = u'(lr) '
-        self.model = Model()
+        # The prompt comes up right away while the library loads in the
+        # background. Commands that need it wait for it to finish.
+        self.model = Model(live=live, backend=backend, cache_path=cache_path, \
+                           background=True, progress=self.report_progress, search_path=search_path)
         self.child_notes = []
+        self.search_hits = []
+        self.stats_footer = False
+
+    def report_progress(self, message):
+        # Called from the model's loading thread. cmd2 holds terminal_lock
+        # while a command runs; when it's free the prompt is up and the
+        # message has to go above it. async_alert silently does nothing
+        # without VT100 support or when input isn't read with the prompt
+        # (piped input), so then the message is printed.
+        if vt100_support and self.use_rawinput and self.terminal_lock.acquire(blocking=False):
+            try:
+                self.async_alert(u'    ' + message)
+                return
+            finally:
+                self.terminal_lock.release()
+        print(u'    ' + message)
+
+    def precmd(self, statement):
+        self.model.stats.begin(u'command', statement.command or u'')
+        return statement
+
+    def postcmd(self, stop, statement):
+        counters = self.model.stats.end()
+        if self.stats_footer and statement.command:
+            print(u'[{0}]'.format(counters))
+        return stop
 
     def update_prompt(self):
         current_doc = self.model.get_current_doc()
@@ -110,6 +150,20 @@ class LitreviewShell(cmd2.Cmd):
         except EOFError:
             return
 
+        similar_docs = self.model.find_similar_docs(doc_dict[u'title'])
+        if similar_docs:
+            print("")
+            print("Similar docs already in the library:")
+            for similarity, doc in similar_docs:
+                self.print_indented("{0} ({1:.0%} similar)".format(doc.title, similarity))
+            try:
+                if input("Add it anyway? y/N: ").lower() != u'y':
+                    print("Canceling add doc.")
+                    print("")
+                    return
+            except EOFError:
+                return
+
         print("")
         doc_dict[u'authors'] = []
         try:
@@ -163,24 +217,16 @@ class LitreviewShell(cmd2.Cmd):
             except EOFError:
                 return
         else:
-            all_docs = self.get_docs()
-            while not (line != "" and line.isnumeric() and int(line) < len(all_docs) and int(line) >= 0):
-                print("")
-                doc_index = 0
-                for doc in all_docs:
-                    self.print_indented("[{0}]: {1}".format(doc_index, doc.title))
-                    doc_index += 1
-                    print("")
-                try:
-                    line = input('Please select a doc: ')
-                except EOFError:
+            doc = self.get_doc_at(line)
+            if doc is None:
+                doc = self.choose_doc('Please select a doc')
+                if doc is None:
                     return
 
-            self.print_indented("Selected doc: {0}".format(all_docs[int(line)].title))
+            self.print_indented("Selected doc: {0}".format(doc.title))
             try:
                 if input("Delete this doc? Y/n: ").lower() == u'y':
-                    # Need
-                    deleted = self.model.delete_doc(all_docs[int(line)])
+                    deleted = self.model.delete_doc(doc)
                     if deleted == True:
                         print("")
                         print("Doc deleted.")
@@ -195,31 +241,150 @@ class LitreviewShell(cmd2.Cmd):
                 return
 
     def do_docs(self, line):
-        doc_index = 0
-        all_docs = self.get_docs()
-        for doc in all_docs:
-            self.do_doc_info(str(doc_index))
-            doc_index += 1
-        print("")
+        # docs [--page N] [--per-page M] [--all] lists the docs' titles,
+        # authors and years, a page at a time (the first by default),
+        # through the pager. While the library is still loading the page is
+        # read straight from the database.
+        args = line.split()
+        show_all = "--all" in args
+        args = [arg for arg in args if arg != "--all"]
+        paging = self.parse_page(args)
+        if paging is None:
+            print("Usage: docs [--page N] [--per-page M] [--all]")
+            return
+        page, per_page = paging
+        if show_all:
+            page, per_page = 1, max(self.model.get_doc_count(), 1)
+        rows, doc_count = self.model.list_docs(page, per_page)
+        self.ppaged(self.format_doc_page(rows, page, per_page, doc_count), chop=True)
+
+    def parse_page(self, args):
+        # (page, per page) from --page N and --per-page M, or None if args
+        # has anything else.
+        page = 1
+        per_page = DOCS_PER_PAGE
+        for option, value in zip(args[::2], args[1::2] + [None]):
+            if value is None or not value.isnumeric() or int(value) < 1:
+                return None
+            if option == "--page":
+                page = int(value)
+            elif option == "--per-page":
+                per_page = int(value)
+            else:
+                return None
+        return page, per_page
+
+    def format_doc_page(self, rows, page, per_page, doc_count):
+        # The rows list_docs returns, one doc per line, and where they are
+        # in the listing.
+        lines = [""]
+        for index, title, year, authors in rows:
+            number = "[{0}]".format(index) if index is not None else "-"
+            year = " ({0})".format(year) if year is not None else ""
+            lines.append("{0}{1}: {2}, {3}{4}".format(" " * self.INDENT, number, title, self.format_authors(authors), year))
+        lines.append("")
+        if doc_count is None:
+            status = "Page {0}. The library is still loading, the docs get their numbers once it's done.".format(page)
+        elif not rows:
+            status = "Page {0} is empty, there are {1} docs.".format(page, doc_count)
+        else:
+            page_count = (doc_count + per_page - 1) // per_page
+            status = "Page {0} of {1}: docs {2} to {3} of {4}.".format(page, page_count, rows[0][0], rows[-1][0], doc_count)
+        lines.append(" " * self.INDENT + status)
+        return "\n".join(lines) + "\n"
+
+    def format_authors(self, authors):
+        # Smith, Smith and Lee, or Smith et al.
+        names = [author.get(u'lastname') or author.get(u'firstname') or "?" for author in authors or []]
+        if not names:
+            return "no authors"
+        if len(names) > 2:
+            return "{0} et al.".format(names[0])
+        return " and ".join(names)
+
+    def choose_doc(self, prompt):
+        # Shows the docs a page at a time and asks for one by number, n and
+        # p going to the next and previous page. The doc, or None.
+        # The numbers are only known once the library is loaded.
+        self.model.wait_until_loaded()
+        page = 1
+        while True:
+            rows, doc_count = self.model.list_docs(page, DOCS_PER_PAGE)
+            print(self.format_doc_page(rows, page, DOCS_PER_PAGE, doc_count))
+            try:
+                choice = input("{0} (n/p for the next/previous page): ".format(prompt)).strip()
+            except EOFError:
+                return None
+            if choice == "n" and page * DOCS_PER_PAGE < doc_count:
+                page += 1
+            elif choice == "p" and page > 1:
+                page -= 1
+            elif choice.isnumeric() and int(choice) < doc_count:
+                return self.model.get_doc_range(int(choice), int(choice) + 1)[0]
+
+    def get_doc_at(self, line):
+        # The doc numbered line, or None.
+        if not line.isnumeric():
+            return None
+        docs = self.model.get_doc_range(int(line), int(line) + 1)
+        return docs[0] if docs else None
 
     def do_select_doc(self, line):
-        all_docs = self.get_docs()
-        while not (line != "" and line.isnumeric() and int(line) < len(all_docs) and int(line) >= 0):
-            print("")
-            doc_index = 0
-            for doc in all_docs:
-                self.print_indented("[{0}]: {1}".format(doc_index, doc.title))
-                doc_index += 1
+        # select_doc N selects by index, select_doc TITLE by (fuzzy) title.
+        # Without either, the docs are shown a page at a time to pick from.
+        doc = None
+        if line != "" and not line.isnumeric():
+            matches = self.model.find_docs_by_title(line)
+            if not matches:
+                print("No doc with a title like that.")
+                return
+            if len(matches) == 1:
+                doc = matches[0][1]
+            else:
                 print("")
-            try:
-                line = input('Please select a doc: ')
-            except EOFError:
+                for similarity, match in matches:
+                    self.print_indented("[{0}]: {1}".format(self.model.get_doc_index(match), match.title))
+                print("")
+                try:
+                    doc = self.get_doc_at(input('Please select a doc: '))
+                except EOFError:
+                    return
+        else:
+            doc = self.get_doc_at(line)
+        if doc is None:
+            doc = self.choose_doc('Please select a doc')
+            if doc is None:
                 return
 
-        self.set_current_obj(all_docs[int(line)])
+        self.set_current_obj(doc)
         self.update_prompt()
         self.do_note_tree("")
 
+    def do_dedupe(self, line):
+        # dedupe [SIMILARITY] lists pairs of docs whose titles look alike,
+        # by default at least 70% similar.
+        try:
+            threshold = float(line) if line != "" else None
+        except ValueError:
+            print("Usage: dedupe [SIMILARITY between 0 and 1]")
+            return
+        if threshold is None:
+            pairs = self.model.find_duplicate_docs()
+        else:
+            pairs = self.model.find_duplicate_docs(threshold)
+
+        print("")
+        if not pairs:
+            print("No likely duplicates.")
+            print("")
+            return
+        doc_indices = {doc.id: doc_index for doc_index, doc in enumerate(self.get_docs())}
+        for similarity, doc, other_doc in pairs:
+            self.print_indented("{0:.0%} similar:".format(similarity))
+            self.print_indented("[{0}]: {1}".format(doc_indices[doc.id], doc.title), 2)
+            self.print_indented("[{0}]: {1}".format(doc_indices[other_doc.id], other_doc.title), 2)
+            print("")
+
     def do_doc(self, line):
         current_doc = self.model.get_current_doc()
         if current_doc is None:
@@ -245,19 +410,21 @@ class LitreviewShell(cmd2.Cmd):
             self.print_indented("{0}, {1}".format(author[u'lastname'], author[u'firstname']), 2)
         self.print_indented("DOI: {0}".format(doc.doi))
         self.print_indented("Year: {0}".format(doc.year))
-        self.print_indented("Number of notes: {0}".format(len(doc.attached_notes))) # Do more with this
+        self.print_indented("Number of notes: {0}".format(doc.note_count or 0))
+        for notetype, count in sorted((doc.notetype_counts or {}).items()):
+            if count > 0:
+                self.print_indented("{0}: {1}".format(notetype, count), 2)
 
     def do_doc_info(self, line):
         doc = None
-        all_docs = self.get_docs()
         if line != "" and line.isnumeric():
-            if int(line) >= len(all_docs) or int(line) < 0:
+            doc = self.get_doc_at(line)
+            if doc is None:
                 print("")
                 print("That doc does not exist.")
                 print("")
                 return
             else:
-                doc = all_docs[int(line)]
                 print("")
                 self.print_indented("[{}]".format(line))
         else:
@@ -293,20 +460,7 @@ class LitreviewShell(cmd2.Cmd):
 
         in_obj = None
         if link_to == "doc":
-            print("")
-            choice = ""
-            doc_index = 0
-            all_docs = self.get_docs()
-            while not (choice != "" and choice.isnumeric() and int(choice) < len(all_docs) and int(choice) >= 0):
-                for doc in all_docs:
-                    self.print_indented("[{0}]: {1}".format(doc_index, doc.title))
-                    doc_index += 1
-                    print("")
-                try:
-                    choice = input('Please select the doc to link to: ')
-                except EOFError:
-                    return
-            in_obj = all_docs[int(choice)]
+            in_obj = self.choose_doc('Please select the doc to link to')
         elif link_to == "note":
             pass
 
@@ -330,17 +484,15 @@ class LitreviewShell(cmd2.Cmd):
             return None
 
         self.print_indented("Outlinks:")
+        # Outlinks to docs that are no longer in the library aren't shown.
         index_map = {}
         current_index = 0
         for outlinks_doc_id in outlinks:
-            master_index = 0
-            all_docs = self.get_docs()
-            for doc in all_docs:
-                if outlinks_doc_id == doc.id:
-                    self.print_indented("[{0}]: {1}".format(current_index, doc.title), 2)
-                    index_map[current_index] = master_index
-                    print("")
-                master_index += 1
+            doc = self.model.get_doc(outlinks_doc_id)
+            if doc is not None:
+                self.print_indented("[{0}]: {1}".format(current_index, doc.title), 2)
+                index_map[current_index] = doc
+                print("")
             current_index += 1
 
         try:
@@ -348,11 +500,10 @@ class LitreviewShell(cmd2.Cmd):
         except EOFError:
             return
 
-        if not (line != "" and line.isnumeric() and int(line) < len(index_map) and int(line) >= 0):
+        if not (line.isnumeric() and int(line) in index_map):
             return
 
-        all_docs = self.get_docs()
-        deleted = self.model.delete_link(self.get_current_doc(), all_docs[index_map[int(line)]])
+        deleted = self.model.delete_link(self.get_current_doc(), index_map[int(line)])
         if deleted == True:
             print("")
             print("Link deleted.")
@@ -430,6 +581,136 @@ class LitreviewShell(cmd2.Cmd):
         self.set_current_obj(jumping_to_obj)
         self.update_prompt()
 
+    def describe_linked(self, obj, doc_indices):
+        # One line for a doc or note in the graph commands. Docs show the
+        # index select_doc takes.
+        if isinstance(obj, Doc):
+            return "[{0}]: {1}".format(doc_indices.get(obj.id), obj.title[:60])
+        doc = self.model.get_note_doc(obj)
+        if doc is None:
+            return "{0} note \"{1}\"".format(obj.notetype, obj.body[:40])
+        return "{0} note \"{1}\" in [{2}]: {3}".format(obj.notetype, obj.body[:40], \
+                                                     doc_indices.get(doc.id), doc.title[:40])
+
+    def parse_direction(self, args):
+        # Takes an out|in|both argument off the end of args, if there is one.
+        if args and args[-1] in DIRECTIONS:
+            return args[:-1], args[-1]
+        return args, BOTH
+
+    def do_path(self, line):
+        # path DOC [out|in|both]
+        # The shortest chain of links from the current doc or note to DOC,
+        # given by index or title. out only follows outlinks, in only
+        # inlinks, both (the default) either.
+        args, direction = self.parse_direction(shlex.split(line))
+        current_obj = self.get_current_obj()
+        if current_obj is None or not args:
+            print("Usage: path DOC [out|in|both], from the current doc or note.")
+            return
+        all_docs = self.get_docs()
+        target = " ".join(args)
+        if target.isnumeric() and int(target) < len(all_docs):
+            target_doc = all_docs[int(target)]
+        else:
+            matches = self.model.find_docs_by_title(target, limit=1)
+            if not matches:
+                print("No doc with a title like that.")
+                return
+            target_doc = matches[0][1]
+
+        path = self.model.find_path(current_obj, target_doc, direction)
+        print("")
+        if path is None:
+            print("No chain of links leads there.")
+            print("")
+            return
+        doc_indices = {doc.id: doc_index for doc_index, doc in enumerate(all_docs)}
+        self.print_indented("{0} links:".format(len(path) - 1))
+        for obj in path:
+            self.print_indented(self.describe_linked(obj, doc_indices), 2)
+        print("")
+
+    def do_neighbors(self, line):
+        # neighbors [HOPS] [out|in|both]
+        # Everything within HOPS links (default 1) of the current doc or note.
+        args, direction = self.parse_direction(shlex.split(line))
+        current_obj = self.get_current_obj()
+        if current_obj is None or len(args) > 1 or (args and not args[0].isnumeric()):
+            print("Usage: neighbors [HOPS] [out|in|both], of the current doc or note.")
+            return
+        hops = int(args[0]) if args else 1
+
+        neighborhood = self.model.get_neighborhood(current_obj, hops, direction)
+        print("")
+        if not neighborhood:
+            print("Nothing linked.")
+            print("")
+            return
+        doc_indices = {doc.id: doc_index for doc_index, doc in enumerate(self.get_docs())}
+        for distance, obj in neighborhood:
+            self.print_indented("{0}: {1}".format(distance, self.describe_linked(obj, doc_indices)))
+        print("")
+
+    def do_rank(self, line):
+        # rank [N] lists the N (default 10) most central docs and notes, by
+        # PageRank over the links.
+        if line != "" and not line.isnumeric():
+            print("Usage: rank [N]")
+            return
+        ranked = self.model.rank_linked(int(line) if line else 10)
+        print("")
+        doc_indices = {doc.id: doc_index for doc_index, doc in enumerate(self.get_docs())}
+        for score, obj in ranked:
+            self.print_indented("{0:.4f} {1}".format(score, self.describe_linked(obj, doc_indices)))
+        print("")
+
+    def do_components(self, line):
+        # components lists the groups of docs that are linked together,
+        # biggest first.
+        components = self.model.get_components()
+        print("")
+        if not components:
+            print("Nothing is linked.")
+            print("")
+            return
+        doc_indices = {doc.id: doc_index for doc_index, doc in enumerate(self.get_docs())}
+        for doc_objs, note_count in components:
+            self.print_indented("{0} docs, {1} notes:".format(len(doc_objs), note_count))
+            for doc in doc_objs[:10]:
+                self.print_indented(self.describe_linked(doc, doc_indices), 2)
+            if len(doc_objs) > 10:
+                self.print_indented("...", 2)
+            print("")
+
+    def do_related(self, line):
+        # related [N] [docs|notes] lists the N (default 10) docs and notes
+        # whose text is most like the current doc or note.
+        args = line.split()
+        kind = None
+        if args and args[-1] in ("docs", "notes"):
+            kind = args.pop()[:-1]
+        current_obj = self.get_current_obj()
+        if current_obj is None or len(args) > 1 or (args and not args[0].isnumeric()):
+            print("Usage: related [N] [docs|notes], for the current doc or note.")
+            return
+        try:
+            related = self.model.find_related([current_obj], int(args[0]) if args else 10, kind)[0]
+        except RuntimeError as error:
+            print(error)
+            return
+
+        print("")
+        if not related:
+            print("Nothing similar.")
+            print("")
+            return
+        doc_indices = {doc.id: doc_index for doc_index, doc in enumerate(self.get_docs())}
+        for similarity, obj in related:
+            if obj is not None:
+                self.print_indented("{0:.0%} {1}".format(similarity, self.describe_linked(obj, doc_indices)))
+        print("")
+
     def do_back(self, line):
         if self.model.history.back() is None:
             print("")
@@ -445,8 +726,7 @@ class LitreviewShell(cmd2.Cmd):
             print("Please select a doc first.")
             print("")
             return
-        all_notes = self.get_notes()
-        return list({note.notetype for note in all_notes if note.ref_id == target_obj.id})
+        return self.model.get_child_notetypes(target_obj)
 
     def get_notes_by_obj(self, target_obj):
         if self.get_current_doc() is None:
@@ -454,10 +734,7 @@ class LitreviewShell(cmd2.Cmd):
             print("Please select a doc first.")
             print("")
             return
-        all_notes = self.get_notes()
-        obj_notes = [note for note in all_notes if note.ref_id == target_obj.id]
-        obj_notes.sort()
-        return obj_notes
+        return self.model.get_child_notes(target_obj)
 
     def do_add_note(self, line):
         print("")
@@ -639,14 +916,7 @@ class LitreviewShell(cmd2.Cmd):
             else:
                 target = self.get_current_obj()
 
-        all_notes = self.get_notes()
-        child_notes = []
-        for note in all_notes:
-            if note.ref_id == target.id:
-                child_notes.append(note)
-
-        child_notes.sort()
-        return child_notes
+        return self.model.get_child_notes(target)
 
     def print_note_info(self, note, indentation_multiplier=1, truncated=True, verbose=True):
         if note is None:
@@ -751,14 +1021,180 @@ class LitreviewShell(cmd2.Cmd):
         self.note_tree_helper(current_note, 1, "and Children", truncated=truncated)
         return
 
+    def do_stats(self, line):
+        # stats [calls | reset | footer [on|off] | export [path]]
+        stats = self.model.stats
+        commands = line.split()
+        if not commands or commands[0] == "calls":
+            by_name = stats.by_command
+            if commands:
+                by_name = stats.by_call
+            print("")
+            self.print_indented("{0:<20} {1:>6} {2:>8} {3:>8} {4:>8} {5:>10}".format(
+                "Name", "Calls", "Reads", "Writes", "Trips", "Time (ms)"))
+            for name, counters in sorted(by_name.items(), key=lambda item: -item[1].seconds):
+                self.print_indented("{0:<20} {1:>6} {2:>8} {3:>8} {4:>8} {5:>10.1f}".format(
+                    name, counters.calls, counters.reads, counters.writes, counters.round_trips, counters.seconds * 1000))
+            print("")
+            self.print_indented("Total: {0}".format(stats.totals))
+            print("")
+        elif commands[0] == "reset":
+            stats.reset()
+        elif commands[0] == "footer":
+            if len(commands) > 1:
+                self.stats_footer = commands[1] == "on"
+            else:
+                self.stats_footer = not self.stats_footer
+            print("Stats footer {0}.".format("on" if self.stats_footer else "off"))
+        elif commands[0] == "export":
+            path = "litreview_stats.json"
+            if len(commands) > 1:
+                path = commands[1]
+            stats.export(path)
+            print("Stats written to {0}.".format(path))
+
+    def do_search(self, line):
+        # search [docs|notes] [type:NOTETYPE] [page:N-M] [year:N-M] terms
+        # Terms are words, word* prefixes, "quoted phrases" and OR.
+        if line.strip() == "":
+            print("Usage: search [docs|notes] [type:NOTETYPE] [page:N-M] [year:N-M] words, prefix* or \"a phrase\"")
+            return
+        try:
+            self.search_hits = self.model.search(line)
+        except ValueError as error:
+            print(error)
+            return
+
+        print("")
+        if not self.search_hits:
+            print("No matches.")
+            print("")
+            return
+        for hit_index, hit in enumerate(self.search_hits):
+            doc = self.model.get_doc(hit.doc_id)
+            title = doc.title if doc is not None else hit.doc_id
+            if hit.kind == u'doc':
+                self.print_indented("[{0}]: {1}".format(hit_index, title))
+            else:
+                self.print_indented("[{0}]: {1} in {2}".format(hit_index, hit.notetype, title))
+            self.print_indented(hit.snippet, 2)
+        print("")
+        print("Use select_result N to go to a result.")
+
+    def do_select_result(self, line):
+        if not (line.isnumeric() and int(line) < len(self.search_hits)):
+            print("No such search result.")
+            return
+        hit = self.search_hits[int(line)]
+        doc = self.model.get_doc(hit.doc_id)
+        if doc is None:
+            print("That doc is no longer in the library.")
+            return
+        self.set_current_obj(doc)
+        if hit.kind == u'note':
+            note = self.model.get_note(hit.id)
+            if note is None:
+                print("That note is no longer in the library.")
+            else:
+                self.set_current_obj(note)
+        self.update_prompt()
+        self.do_whereami("")
+
+    def do_import(self, line):
+        # import PATH [bibtex|ris|csl-json] [restart]
+        # The format is guessed from the extension if it isn't given. An
+        # interrupted import carries on where it stopped unless restart is
+        # given.
+        args = shlex.split(line)
+        usage = "Usage: import PATH [{0}] [restart]".format("|".join(sorted(importer.FORMATS)))
+        if not args:
+            print(usage)
+            return
+        path = args[0]
+        format = None
+        restart = False
+        for arg in args[1:]:
+            if arg == "restart":
+                restart = True
+            elif arg in importer.FORMATS:
+                format = arg
+            else:
+                print(usage)
+                return
+        try:
+            importer.import_file(self.model, path, format, restart=restart, progress=self.print_indented)
+        except (IOError, ValueError) as error:
+            print(error)
+
+    def do_export(self, line):
+        # export PATH [jsonl|html|bibtex] [processes N]
+        # The format is guessed from the extension if it isn't given. With
+        # processes N the formatting is spread over N processes.
+        args = shlex.split(line)
+        usage = "Usage: export PATH [{0}] [processes N]".format("|".join(sorted(exporter.FORMATS)))
+        if not args:
+            print(usage)
+            return
+        path = args[0]
+        format = None
+        processes = 1
+        rest = iter(args[1:])
+        for arg in rest:
+            if arg in exporter.FORMATS:
+                format = arg
+            elif arg == "processes":
+                try:
+                    processes = int(next(rest, ""))
+                except ValueError:
+                    print(usage)
+                    return
+            else:
+                print(usage)
+                return
+        try:
+            exporter.export_file(self.model, path, format, processes=processes, progress=self.print_indented)
+        except (IOError, ValueError) as error:
+            print(error)
+
+    def do_sync(self, line):
+        self.model.wait_until_loaded()
+        if self.model.cache is None:
+            self.model.reconcile()
+        else:
+            self.model.sync()
+        self.update_prompt()
+
     def do_EOF(self, line):
         return True
 
     def postloop(self):
-        print
+        self.model.close()
 
 if __name__ == '__main__':
+    # --live keeps the local library in sync with other sessions through
+    # snapshot listeners. Remove it so cmd2 doesn't run it as a command.
+    live = '--live' in sys.argv
+    if live:
+        sys.argv.remove('--live')
+    # --sqlite PATH works on a local SQLite library instead of Firestore.
+    backend = None
+    cache_path = DEFAULT_CACHE_PATH
+    if '--sqlite' in sys.argv:
+        index = sys.argv.index('--sqlite')
+        from sqlite_backend import SqliteBackend
+        backend = SqliteBackend(sys.argv[index + 1])
+        del sys.argv[index:index + 2]
+        # Already local, no need for a cache in front of it.
+        cache_path = None
+    # --no-cache skips the on-disk cache and loads the library from scratch.
+    if '--no-cache' in sys.argv:
+        sys.argv.remove('--no-cache')
+        cache_path = None
+    # The search index is kept next to the cache, or in memory without one.
+    search_path = None
+    if cache_path is not None:
+        search_path = DEFAULT_SEARCH_PATH
     try:
-        LitreviewShell().cmdloop()
+        LitreviewShell(live=live, backend=backend, cache_path=cache_path, search_path=search_path).cmdloop()
     except KeyboardInterrupt:
         print("^C")
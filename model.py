@@ -1,23 +1,365 @@
+import bisect
+import functools
+import heapq
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from operator import attrgetter
+from cache import LibraryCache
 from database import Database
 from document_types import *
+from fuzzy import DUPLICATE_SIMILARITY, LOOKUP_SIMILARITY
+from graph import BOTH, LinkGraph
 from pubsub import pub
+from related import RelatedIndex
+from search import SearchIndex
+from stats import Stats
+
+# How far before the last watermark sync looks again, to catch writes whose
+# server timestamp was assigned before, but committed after, the last sync.
+SYNC_OVERLAP = timedelta(seconds=60)
+
+# How many notes NoteCache keeps in memory before dropping the least
+# recently used docs.
+NOTE_CACHE_SIZE = 5000
+
+def needs_library(method):
+    # Methods that read or write the library wait until the background load
+    # started by Model(background=True) is done.
+    @functools.wraps(method)
+    def wait_then_call(self, *args, **kwargs):
+        self.wait_until_loaded()
+        return method(self, *args, **kwargs)
+    return wait_then_call
 
 class Model():
-    def __init__(self):
-        self.db = Database()
+    def __init__(self, live=False, backend=None, cache_path=None, background=False, progress=None, search_path=None):
+        # With background=True the constructor returns right away and the
+        # backend connection and library load happen on another thread.
+        # progress(message) is called as that goes along. The search index
+        # is kept at search_path, or in memory if it's None.
+        self.db = None
+        self.stats = Stats()
+        self.cache = None
+        self.search_index = None
+        self.search_path = search_path
+        self.search_ready = False
+        self.connected = threading.Event()
+        self.loaded = threading.Event()
+        self.load_error = None
+        self.progress = progress
 
+        # Doc ids in update_time order, and their update times alongside so
+        # a changed doc can be moved to its place with bisect.
         self.all_doc_ids = []
+        self.all_doc_times = []
         self.doc_id_to_obj = {}
 
         self.all_note_ids = []
         self.note_id_to_obj = {}
+        # Index over the current doc's notes, keyed by the id of the doc or
+        # note they are attached to (ref_id).
+        self.ref_id_to_children = {} # ref id -> sorted list of note objs
+        # Notes of recently visited docs, so going back to a doc doesn't
+        # load its notes again.
+        self.note_cache = NoteCache()
+        # Where the pages of the doc listing start while the library is
+        # still loading: (per page, page) -> last snapshot of the page
+        # before (see list_docs).
+        self.listing_cursors = {}
+        # The link graph and the index of related texts, built the first
+        # time they're needed (see get_graph and get_related_index).
+        self.graph = None
+        self.related_index = None
+
+        # In live mode the indexes are kept up to date by snapshot listeners
+        # running in a background thread, so every change to them goes
+        # through self.lock.
+        self.live = live
+        self.lock = threading.RLock()
+        self.watches = []
+        self.live_notes = {} # doc id -> {note id: note obj}
+        self.docs_ready = threading.Event()
+        self.notes_ready = threading.Event()
 
         self.history = History(self)
         pub.subscribe(self._new_current_doc_listener, 'new_current_doc')
         pub.subscribe(self._new_current_note_listener, 'new_current_note')
 
-        self.reload_docs()
+        if background:
+            threading.Thread(target=self._start, args=(backend, cache_path), daemon=True).start()
+        else:
+            self._start(backend, cache_path)
+            self.wait_until_loaded()
+
+    def _start(self, backend, cache_path):
+        try:
+            start_time = time.perf_counter()
+            self._report_progress("Connecting...")
+            self.db = Database(backend, self.stats)
+
+            # The listeners hold the whole library in live mode, so the cache
+            # is only used without it.
+            if cache_path is not None and not self.live:
+                self.cache = LibraryCache(cache_path, self.db.backend.name)
+            self.search_index = SearchIndex(self.search_path or u':memory:', self.db.backend.name)
+            self.connected.set()
+
+            self._report_progress("Loading library...")
+            if self.live:
+                self.start_watching()
+                # The listeners have put every doc and note in the index.
+                self.search_ready = True
+            elif self.cache is not None:
+                self.load_cache()
+                self._report_progress("Loaded {0} docs from cache, syncing...".format(len(self.all_doc_ids)))
+                self.sync()
+            else:
+                self.reload_docs()
+            self._report_progress("Library loaded: {0} docs in {1:.1f}s.".format(
+                len(self.all_doc_ids), time.perf_counter() - start_time))
+        except Exception as error:
+            self.load_error = error
+            self._report_progress("Error loading library: {0}".format(error))
+        finally:
+            self.connected.set()
+            self.loaded.set()
+
+    def _report_progress(self, message):
+        if self.progress is not None:
+            self.progress(message)
+
+    def wait_until_loaded(self):
+        self.loaded.wait()
+        if self.load_error is not None:
+            raise self.load_error
+
+    def start_watching(self, timeout=60):
+        self.watches.append(self.db.watch_docs(self._docs_changed_listener))
+        self.watches.append(self.db.watch_notes(self._notes_changed_listener))
+        # The first snapshot of each listener holds the whole library.
+        self.docs_ready.wait(timeout)
+        self.notes_ready.wait(timeout)
+        with self.lock:
+            doc_objs = list(self.doc_id_to_obj.values())
+        self.db.migrate_note_counts(doc_objs)
+
+    def close(self):
+        for watch in self.watches:
+            watch.unsubscribe()
+        self.watches = []
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+        if self.search_index is not None:
+            self.search_index.close()
+            self.search_index = None
+
+    def load_cache(self):
+        # Only the docs are read here. Notes are read from the cache one doc
+        # at a time, by get_doc_notes.
+        doc_objs = [Doc.from_dict(source, id, update_time, self.db.doc_reference(id)) \
+                    for id, source, update_time in self.cache.load_docs()]
+        self.db.index_docs(doc_objs)
+        with self.lock:
+            self.reset_docs()
+            self._apply_changes(doc_objs, {}, [])
+
+    def sync(self):
+        # Bring the cache and the indexes up to date with the backend,
+        # fetching only what was written since the last sync.
+        watermark = self.cache.get_watermark()
+        if watermark is None:
+            doc_objs, notes_by_doc, tombstones, watermark = self.db.get_changes()
+            self.cache.apply(doc_objs, notes_by_doc, tombstones, watermark, replace=True)
+            with self.lock:
+                self.reset_docs()
+                self._apply_changes(doc_objs, notes_by_doc, tombstones)
+        else:
+            doc_objs, notes_by_doc, tombstones, watermark = self.db.get_changes(watermark - SYNC_OVERLAP)
+            self.cache.apply(doc_objs, notes_by_doc, tombstones, watermark)
+            self._apply_changes(doc_objs, notes_by_doc, tombstones)
+        # _apply_changes has passed the changes on to the search index.
+        if self.search_ready:
+            self.search_index.set_watermark(watermark)
+
+    def _apply_changes(self, doc_objs, notes_by_doc, tombstones):
+        with self.lock:
+            # In time order, so on a first load every doc goes at the end.
+            for doc_obj in sorted(doc_objs, key=_doc_time):
+                self._put_doc(doc_obj)
+            for doc_id, note_objs in notes_by_doc.items():
+                for note_obj in note_objs:
+                    self._put_note(doc_id, note_obj)
+            for kind, doc_id, id in tombstones:
+                if kind == u'doc':
+                    if id in self.doc_id_to_obj:
+                        self.db.unindex_doc(self.doc_id_to_obj[id])
+                    self._drop_doc(id)
+                else:
+                    self._drop_note(doc_id, id)
+
+    def _docs_changed_listener(self, doc_changes):
+        removed_current_doc = False
+        with self.lock:
+            for change_type, doc_obj in doc_changes:
+                if change_type == u'REMOVED':
+                    self._drop_doc(doc_obj.id)
+                    if doc_obj.id == self.history.get_current_doc_id():
+                        removed_current_doc = True
+            for doc_obj in sorted((doc_obj for change_type, doc_obj in doc_changes if change_type != u'REMOVED'), \
+                                  key=_doc_time):
+                self._put_doc(doc_obj)
+        self.docs_ready.set()
+
+        for change_type, doc_obj in doc_changes:
+            pub.sendMessage('doc_changed', change_type=change_type, doc_id=doc_obj.id)
+        if removed_current_doc:
+            self.history.delete_doc(self.history.get_current_doc_id())
+
+    def _notes_changed_listener(self, note_changes):
+        removed_note_ids = []
+        with self.lock:
+            for change_type, doc_id, note_obj in note_changes:
+                if change_type == u'REMOVED':
+                    self._drop_note(doc_id, note_obj.id)
+                    removed_note_ids.append(note_obj.id)
+                else:
+                    self._put_note(doc_id, note_obj)
+        self.notes_ready.set()
+
+        for change_type, doc_id, note_obj in note_changes:
+            pub.sendMessage('note_changed', change_type=change_type, doc_id=doc_id, note_id=note_obj.id)
+        for note_id in removed_note_ids:
+            self.history.delete_note(note_id)
+
+    # The helpers below are idempotent, since in live mode a local write is
+    # followed by the listener reporting the same change.
+
+    def _put_doc(self, doc_obj):
+        with self.lock:
+            # Keep the same order reload_docs would give. New docs have the
+            # latest update_time, so they usually go at the end.
+            doc_time = _doc_time(doc_obj)
+            index = self._find_doc_index(doc_obj.id)
+            if index is not None:
+                if self.all_doc_times[index] != doc_time:
+                    del self.all_doc_ids[index]
+                    del self.all_doc_times[index]
+                    index = None
+            if index is None:
+                index = bisect.bisect_right(self.all_doc_times, doc_time)
+                self.all_doc_ids.insert(index, doc_obj.id)
+                self.all_doc_times.insert(index, doc_time)
+            self.doc_id_to_obj[doc_obj.id] = doc_obj
+            if self.search_index is not None:
+                self.search_index.put_doc(doc_obj)
+            if self.graph is not None:
+                self.graph.set_links(doc_obj.id, doc_obj.id, doc_obj.outlinks)
+            if self.related_index is not None:
+                self.related_index.add(doc_obj.id, u'doc', doc_obj.id, doc_obj.title)
+
+    def _drop_doc(self, doc_id):
+        with self.lock:
+            if doc_id in self.doc_id_to_obj:
+                index = self._find_doc_index(doc_id)
+                del self.all_doc_ids[index]
+                del self.all_doc_times[index]
+                del self.doc_id_to_obj[doc_id]
+            self.live_notes.pop(doc_id, None)
+            self.note_cache.discard(doc_id)
+            if self.search_index is not None:
+                self.search_index.drop_doc(doc_id)
+            if self.graph is not None:
+                self.graph.remove(doc_id)
+            if self.related_index is not None:
+                self.related_index.remove_doc(doc_id)
+
+    def _find_doc_index(self, doc_id):
+        # Index of a stored doc in all_doc_ids, or None. Found with bisect on
+        # the update time it was stored with, among the docs with that time.
+        doc_obj = self.doc_id_to_obj.get(doc_id)
+        if doc_obj is None:
+            return None
+        doc_time = _doc_time(doc_obj)
+        index = bisect.bisect_left(self.all_doc_times, doc_time)
+        while index < len(self.all_doc_ids) and self.all_doc_times[index] == doc_time:
+            if self.all_doc_ids[index] == doc_id:
+                return index
+            index += 1
+        # Its update_time changed since it was put in the list.
+        return self.all_doc_ids.index(doc_id)
 
+    def _put_note(self, doc_id, note_obj):
+        with self.lock:
+            if self.live:
+                self.live_notes.setdefault(doc_id, {})[note_obj.id] = note_obj
+            self.note_cache.add_note(doc_id, note_obj)
+            if self.search_index is not None:
+                self.search_index.put_note(doc_id, note_obj)
+            if self.graph is not None:
+                self.graph.set_links(note_obj.id, doc_id, note_obj.outlinks, note_obj.inlinks)
+            if self.related_index is not None:
+                self.related_index.add(note_obj.id, u'note', doc_id, note_obj.body)
+            if doc_id == self.history.get_current_doc_id():
+                if note_obj.id not in self.note_id_to_obj:
+                    self.all_note_ids.append(note_obj.id)
+                else:
+                    self._unindex_child(self.note_id_to_obj[note_obj.id])
+                self.note_id_to_obj[note_obj.id] = note_obj
+                self._index_child(note_obj)
+
+    def _drop_note(self, doc_id, note_id):
+        with self.lock:
+            if doc_id in self.live_notes:
+                self.live_notes[doc_id].pop(note_id, None)
+            self.note_cache.remove_note(doc_id, note_id)
+            if self.search_index is not None:
+                self.search_index.drop_note(note_id)
+            if self.graph is not None:
+                self.graph.remove(note_id)
+            if self.related_index is not None:
+                self.related_index.remove(note_id)
+            if note_id in self.note_id_to_obj:
+                self._unindex_child(self.note_id_to_obj[note_id])
+                self.all_note_ids.remove(note_id)
+                del self.note_id_to_obj[note_id]
+
+    def _index_child(self, note_obj):
+        bisect.insort(self.ref_id_to_children.setdefault(note_obj.ref_id, []), note_obj)
+
+    def _unindex_child(self, note_obj):
+        siblings = self.ref_id_to_children.get(note_obj.ref_id, [])
+        index = _find_sorted(siblings, note_obj)
+        if index is not None:
+            del siblings[index]
+        if not siblings:
+            self.ref_id_to_children.pop(note_obj.ref_id, None)
+
+    def _count_note(self, doc_obj, note_obj, step):
+        # Mirror the counter updates Database.add_note (step 1) and
+        # Database.delete_note (step -1) make. In live mode the listeners
+        # bring the new counters instead.
+        if self.live:
+            return
+        with self.lock:
+            doc_obj.note_count = max((doc_obj.note_count or 0) + step, 0)
+            doc_obj.notetype_counts = _counted(doc_obj.notetype_counts, note_obj.notetype, step)
+            parent_obj = doc_obj if note_obj.ref_id == doc_obj.id else self._find_note(doc_obj.id, note_obj.ref_id)
+            if parent_obj is not None:
+                parent_obj.child_counts = _counted(parent_obj.child_counts, note_obj.notetype, step)
+
+    def _find_note(self, doc_id, note_id):
+        # A note that is already in memory, or None.
+        if note_id in self.note_id_to_obj:
+            return self.note_id_to_obj[note_id]
+        for note_obj in self.note_cache.peek(doc_id) or []:
+            if note_obj.id == note_id:
+                return note_obj
+        return None
+
+    @needs_library
     def set_current_obj(self, obj=None):
         if obj is None:
             print("Error. Nothing specified to set as current object.")
@@ -40,14 +382,15 @@ class Model():
                 self.history.push_note(obj.id)
                 return
 
+    @needs_library
     def get_current_obj(self):
         current_obj_id = self.history.head()
         if current_obj_id is None:
             return None
         else:
-            if current_obj_id in self.all_doc_ids:
+            if current_obj_id in self.doc_id_to_obj:
                 return self.doc_id_to_obj.get(current_obj_id)
-            elif current_obj_id in self.all_note_ids:
+            elif current_obj_id in self.note_id_to_obj:
                 return self.note_id_to_obj.get(current_obj_id)
             else:
                 return None
@@ -61,20 +404,28 @@ class Model():
 
     def reset_docs(self):
         self.all_doc_ids = []
+        self.all_doc_times = []
         self.doc_id_to_obj = {}
+        self.note_cache.clear()
 
     def reset_notes(self):
         self.all_note_ids = []
         self.note_id_to_obj = {}
+        self.ref_id_to_children = {}
 
     def reload_docs(self):
-        self.reset_docs()
         doc_objs = self.db.get_docs()
-        doc_obj_index = 0
-        for doc_obj in doc_objs:
-            self.all_doc_ids.append(doc_obj.id)
-            self.doc_id_to_obj[doc_obj.id] = doc_obj
-            doc_obj_index += 1
+        with self.lock:
+            # Docs that are gone also leave the search index.
+            doc_ids = set(doc_obj.id for doc_obj in doc_objs)
+            for doc_id in [id for id in self.doc_id_to_obj if id not in doc_ids]:
+                self._drop_doc(doc_id)
+            self.reset_docs()
+            # Links may have changed anywhere, so these are built again the
+            # next time they're needed.
+            self.graph = None
+            self.related_index = None
+            self._apply_changes(doc_objs, {}, [])
 
     def get_current_doc(self):
         current_doc_id = self.history.get_current_doc_id()
@@ -82,36 +433,176 @@ class Model():
             return None
         return self.doc_id_to_obj.get(current_doc_id)
 
+    @needs_library
     def add_doc(self, doc_obj):
-        self.db.add_doc(doc_obj)
-        self.reload_docs()
+        new_doc = self.db.add_doc(doc_obj)
+        if new_doc is None:
+            return None
+        self._put_doc(new_doc)
+        self._write_through([new_doc])
+        return new_doc
 
+    @needs_library
     def delete_doc(self, doc_obj):
         if doc_obj is not None:
-            if doc_obj.id in self.all_doc_ids:
-                self.db.delete_doc(doc_obj)
+            if doc_obj.id in self.doc_id_to_obj:
+                linked_ids = self.db.delete_doc(doc_obj)
+                if linked_ids is None:
+                    self.reconcile()
+                    return False
+                self._drop_doc(doc_obj.id)
+                linked_doc_objs = self._drop_local_links(linked_ids)
+                self._write_through(linked_doc_objs, tombstones=[(u'doc', doc_obj.id, doc_obj.id)])
+                if self.cache is not None:
+                    for deleted_id, inlinks, outlinks in linked_ids:
+                        self.cache.remove_links(set(inlinks) | set(outlinks), deleted_id)
                 self.history.delete_doc(doc_obj.id)
-                self.reload_docs()
                 return True
         return False
 
+    @needs_library
+    def import_docs(self, entries, on_commit=None):
+        # See Database.import_docs. Imported docs and notes are added to the
+        # local indexes as each commit goes through.
+        def committed(entry_count, added):
+            with self.lock:
+                for doc_obj, note_objs in added:
+                    self._put_doc(doc_obj)
+                    for note_obj in note_objs:
+                        self._put_note(doc_obj.id, note_obj)
+            self._write_through([doc_obj for doc_obj, note_objs in added], \
+                                [note_obj for doc_obj, note_objs in added for note_obj in note_objs])
+            if on_commit is not None:
+                on_commit(entry_count, added)
+        return self.db.import_docs(entries, committed)
+
+    @needs_library
     def get_docs(self):
         return [self.doc_id_to_obj.get(id) for id in self.all_doc_ids]
 
+    @needs_library
+    def get_doc_count(self):
+        return len(self.all_doc_ids)
+
+    @needs_library
+    def get_doc_range(self, start, stop):
+        # The docs from index start up to stop, numbered like get_docs,
+        # without building the whole list.
+        with self.lock:
+            return [self.doc_id_to_obj[id] for id in self.all_doc_ids[max(start, 0):max(stop, 0)]]
+
+    @needs_library
+    def get_doc_index(self, doc_obj):
+        # doc_obj's index in get_docs, or None.
+        with self.lock:
+            return self._find_doc_index(doc_obj.id)
+
+    def list_docs(self, page, per_page):
+        # Page page (from 1) of the doc listing: ([(index, title, year,
+        # authors)], doc count). Once the library is loaded the rows come
+        # from memory, numbered like get_docs. Until then they are read from
+        # the database, only the fields shown and a page at a time, in
+        # storage order. Those rows have no index, since the numbering isn't
+        # known yet, and the doc count is None.
+        self.connected.wait()
+        if self.loaded.is_set() or self.db is None:
+            # Loaded, or the connection failed and this raises.
+            self.wait_until_loaded()
+            with self.lock:
+                start = (page - 1) * per_page
+                rows = [(index, doc_obj.title, doc_obj.year, doc_obj.authors) for index, doc_obj \
+                        in enumerate(self.get_doc_range(start, start + per_page), start)]
+                return rows, len(self.all_doc_ids)
+
+        # Start from the closest page whose cursor is known and skip ahead
+        # from there.
+        known_page = page
+        while known_page > 1 and (per_page, known_page) not in self.listing_cursors:
+            known_page -= 1
+        cursor = self.listing_cursors.get((per_page, known_page))
+        for current_page in range(known_page, page + 1):
+            listed, cursor = self.db.list_docs(per_page, cursor)
+            if len(listed) < per_page:
+                if current_page < page:
+                    return [], None
+                break
+            self.listing_cursors[(per_page, current_page + 1)] = cursor
+        return [(None, data.get(u'title'), data.get(u'year'), data.get(u'authors') or []) \
+                for id, data in listed], None
+
+    @needs_library
     def get_doc(self, id):
         return self.doc_id_to_obj.get(id)
 
+    @needs_library
+    def find_similar_docs(self, title, threshold=DUPLICATE_SIMILARITY, limit=10):
+        # [(similarity, doc_obj)] for likely duplicates of a doc titled
+        # title, best first.
+        return self._docs_for(self.db.similar_titles(title, threshold, limit))
+
+    @needs_library
+    def find_docs_by_title(self, text, limit=10):
+        # Typo-tolerant title lookup: [(similarity, doc_obj)] for the docs
+        # whose title contains most of text's trigrams, best first.
+        return self._docs_for(self.db.similar_titles(text, LOOKUP_SIMILARITY, limit, containment=True))
+
+    @needs_library
+    def find_duplicate_docs(self, threshold=DUPLICATE_SIMILARITY):
+        # [(similarity, doc_obj, other_doc_obj)] for every pair of docs with
+        # similar titles, most similar first. One index lookup per doc.
+        pairs = []
+        for doc_obj in self.get_docs():
+            for similarity, other_doc_obj in self._docs_for(self.db.similar_titles(doc_obj.title, threshold)):
+                if other_doc_obj.id > doc_obj.id:
+                    pairs.append((similarity, doc_obj, other_doc_obj))
+        pairs.sort(key=lambda pair: -pair[0])
+        return pairs
+
+    def _docs_for(self, matches):
+        with self.lock:
+            return [(similarity, self.doc_id_to_obj[doc_id]) for similarity, doc_id in matches \
+                    if doc_id in self.doc_id_to_obj]
+
+    @needs_library
+    def get_doc_notes(self, doc_obj):
+        # All notes of doc_obj, sorted. Outside live mode they are loaded
+        # the first time they're asked for, from the cache if there is one,
+        # and then kept in self.note_cache.
+        with self.lock:
+            if self.live:
+                # The listeners already hold every note.
+                return sorted(self.live_notes.get(doc_obj.id, {}).values(), key=attrgetter('sort_key'))
+            note_objs = self.note_cache.get(doc_obj.id)
+        if note_objs is not None:
+            return list(note_objs)
+
+        if self.cache is not None:
+            note_objs = [Note.from_dict(source, id, update_time, self.db.note_reference(doc_id, id)) \
+                         for doc_id, id, source, update_time in self.cache.load_notes(doc_obj.id)]
+        else:
+            note_objs = self.db.get_notes(doc_obj)
+        note_objs.sort(key=attrgetter('sort_key'))
+        with self.lock:
+            self.note_cache.put(doc_obj.id, note_objs)
+        return list(note_objs)
+
     def reload_notes(self):
         current_doc = self.get_current_doc()
         if current_doc is None:
             return
-        self.reset_notes()
-        note_objs = self.db.get_notes(current_doc)
-        note_obj_index = 0
-        for note_obj in note_objs:
-            self.all_note_ids.append(note_obj.id)
-            self.note_id_to_obj[note_obj.id] = note_obj
-            note_obj_index += 1
+        note_objs = self.get_doc_notes(current_doc)
+        with self.lock:
+            self.reset_notes()
+            note_obj_index = 0
+            for note_obj in note_objs:
+                self.all_note_ids.append(note_obj.id)
+                self.note_id_to_obj[note_obj.id] = note_obj
+                note_obj_index += 1
+
+            # The notes come sorted, so every sibling list is built already
+            # in order.
+            for note_obj in note_objs:
+                self.ref_id_to_children.setdefault(note_obj.ref_id, []).append(note_obj)
 
     def get_current_note(self):
         current_note_id = self.history.get_current_note_id()
@@ -122,36 +613,376 @@ class Model():
     def clear_current_note(self):
         self.current_note_id = None
 
+    @needs_library
     def add_note(self, note_obj, doc_obj):
-        self.db.add_note(note_obj, doc_obj)
-        self.reload_docs()
-        self.reload_notes()
+        if self.cache is not None:
+            # Load the doc's notes first, so the note it's attached to gets
+            # its counters updated and written to the cache too.
+            self.get_doc_notes(doc_obj)
+        new_note = self.db.add_note(note_obj, doc_obj)
+        if new_note is None:
+            return None
+        self._count_note(doc_obj, new_note, 1)
+        self._put_note(doc_obj.id, new_note)
+        parent_obj = self._find_note(doc_obj.id, new_note.ref_id)
+        self._write_through([doc_obj], [new_note] + ([parent_obj] if parent_obj is not None else []))
+        return new_note
 
+    @needs_library
     def delete_note(self, note_obj, doc_obj):
-        self.db.delete_note(note_ob, doc_obj)
+        # The current doc's notes are all loaded, so its children are known.
+        children = None
+        if doc_obj.id == self.history.get_current_doc_id():
+            children = [(note.id, note.notetype) for note in self.get_child_notes(note_obj)]
+        if self.cache is not None:
+            # Load the doc's notes first, so the re-parented children and the
+            # parent's counters can be written to the cache too.
+            self.get_doc_notes(doc_obj)
+
+        if self.db.delete_note(note_obj, doc_obj, children) == False:
+            self.reconcile()
+            return False
+
+        # Children of the deleted note are re-attached to the doc, the same
+        # way Database.delete_note does it on the server.
+        with self.lock:
+            self._count_note(doc_obj, note_obj, -1)
+            self._drop_note(doc_obj.id, note_obj.id)
+            for note in self.get_child_notes(note_obj):
+                self._unindex_child(note)
+                note.ref_id = doc_obj.id
+                self._index_child(note)
+            for note in self.note_cache.peek(doc_obj.id) or []:
+                if note.ref_id == note_obj.id:
+                    note.ref_id = doc_obj.id
+            if not self.live:
+                for notetype, count in (note_obj.child_counts or {}).items():
+                    doc_obj.child_counts = _counted(doc_obj.child_counts, notetype, count)
+            self._write_through([doc_obj], self.note_cache.peek(doc_obj.id) or [], \
+                                [(u'note', doc_obj.id, note_obj.id)])
+
         self.history.delete_note(note_obj.id)
-        self.reload_docs()
-        self.reload_notes()
+        return True
 
+    @needs_library
     def get_notes(self, target_obj=None):
         return [self.note_id_to_obj.get(id) for id in self.all_note_ids]
 
+    @needs_library
     def get_note(self, id):
         return self.note_id_to_obj.get(id)
 
+    @needs_library
+    def get_child_notes(self, target_obj):
+        # Notes attached to target_obj (the current doc or one of its notes),
+        # already sorted.
+        return list(self.ref_id_to_children.get(target_obj.id, []))
+
+    @needs_library
+    def get_child_notetypes(self, target_obj):
+        # From the counters stored on target_obj, so no notes are read. The
+        # indexed object has the latest counters if target_obj is stale.
+        target_obj = self.doc_id_to_obj.get(target_obj.id) or self.note_id_to_obj.get(target_obj.id) or target_obj
+        counts = target_obj.child_counts or {}
+        return sorted(notetype for notetype, count in counts.items() if count > 0)
+
+    @needs_library
     def create_link(self, out_obj, in_obj):
-        self.db.add_link(out_obj, in_obj)
-        self.reload_docs()
-        self.reload_notes()
+        if self.db.add_link(out_obj, in_obj) == False:
+            return False
+        self._add_local_link(out_obj, in_obj)
+        self._write_through_objs([out_obj, in_obj])
+        return True
+
+    @needs_library
+    def create_links(self, pairs):
+        pairs = list(pairs)
+        link_count = self.db.add_links(pairs)
+        linked_objs = []
+        for out_obj, in_obj in pairs:
+            if out_obj.db_reference is not None and in_obj.db_reference is not None:
+                self._add_local_link(out_obj, in_obj)
+                linked_objs.extend([out_obj, in_obj])
+        self._write_through_objs(linked_objs)
+        return link_count
+
+    def _drop_local_links(self, linked_ids):
+        # Mirror the link cleanup Database.delete_doc does on the server.
+        # linked_ids is what it returns: (id, inlinks, outlinks) for the
+        # deleted doc and its notes that had links. Returns the docs that
+        # changed.
+        doc_objs = []
+        with self.lock:
+            for deleted_id, inlinks, outlinks in linked_ids:
+                for id in set(inlinks) | set(outlinks):
+                    linked_obj = self.doc_id_to_obj.get(id) or self.note_id_to_obj.get(id)
+                    if linked_obj is None:
+                        continue
+                    linked_obj.inlinks = [link_id for link_id in (linked_obj.inlinks or []) if link_id != deleted_id]
+                    linked_obj.outlinks = [link_id for link_id in (linked_obj.outlinks or []) if link_id != deleted_id]
+                    self._update_graph_links(linked_obj)
+                    if linked_obj.id in self.doc_id_to_obj:
+                        doc_objs.append(linked_obj)
+        return doc_objs
+
+    def _write_through(self, doc_objs=(), note_objs=(), tombstones=()):
+        # Put a write that went through in the cache as well, since notes
+        # and the rebuilt indexes are read from it until the next sync.
+        if self.cache is None:
+            return
+        notes_by_doc = {}
+        for note_obj in note_objs:
+            notes_by_doc.setdefault(note_obj.db_reference.parent.parent.id, []).append(note_obj)
+        with self.lock:
+            self.cache.apply(list(doc_objs), notes_by_doc, list(tombstones), None)
+
+    def _write_through_objs(self, objs):
+        # Same as _write_through for a mix of docs and notes.
+        self._write_through([obj for obj in objs if isinstance(obj, Doc)], \
+                            [obj for obj in objs if isinstance(obj, Note)])
+
+    def _add_local_link(self, out_obj, in_obj):
+        # Mirror ArrayUnion: no duplicates. Assign new lists rather than
+        # appending, the defaults are shared.
+        with self.lock:
+            if in_obj.id not in (out_obj.outlinks or []):
+                out_obj.outlinks = list(out_obj.outlinks or []) + [in_obj.id]
+            if out_obj.id not in (in_obj.inlinks or []):
+                in_obj.inlinks = list(in_obj.inlinks or []) + [out_obj.id]
+            self._update_graph_links(out_obj)
+            self._update_graph_links(in_obj)
 
+    @needs_library
     def delete_link(self, out_obj, in_obj):
         if self.db.delete_link(out_obj, in_obj) == True:
-            self.reload_docs()
-            self.reload_notes()
+            with self.lock:
+                out_obj.outlinks = [id for id in (out_obj.outlinks or []) if id != in_obj.id]
+                in_obj.inlinks = [id for id in (in_obj.inlinks or []) if id != out_obj.id]
+                self._update_graph_links(out_obj)
+            self._write_through_objs([out_obj, in_obj])
             return True
         else:
+            self.reconcile()
             return False
 
+    def _update_graph_links(self, obj):
+        # A note belongs to the doc its reference sits under.
+        if self.graph is not None:
+            if isinstance(obj, Note):
+                doc_id = obj.db_reference.parent.parent.id
+            else:
+                doc_id = obj.id
+            self.graph.set_links(obj.id, doc_id, obj.outlinks, obj.inlinks)
+
+    @needs_library
+    def get_graph(self):
+        # The link graph of the whole library. Building it reads every
+        # linked note once: from the listeners in live mode, from the cache
+        # if there is one, otherwise only their link fields from the backend.
+        # After that the changes the model sees keep it current.
+        with self.lock:
+            if self.graph is not None:
+                return self.graph
+            rows = [(doc_obj.id, doc_obj.id, doc_obj.outlinks) for doc_obj in self.doc_id_to_obj.values()]
+            if self.live:
+                rows.extend((note_obj.id, doc_id, note_obj.outlinks) \
+                            for doc_id, note_objs in self.live_notes.items() \
+                            for note_obj in note_objs.values() if note_obj.inlinks or note_obj.outlinks)
+                return self._build_graph(rows)
+        if self.cache is not None:
+            # Notes of docs the model no longer has are left out.
+            rows.extend((id, doc_id, source.get(u'outlinks')) \
+                        for doc_id, id, source, update_time in self.cache.load_notes() \
+                        if (source.get(u'inlinks') or source.get(u'outlinks')) and doc_id in self.doc_id_to_obj)
+        else:
+            rows.extend((note_id, doc_id, outlinks) \
+                        for doc_id, note_id, inlinks, outlinks in self.db.stream_note_links())
+        with self.lock:
+            return self._build_graph(rows)
+
+    def _build_graph(self, rows):
+        graph = LinkGraph()
+        graph.build(rows)
+        self.graph = graph
+        return graph
+
+    @needs_library
+    def get_linked_obj(self, id):
+        # The doc or note with this id from the graph, or None.
+        return self._find_obj(id, self.get_graph().owner(id))
+
+    def _find_obj(self, id, doc_id):
+        # The doc or note with this id, doc_id being the id of its doc.
+        # Loads the notes of the doc if need be. None if it isn't in the
+        # library.
+        doc_obj = self.doc_id_to_obj.get(id)
+        if doc_obj is not None:
+            return doc_obj
+        if id in self.note_id_to_obj:
+            return self.note_id_to_obj[id]
+        doc_obj = self.doc_id_to_obj.get(doc_id)
+        if doc_obj is None:
+            return None
+        for note_obj in self.get_doc_notes(doc_obj):
+            if note_obj.id == id:
+                return note_obj
+        return None
+
+    def get_note_doc(self, note_obj):
+        # The doc a note belongs to, or None.
+        if note_obj.db_reference is None:
+            return None
+        return self.doc_id_to_obj.get(note_obj.db_reference.parent.parent.id)
+
+    @needs_library
+    def find_path(self, from_obj, to_obj, direction=BOTH):
+        # The docs and notes along a shortest chain of links from from_obj to
+        # to_obj, or None if they aren't connected.
+        ids = self.get_graph().shortest_path(from_obj.id, to_obj.id, direction)
+        if ids is None:
+            return None
+        return [self.get_linked_obj(id) for id in ids]
+
+    @needs_library
+    def get_neighborhood(self, obj, hops=1, direction=BOTH):
+        # [(distance, obj)] for the docs and notes within hops links of obj.
+        return [(distance, self.get_linked_obj(id)) \
+                for distance, id in self.get_graph().neighborhood(obj.id, hops, direction)]
+
+    @needs_library
+    def get_components(self):
+        # [(doc_objs, note_count)] for each group of linked docs and notes,
+        # biggest first.
+        components = []
+        for ids in self.get_graph().components():
+            doc_objs = [self.doc_id_to_obj[id] for id in ids if id in self.doc_id_to_obj]
+            components.append((doc_objs, len(ids) - len(doc_objs)))
+        return components
+
+    @needs_library
+    def rank_linked(self, limit=10):
+        # [(score, obj)] for the limit most central docs and notes by
+        # PageRank over the links.
+        ranks = self.get_graph().rank()
+        top = heapq.nlargest(limit, ranks.items(), key=lambda item: item[1])
+        return [(score, self.get_linked_obj(id)) for id, score in top]
+
+    @needs_library
+    def get_related_index(self):
+        # The index behind find_related. Building it reads every note once,
+        # like get_graph. Raises RuntimeError without numpy and scipy.
+        with self.lock:
+            if self.related_index is not None:
+                return self.related_index
+            entries = [(doc_obj.id, u'doc', doc_obj.id, doc_obj.title) for doc_obj in self.doc_id_to_obj.values()]
+            if self.live:
+                entries.extend((note_obj.id, u'note', doc_id, note_obj.body) \
+                               for doc_id, note_objs in self.live_notes.items() for note_obj in note_objs.values())
+                return self._build_related_index(entries)
+        if self.cache is not None:
+            entries.extend((id, u'note', doc_id, source.get(u'body')) \
+                           for doc_id, id, source, update_time in self.cache.load_notes() \
+                           if doc_id in self.doc_id_to_obj)
+        else:
+            entries.extend((note_data[u'id'], u'note', doc_data[u'id'], note_data.get(u'body')) \
+                           for doc_data, notes_data in self.db.stream_library() for note_data in notes_data)
+        with self.lock:
+            return self._build_related_index(entries)
+
+    def _build_related_index(self, entries):
+        related_index = RelatedIndex()
+        related_index.build(entries)
+        self.related_index = related_index
+        return related_index
+
+    @needs_library
+    def find_related(self, objs, limit=10, kind=None):
+        # For each doc or note in objs, [(similarity, obj)] for the limit
+        # docs and notes with the most similar text, best first. A doc is
+        # compared by its title and all its notes together, and its own
+        # notes are left out. kind 'doc' or 'note' only returns those.
+        related_index = self.get_related_index()
+        texts = []
+        exclude = []
+        for obj in objs:
+            if isinstance(obj, Doc):
+                note_objs = self.get_doc_notes(obj)
+                texts.append(u' '.join([obj.title or u''] + [note_obj.body or u'' for note_obj in note_objs]))
+                exclude.append(set([obj.id] + [note_obj.id for note_obj in note_objs]))
+            else:
+                texts.append(obj.body)
+                exclude.append(set([obj.id]))
+        results = []
+        for matches in related_index.query(texts, limit, exclude, kind):
+            results.append([(similarity, self._find_obj(id, related_index.doc_id(id))) for similarity, id in matches])
+        return results
+
+    @needs_library
+    def search(self, query, limit=20):
+        # Hits for query, best first (see search.parse_query).
+        self._catch_up_search_index()
+        return self.search_index.search(query, limit)
+
+    def _catch_up_search_index(self):
+        # The first search of a session brings the index up to date. After
+        # that the changes the model sees keep it current.
+        if self.search_ready:
+            return
+        watermark = self.search_index.get_watermark()
+        if watermark is None and self.cache is not None:
+            # Build it from the docs the model has and the notes in the cache,
+            # which sync and the writes since have kept up to date. The
+            # watermark is the cache's, so the session's own writes are
+            # looked at again on the next catch up.
+            with self.lock:
+                doc_objs = list(self.doc_id_to_obj.values())
+            for doc_obj in doc_objs:
+                self.search_index.put_doc(doc_obj)
+            for doc_id, id, source, update_time in self.cache.load_notes():
+                if doc_id in self.doc_id_to_obj:
+                    self.search_index.put_note(doc_id, Note.from_dict(source, id, update_time))
+            self.search_index.set_watermark(self.cache.get_watermark())
+        elif watermark is None:
+            self.search_index.apply(*self.db.get_changes(), replace=True)
+        else:
+            self.search_index.apply(*self.db.get_changes(watermark - SYNC_OVERLAP))
+        self.search_ready = True
+
+    def reconcile(self):
+        # Local deltas are applied after every write. Only fall back to a
+        # reload when a write didn't go through as expected.
+        if self.cache is not None:
+            self.sync()
+            return
+        self.reload_docs()
+        self.reload_notes()
+
+def _doc_time(doc_obj):
+    return doc_obj.update_time or datetime.min
+
+def _find_sorted(note_objs, note_obj):
+    # Index of note_obj in a list of notes sorted by sort_key, found by its
+    # id among the notes with the same key, or None.
+    index = bisect.bisect_left(note_objs, note_obj)
+    while index < len(note_objs) and note_objs[index].sort_key == note_obj.sort_key:
+        if note_objs[index].id == note_obj.id:
+            return index
+        index += 1
+    # Its key changed since it was put in the list.
+    for index, note in enumerate(note_objs):
+        if note.id == note_obj.id:
+            return index
+    return None
+
+def _counted(counts, key, step):
+    # A copy of the counts dict with counts[key] moved by step. Counters that
+    # reach zero are dropped.
+    counts = dict(counts or {})
+    counts[key] = counts.get(key, 0) + step
+    if counts[key] <= 0:
+        del counts[key]
+    return counts
+
 class History():
     # self.note_history is a list of lists.
     # Pushing a doc adds a new entry to self.doc_history and a new list to self.note_history.
@@ -244,6 +1075,8 @@ class History():
             else:
                 new_doc_history.append(doc_id)
                 new_note_history.append(note_ids)
+        self.doc_history = new_doc_history
+        self.note_history = new_note_history
 
         if new_current_doc:
             pub.sendMessage('new_current_doc')
@@ -265,7 +1098,81 @@ class History():
                      continue
                 else:
                     new_note_history[-1].append(note_id)
-
+        self.note_history = new_note_history
 
         if new_current_note:
             pub.sendMessage('new_current_note')
+
+class NoteCache():
+    # The notes of recently used docs, by doc id, least recently used first.
+    # Each doc's notes are kept sorted, the order the note tree shows them in.
+    # Each doc weighs one plus its number of notes, and once the total goes
+    # over capacity the least recently used docs are dropped. The most
+    # recently used doc is always kept.
+
+    def __init__(self, capacity=NOTE_CACHE_SIZE):
+        self.capacity = capacity
+        self.size = 0
+        self.doc_notes = OrderedDict() # doc id -> list of note objs
+
+    def __contains__(self, doc_id):
+        return doc_id in self.doc_notes
+
+    def get(self, doc_id):
+        note_objs = self.doc_notes.get(doc_id)
+        if note_objs is not None:
+            self.doc_notes.move_to_end(doc_id)
+        return note_objs
+
+    def peek(self, doc_id):
+        # Same as get, without counting as a use.
+        return self.doc_notes.get(doc_id)
+
+    def put(self, doc_id, note_objs):
+        # note_objs sorted.
+        self.discard(doc_id)
+        self.doc_notes[doc_id] = list(note_objs)
+        self.size += len(note_objs) + 1
+        self._evict()
+
+    def add_note(self, doc_id, note_obj):
+        # Docs that aren't cached are left alone, their notes get loaded in
+        # full when they are needed.
+        note_objs = self.doc_notes.get(doc_id)
+        if note_objs is None:
+            return
+        for index, note in enumerate(note_objs):
+            if note.id == note_obj.id:
+                if note.sort_key == note_obj.sort_key:
+                    note_objs[index] = note_obj
+                    return
+                del note_objs[index]
+                bisect.insort(note_objs, note_obj)
+                return
+        bisect.insort(note_objs, note_obj)
+        self.size += 1
+        self._evict()
+
+    def remove_note(self, doc_id, note_id):
+        note_objs = self.doc_notes.get(doc_id)
+        if note_objs is None:
+            return
+        for index, note in enumerate(note_objs):
+            if note.id == note_id:
+                del note_objs[index]
+                self.size -= 1
+                return
+
+    def discard(self, doc_id):
+        note_objs = self.doc_notes.pop(doc_id, None)
+        if note_objs is not None:
+            self.size -= len(note_objs) + 1
+
+    def clear(self):
+        self.doc_notes = OrderedDict()
+        self.size = 0
+
+    def _evict(self):
+        while self.size > self.capacity and len(self.doc_notes) > 1:
+            doc_id, note_objs = self.doc_notes.popitem(last=False)
+            self.size -= len(note_objs) + 1
@@ -0,0 +1,252 @@
+import re
+import threading
+from collections import Counter
+
+# numpy and scipy are optional: only the related command needs them. They
+# take a while to import, so that happens the first time they're needed
+# (see _import_numpy), not when litreview starts.
+numpy = None
+sparse = None
+
+# Words are hashed into this many features, so the vocabulary never has to
+# be stored or grown.
+FEATURES = 2 ** 20
+
+# New entries are scored on their own until there are this many of them,
+# then folded into the main matrix.
+PENDING_LIMIT = 2000
+
+# The main matrix is reweighted once this share of the entries has been
+# added or removed since it was built, as document frequencies have drifted.
+REWEIGHT_FRACTION = 0.1
+
+# Queries scored together in one matrix product. Each one gets a dense row
+# of scores over all entries.
+QUERY_BATCH = 16
+
+STOPWORDS = frozenset(u'''
+    an and are as at be but by can do does for from had has have he her his how if in into is it its
+    not of on or our she so than that the their them then there these they this to was we were what
+    when which who will with would you your
+'''.split())
+
+def available():
+    return _import_numpy()
+
+def _import_numpy():
+    # Imports numpy and scipy into the module globals. Returns whether they
+    # are installed.
+    global numpy, sparse
+    if numpy is None:
+        try:
+            import numpy as numpy_module
+            from scipy import sparse as sparse_module
+        except ImportError:
+            return False
+        numpy, sparse = numpy_module, sparse_module
+    return True
+
+class RelatedIndex():
+    # Finds the docs and notes whose text is most like a given text. Every
+    # doc title and note body is a row of a sparse matrix of TF-IDF weights
+    # over hashed words, scaled to unit length, so a matrix product with a
+    # batch of queries gives their cosine similarities to everything at
+    # once.
+    #
+    # The matrix is stored transposed (features x entries) in CSR form: a
+    # query only walks the rows of its own words, not the whole matrix.
+    #
+    # Changes don't rebuild it. Removed entries are masked out, new ones wait
+    # in self.pending and are scored separately, and the whole matrix is
+    # rebuilt once enough has changed. Weights use the document frequencies
+    # from the last rebuild.
+
+    def __init__(self):
+        if not _import_numpy():
+            raise RuntimeError(u'Related docs and notes need numpy and scipy: pip install numpy scipy')
+        self.lock = threading.RLock()
+        self.entries = {} # id -> (kind, doc_id)
+        self.document_frequencies = numpy.zeros(FEATURES, dtype=numpy.int32)
+        self._load([], [], sparse.csr_matrix((0, FEATURES), dtype=numpy.float32))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _load(self, ids, kinds, counts):
+        # counts: the term counts of the rows, as an entries x features CSR
+        # matrix.
+        self.ids = ids
+        self.rows = {id: row for row, id in enumerate(ids)}
+        self.is_doc = numpy.array([kind == u'doc' for kind in kinds], dtype=bool)
+        self.alive = numpy.ones(len(ids), dtype=bool)
+        self.counts = counts
+        self.pending = {} # id -> (feature indices, counts)
+        self.changes = 0
+        self.idf = _idf(self.document_frequencies, len(ids))
+        self.matrix = _weigh(counts, self.idf).T.tocsr()
+
+    def build(self, entries):
+        # Replaces the index with entries of (id, kind, doc_id, text), kind
+        # being 'doc' or 'note'.
+        with self.lock:
+            self.entries = {}
+            self.document_frequencies[:] = 0
+            ids = []
+            kinds = []
+            indptr = [0]
+            indices = []
+            values = []
+            for id, kind, doc_id, text in entries:
+                features, counts = _features(text)
+                if not len(features):
+                    continue
+                self.entries[id] = (kind, doc_id)
+                ids.append(id)
+                kinds.append(kind)
+                indices.append(features)
+                values.append(counts)
+                indptr.append(indptr[-1] + len(features))
+                self.document_frequencies[features] += 1
+            counts = sparse.csr_matrix((numpy.concatenate(values) if values else numpy.zeros(0, numpy.float32),
+                                        numpy.concatenate(indices) if indices else numpy.zeros(0, numpy.int32),
+                                        numpy.array(indptr, dtype=numpy.int64)),
+                                       shape=(len(ids), FEATURES), dtype=numpy.float32)
+            self._load(ids, kinds, counts)
+
+    def add(self, id, kind, doc_id, text):
+        with self.lock:
+            features, counts = _features(text)
+            # Docs and notes are put again whenever their links or counters
+            # change, usually with the same text.
+            if self._has(id, features, counts):
+                return
+            self.remove(id)
+            if not len(features):
+                return
+            self.entries[id] = (kind, doc_id)
+            self.pending[id] = (features, counts)
+            self.document_frequencies[features] += 1
+            self._changed()
+
+    def _has(self, id, features, counts):
+        if id in self.pending:
+            old_features, old_counts = self.pending[id]
+        elif id in self.entries:
+            start, end = self.counts.indptr[self.rows[id]], self.counts.indptr[self.rows[id] + 1]
+            old_features, old_counts = self.counts.indices[start:end], self.counts.data[start:end]
+        else:
+            return False
+        return numpy.array_equal(old_features, features) and numpy.array_equal(old_counts, counts)
+
+    def remove(self, id):
+        with self.lock:
+            if id not in self.entries:
+                return
+            del self.entries[id]
+            if id in self.pending:
+                features = self.pending.pop(id)[0]
+            else:
+                row = self.rows[id]
+                self.alive[row] = False
+                features = self.counts.indices[self.counts.indptr[row]:self.counts.indptr[row + 1]]
+            self.document_frequencies[features] -= 1
+            self._changed()
+
+    def remove_doc(self, doc_id):
+        # Removes a doc and all its notes.
+        with self.lock:
+            for id in [id for id, (kind, entry_doc_id) in self.entries.items() if entry_doc_id == doc_id]:
+                self.remove(id)
+
+    def _changed(self):
+        self.changes += 1
+        if len(self.pending) > PENDING_LIMIT or self.changes > max(PENDING_LIMIT, REWEIGHT_FRACTION * len(self.ids)):
+            self._rebuild()
+
+    def _rebuild(self):
+        alive_rows = numpy.flatnonzero(self.alive)
+        ids = [self.ids[row] for row in alive_rows]
+        pending_ids = list(self.pending)
+        counts = [self.counts[alive_rows]]
+        if pending_ids:
+            counts.append(_rows_matrix([self.pending[id] for id in pending_ids]))
+        ids.extend(pending_ids)
+        kinds = [self.entries[id][0] for id in ids]
+        self._load(ids, kinds, sparse.vstack(counts, format=u'csr'))
+
+    def doc_id(self, id):
+        with self.lock:
+            entry = self.entries.get(id)
+            return entry[1] if entry is not None else None
+
+    def query(self, texts, limit=10, exclude=None, kind=None):
+        # For each text, [(similarity, id)] for the limit entries most like
+        # it, best first. exclude is a list with a set of ids to leave out
+        # for each text, and kind 'doc' or 'note' only returns those.
+        texts = list(texts)
+        if exclude is None:
+            exclude = [()] * len(texts)
+        results = []
+        with self.lock:
+            for start in range(0, len(texts), QUERY_BATCH):
+                batch = texts[start:start + QUERY_BATCH]
+                queries = _weigh(_rows_matrix([_features(text) for text in batch]), self.idf)
+                results.extend(self._query(queries, limit, exclude[start:start + QUERY_BATCH], kind))
+        return results
+
+    def _query(self, queries, limit, exclude, kind):
+        scores = (queries @ self.matrix).toarray()
+        scores[:, ~self.alive] = 0.0
+        if kind is not None:
+            scores[:, self.is_doc != (kind == u'doc')] = 0.0
+
+        pending_ids = [id for id in self.pending if kind is None or self.entries[id][0] == kind]
+        if pending_ids:
+            pending = _weigh(_rows_matrix([self.pending[id] for id in pending_ids]), self.idf)
+            pending_scores = (queries @ pending.T).toarray()
+        results = []
+        for query_row, excluded_ids in enumerate(exclude):
+            row_scores = scores[query_row]
+            for id in excluded_ids:
+                if id in self.rows:
+                    row_scores[self.rows[id]] = 0.0
+            # Only the best limit scores are sorted.
+            count = min(limit, len(row_scores))
+            best = numpy.argpartition(-row_scores, count - 1)[:count] if count else []
+            matches = [(float(row_scores[row]), self.ids[row]) for row in best if row_scores[row] > 0.0]
+            if pending_ids:
+                matches.extend((float(score), id) for score, id in zip(pending_scores[query_row], pending_ids) \
+                               if score > 0.0 and id not in excluded_ids)
+            matches.sort(key=lambda match: (-match[0], match[1]))
+            results.append(matches[:limit])
+        return results
+
+def _features(text):
+    # Sorted hashed feature indices of text's words and their counts. Hash
+    # randomization doesn't matter, the index lives in memory only.
+    words = [word for word in re.findall(r'\w\w+', (text or u'').casefold()) if word not in STOPWORDS]
+    counts = Counter(hash(word) & (FEATURES - 1) for word in words)
+    features = numpy.array(sorted(counts), dtype=numpy.int32)
+    return features, numpy.array([counts[feature] for feature in features], dtype=numpy.float32)
+
+def _rows_matrix(rows):
+    # An entries x features CSR matrix of term counts from (features, counts)
+    # pairs.
+    indptr = numpy.zeros(len(rows) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(features) for features, counts in rows], out=indptr[1:])
+    indices = numpy.concatenate([features for features, counts in rows]) if rows else numpy.zeros(0, numpy.int32)
+    values = numpy.concatenate([counts for features, counts in rows]) if rows else numpy.zeros(0, numpy.float32)
+    return sparse.csr_matrix((values, indices, indptr), shape=(len(rows), FEATURES), dtype=numpy.float32)
+
+def _idf(document_frequencies, entry_count):
+    # Smoothed, so words no entry has yet get the highest weight.
+    return (numpy.log((1.0 + entry_count) / (1.0 + document_frequencies)) + 1.0).astype(numpy.float32)
+
+def _weigh(counts, idf):
+    # Sublinear term frequency times idf, each row scaled to unit length.
+    weights = counts.copy()
+    weights.data = 1.0 + numpy.log(weights.data)
+    weights = weights.multiply(idf[numpy.newaxis, :]).tocsr()
+    norms = numpy.sqrt(numpy.asarray(weights.multiply(weights).sum(axis=1)).ravel())
+    norms[norms == 0.0] = 1.0
+    return sparse.diags(1.0 / norms).dot(weights).tocsr().astype(numpy.float32)
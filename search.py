@@ -0,0 +1,265 @@
+import os
+import re
+import sqlite3
+import threading
+from collections import namedtuple
+from datetime import datetime, timezone
+
+DEFAULT_SEARCH_PATH = os.path.join(os.path.expanduser(u'~'), u'.litreview', u'search.sqlite')
+
+# BM25 weights of the title, authors and body columns.
+TITLE_WEIGHT = 10.0
+AUTHORS_WEIGHT = 5.0
+BODY_WEIGHT = 1.0
+
+# Let SQLite map up to this much of the index file instead of reading it.
+MMAP_SIZE = 256 * 1024 * 1024
+
+# kind is 'doc' or 'note'. For docs doc_id is the doc's own id and notetype
+# is None. Lower scores are better matches.
+Hit = namedtuple('Hit', ['kind', 'id', 'doc_id', 'notetype', 'score', 'snippet'])
+
+class SearchIndex():
+    # A full-text index over doc titles, author names and note bodies, kept
+    # in an SQLite FTS5 table: porter stemming, phrase and prefix queries,
+    # BM25 ranking. Every entry also gets a row in the entries table, which
+    # holds what the filters need (notetype, page, year) and the update time
+    # used to skip entries that haven't changed.
+    #
+    # Writes aren't committed one by one. They go out with the next
+    # set_watermark, commit, search or close, so bulk updates stay fast.
+    #
+    # Like LibraryCache, each index belongs to one backend, and the
+    # watermark says how far it is up to date.
+
+    def __init__(self, path, backend_name):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(u'PRAGMA mmap_size = {0}'.format(MMAP_SIZE))
+        try:
+            self.connection.executescript(u'''
+                CREATE VIRTUAL TABLE IF NOT EXISTS entries_text USING fts5(
+                    title, authors, body,
+                    tokenize = 'porter unicode61 remove_diacritics 1',
+                    prefix = '2 3'
+                );
+                CREATE TABLE IF NOT EXISTS entries (
+                    rowid INTEGER PRIMARY KEY,
+                    id TEXT NOT NULL UNIQUE,
+                    kind TEXT NOT NULL,
+                    doc_id TEXT NOT NULL,
+                    notetype TEXT,
+                    page INTEGER,
+                    year INTEGER,
+                    update_time REAL
+                );
+                CREATE INDEX IF NOT EXISTS entries_doc_id ON entries (doc_id);
+                CREATE INDEX IF NOT EXISTS entries_year ON entries (kind, year);
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value
+                );
+            ''')
+        except sqlite3.OperationalError as error:
+            raise RuntimeError(u'Search needs SQLite with the FTS5 extension: {0}'.format(error))
+        if self._get_meta(u'backend') != backend_name:
+            self.clear()
+            self._set_meta(u'backend', backend_name)
+        self.connection.commit()
+
+    def _get_meta(self, key):
+        row = self.connection.execute(u'SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def _set_meta(self, key, value):
+        self.connection.execute(u'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def get_watermark(self):
+        # Aware UTC datetime, or None if the index has never been built.
+        value = self._get_meta(u'watermark')
+        if value is None:
+            return None
+        return datetime.fromtimestamp(value, timezone.utc)
+
+    def set_watermark(self, watermark):
+        with self.lock:
+            if watermark is not None:
+                self._set_meta(u'watermark', watermark.timestamp())
+            self.connection.commit()
+
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute(u'DELETE FROM entries_text')
+            self.connection.execute(u'DELETE FROM entries')
+            self.connection.execute(u'DELETE FROM meta')
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+    def put_doc(self, doc_obj):
+        authors = u'; '.join(u'{0} {1}'.format(author.get(u'firstname', u''), author.get(u'lastname', u'')) \
+                             for author in (doc_obj.authors or []))
+        self._put(doc_obj.id, u'doc', doc_obj.id, doc_obj.update_time, (doc_obj.title or u'', authors, u''), \
+                  year=_to_int(doc_obj.year))
+
+    def put_note(self, doc_id, note_obj):
+        self._put(note_obj.id, u'note', doc_id, note_obj.update_time, (u'', u'', note_obj.body or u''), \
+                  notetype=note_obj.notetype, page=_to_int(getattr(note_obj, 'page', None)))
+
+    def _put(self, id, kind, doc_id, update_time, text, notetype=None, page=None, year=None):
+        update_time = _to_timestamp(update_time)
+        with self.lock:
+            row = self.connection.execute(u'SELECT rowid, update_time FROM entries WHERE id = ?', (id,)).fetchone()
+            if row is not None:
+                if update_time is not None and row[1] == update_time:
+                    return
+                self.connection.execute(u'DELETE FROM entries_text WHERE rowid = ?', (row[0],))
+                self.connection.execute(u'DELETE FROM entries WHERE rowid = ?', (row[0],))
+            rowid = self.connection.execute(
+                u'INSERT INTO entries (id, kind, doc_id, notetype, page, year, update_time) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (id, kind, doc_id, notetype, page, year, update_time)).lastrowid
+            self.connection.execute(u'INSERT INTO entries_text (rowid, title, authors, body) VALUES (?, ?, ?, ?)',
+                                    (rowid,) + tuple(text))
+
+    def drop_doc(self, doc_id):
+        # Drops the doc and all of its notes.
+        with self.lock:
+            self.connection.execute(u'DELETE FROM entries_text WHERE rowid IN (SELECT rowid FROM entries WHERE doc_id = ?)',
+                                    (doc_id,))
+            self.connection.execute(u'DELETE FROM entries WHERE doc_id = ?', (doc_id,))
+
+    def drop_note(self, note_id):
+        with self.lock:
+            self.connection.execute(u'DELETE FROM entries_text WHERE rowid IN (SELECT rowid FROM entries WHERE id = ?)',
+                                    (note_id,))
+            self.connection.execute(u'DELETE FROM entries WHERE id = ?', (note_id,))
+
+    def apply(self, doc_objs, notes_by_doc, tombstones, watermark, replace=False):
+        # Same arguments as LibraryCache.apply.
+        with self.lock:
+            if replace:
+                self.connection.execute(u'DELETE FROM entries_text')
+                self.connection.execute(u'DELETE FROM entries')
+            for doc_obj in doc_objs:
+                self.put_doc(doc_obj)
+            for doc_id, note_objs in notes_by_doc.items():
+                for note_obj in note_objs:
+                    self.put_note(doc_id, note_obj)
+            for kind, doc_id, id in tombstones:
+                if kind == u'doc':
+                    self.drop_doc(id)
+                else:
+                    self.drop_note(id)
+            self.set_watermark(watermark)
+
+    def search(self, query, limit=20):
+        # Returns up to limit Hits for query, best first. See parse_query for
+        # the syntax. Raises ValueError for a query with nothing to match.
+        expression, filters = parse_query(query)
+        sql = u'''SELECT e.kind, e.id, e.doc_id, e.notetype, bm25(entries_text, ?, ?, ?) AS score,
+                         snippet(entries_text, -1, '[', ']', '...', 12)
+                  FROM entries_text JOIN entries AS e ON e.rowid = entries_text.rowid
+                  WHERE entries_text MATCH ?'''
+        parameters = [TITLE_WEIGHT, AUTHORS_WEIGHT, BODY_WEIGHT, expression]
+        if u'kind' in filters:
+            sql += u' AND e.kind = ?'
+            parameters.append(filters[u'kind'])
+        if u'notetype' in filters:
+            sql += u' AND e.notetype = ?'
+            parameters.append(filters[u'notetype'])
+        if u'page' in filters:
+            sql += u' AND e.page BETWEEN ? AND ?'
+            parameters.extend(filters[u'page'])
+        if u'year' in filters:
+            sql += u''' AND e.doc_id IN (SELECT id FROM entries
+                                         WHERE kind = 'doc' AND year BETWEEN ? AND ?)'''
+            parameters.extend(filters[u'year'])
+        sql += u' ORDER BY score LIMIT ?'
+        parameters.append(limit)
+
+        with self.lock:
+            self.connection.commit()
+            try:
+                rows = self.connection.execute(sql, parameters).fetchall()
+            except sqlite3.OperationalError as error:
+                raise ValueError(u'Bad search query: {0}'.format(error))
+        return [Hit(*row) for row in rows]
+
+def parse_query(query):
+    # Turns a search line into an FTS5 expression and a dict of filters.
+    #
+    #     word        matches the word or another form of it (stemming)
+    #     word*       matches words starting with word
+    #     "a phrase"  matches the words next to each other
+    #     OR          between two terms, matches either of them
+    #     type:ideas  only notes of that notetype
+    #     page:10-20  only notes on those pages (page:10, page:10-, page:-20)
+    #     year:2015-2019, or year:2015, only docs from those years and their notes
+    #     docs, notes only docs or only notes
+    #
+    # Terms are ANDed together.
+    terms = []
+    filters = {}
+    for token in re.findall(r'[^\s"]*"[^"]*"?|\S+', query):
+        field, sep, value = token.partition(u':')
+        if sep and field in (u'type', u'page', u'year') and value:
+            if field == u'type':
+                filters[u'notetype'] = value
+            else:
+                filters[field] = _parse_range(value)
+        elif token in (u'docs', u'notes'):
+            filters[u'kind'] = token[:-1]
+        elif token == u'OR':
+            if terms and terms[-1] != u'OR':
+                terms.append(token)
+        elif token.startswith(u'"'):
+            words = token.strip(u'"').split()
+            if words:
+                terms.append(_quote(u' '.join(words)))
+        elif token.endswith(u'*') and len(token) > 1:
+            terms.append(_quote(token.rstrip(u'*')) + u'*')
+        else:
+            terms.append(_quote(token))
+    if terms and terms[-1] == u'OR':
+        terms.pop()
+    if not terms:
+        raise ValueError(u'Nothing to search for.')
+    return u' '.join(terms), filters
+
+def _quote(text):
+    # An FTS5 string, so punctuation in the query isn't read as syntax.
+    return u'"' + text.replace(u'"', u'""') + u'"'
+
+def _parse_range(value):
+    low, sep, high = value.partition(u'-')
+    try:
+        low = int(low) if low else -2**63
+        high = int(high) if high else 2**63 - 1
+    except ValueError:
+        raise ValueError(u'Not a number or range: {0}'.format(value))
+    if not sep:
+        high = low
+    return low, high
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def _to_timestamp(update_time):
+    if update_time is None:
+        return None
+    return update_time.timestamp()
@@ -0,0 +1,677 @@
+import enum
+import json
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+# A local stand-in for the part of the Firestore client API that Database
+# uses: collections, subcollections, collection groups, queries with where/
+# order_by/limit/start_after/select, write batches with the ArrayUnion,
+# ArrayRemove and Increment transforms, and on_snapshot listeners.
+#
+# Documents are stored as JSON in a single table keyed by path. Every scalar
+# top-level field (and every element of an array field) also gets a row in
+# the fields table, which is indexed on (collection_id, field, value). That
+# covers the lookups Database makes: title_key, doi_key, author names,
+# note ref_id and link arrays.
+#
+# Class names match the Firestore ones so stats.InstrumentedClient counts
+# reads and writes for this backend too.
+
+# Like Firestore, strings longer than this aren't indexed.
+MAX_INDEXED_BYTES = 1500
+
+# Like Firestore, a batch can't hold more writes than this.
+MAX_BATCH_WRITES = 500
+
+class NotFound(Exception):
+    pass
+
+class AlreadyExists(Exception):
+    pass
+
+class FailedPrecondition(Exception):
+    pass
+
+class InvalidArgument(Exception):
+    pass
+
+class ArrayUnion():
+    def __init__(self, values):
+        self.values = list(values)
+
+class ArrayRemove():
+    def __init__(self, values):
+        self.values = list(values)
+
+class Increment():
+    def __init__(self, value):
+        self.value = value
+
+class _ServerTimestamp():
+    pass
+
+SERVER_TIMESTAMP = _ServerTimestamp()
+
+class ExistsOption():
+    def __init__(self, exists):
+        self.exists = exists
+
+class LastUpdateOption():
+    def __init__(self, last_update_time):
+        self.last_update_time = last_update_time
+
+class ChangeType(enum.Enum):
+    ADDED = 1
+    MODIFIED = 2
+    REMOVED = 3
+
+class DocumentChange():
+    def __init__(self, type, document, old_index=-1, new_index=-1):
+        self.type = type
+        self.document = document
+        self.old_index = old_index
+        self.new_index = new_index
+
+class WriteResult():
+    def __init__(self, update_time):
+        self.update_time = update_time
+
+def _now_datetime(seconds):
+    return datetime.fromtimestamp(seconds, timezone.utc)
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return {u'__timestamp__': value.timestamp()}
+    raise TypeError(u'{0} is not JSON serializable'.format(type(value).__name__))
+
+def _decode(source):
+    if len(source) == 1 and u'__timestamp__' in source:
+        return _now_datetime(source[u'__timestamp__'])
+    return source
+
+def _dumps(data):
+    return json.dumps(data, default=_encode, separators=(',', ':'))
+
+def _loads(text):
+    return json.loads(text, object_hook=_decode)
+
+def _index_value(value):
+    # The value stored in the fields table, or None if it isn't indexed.
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, datetime):
+        return value.timestamp()
+    if isinstance(value, str) and len(value.encode('utf-8')) <= MAX_INDEXED_BYTES:
+        return value
+    return None
+
+def _sort_value(value):
+    # Firestore orders values by type first, then by value.
+    if value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (1, value)
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, datetime):
+        return (3, value.timestamp())
+    if isinstance(value, str):
+        return (4, value)
+    return (5, _dumps(value))
+
+class _Descending():
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+def _get_field(data, field_path):
+    value = data
+    for part in field_path.split(u'.'):
+        if not isinstance(value, dict) or part not in value:
+            raise KeyError(field_path)
+        value = value[part]
+    return value
+
+def _matches(data, field, op, value):
+    try:
+        field_value = _get_field(data, field)
+    except KeyError:
+        return False
+    try:
+        if op == u'==':
+            return field_value == value
+        if op == u'!=':
+            return field_value != value
+        if op == u'array_contains':
+            return isinstance(field_value, list) and value in field_value
+        if op == u'array_contains_any':
+            return isinstance(field_value, list) and any(item in field_value for item in value)
+        if op == u'in':
+            return field_value in value
+        if op == u'not-in':
+            return field_value not in value
+        if isinstance(field_value, datetime):
+            field_value = field_value.timestamp()
+        if isinstance(value, datetime):
+            value = value.timestamp()
+        if op == u'<':
+            return field_value < value
+        if op == u'<=':
+            return field_value <= value
+        if op == u'>':
+            return field_value > value
+        if op == u'>=':
+            return field_value >= value
+    except TypeError:
+        return False
+    raise ValueError(u'Unsupported operator {0}'.format(op))
+
+class DocumentSnapshot():
+    def __init__(self, reference, data, create_time=None, update_time=None):
+        self.reference = reference
+        self._data = data
+        self.create_time = create_time
+        self.update_time = update_time
+
+    @property
+    def id(self):
+        return self.reference.id
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        if self._data is None:
+            return None
+        return dict(self._data)
+
+    def get(self, field_path):
+        if self._data is None:
+            raise KeyError(field_path)
+        return _get_field(self._data, field_path)
+
+class DocumentReference():
+    def __init__(self, client, path):
+        self._client = client
+        self.path = path
+
+    def __eq__(self, other):
+        return isinstance(other, DocumentReference) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    @property
+    def id(self):
+        return self.path.rsplit(u'/', 1)[-1]
+
+    @property
+    def parent(self):
+        return CollectionReference(self._client, self.path.rsplit(u'/', 1)[0])
+
+    def collection(self, collection_id):
+        return CollectionReference(self._client, self.path + u'/' + collection_id)
+
+    def get(self):
+        return self._client._get(self)
+
+    def create(self, document_data):
+        batch = self._client.batch()
+        batch.create(self, document_data)
+        return batch.commit()[0]
+
+    def set(self, document_data, merge=False):
+        batch = self._client.batch()
+        batch.set(self, document_data, merge=merge)
+        return batch.commit()[0]
+
+    def update(self, field_updates):
+        batch = self._client.batch()
+        batch.update(self, field_updates)
+        return batch.commit()[0]
+
+    def delete(self, option=None):
+        batch = self._client.batch()
+        batch.delete(self, option=option)
+        return batch.commit()[0]
+
+class Query():
+    def __init__(self, client, collection_path=None, collection_id=None, filters=(), orders=(),
+                 limit=None, cursor=None, projection=None):
+        # Either collection_path (a single collection) or collection_id
+        # (a collection group) is set.
+        self._client = client
+        self._collection_path = collection_path
+        self._collection_id = collection_id
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit
+        self._cursor = cursor
+        self._projection = projection
+
+    def _copy(self, **changes):
+        options = {
+            u'collection_path': self._collection_path,
+            u'collection_id': self._collection_id,
+            u'filters': self._filters,
+            u'orders': self._orders,
+            u'limit': self._limit,
+            u'cursor': self._cursor,
+            u'projection': self._projection,
+        }
+        options.update(changes)
+        return Query(self._client, **options)
+
+    def where(self, field_path, op_string, value):
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def order_by(self, field_path, direction=u'ASCENDING'):
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def start_after(self, document_fields_or_snapshot):
+        return self._copy(cursor=document_fields_or_snapshot)
+
+    def select(self, field_paths):
+        return self._copy(projection=list(field_paths))
+
+    def stream(self):
+        for snapshot in self._client._run_query(self):
+            yield snapshot
+
+    def get(self):
+        return list(self.stream())
+
+    def on_snapshot(self, callback):
+        return self._client._watch(self, callback)
+
+    def _in_scope(self, path):
+        collection_path = path.rsplit(u'/', 1)[0]
+        if self._collection_path is not None:
+            return collection_path == self._collection_path
+        return collection_path.rsplit(u'/', 1)[-1] == self._collection_id
+
+    def _matches(self, data):
+        return all(_matches(data, field, op, value) for field, op, value in self._filters)
+
+    def _sort_key(self, path, data):
+        key = []
+        for field, direction in self._orders:
+            if field == u'__name__':
+                value = (4, path)
+            else:
+                value = _sort_value(_get_field(data, field))
+            if direction == u'DESCENDING':
+                value = _Descending(value)
+            key.append(value)
+        # Ties are broken by document path, like Firestore does.
+        key.append((4, path))
+        return key
+
+class CollectionReference(Query):
+    def __init__(self, client, path):
+        Query.__init__(self, client, collection_path=path)
+        self.path = path
+
+    @property
+    def id(self):
+        return self.path.rsplit(u'/', 1)[-1]
+
+    @property
+    def parent(self):
+        if u'/' not in self.path:
+            return None
+        return DocumentReference(self._client, self.path.rsplit(u'/', 1)[0])
+
+    def document(self, document_id=None):
+        if document_id is None:
+            document_id = uuid.uuid4().hex[:20]
+        return DocumentReference(self._client, self.path + u'/' + document_id)
+
+    def add(self, document_data, document_id=None):
+        reference = self.document(document_id)
+        write_result = reference.create(document_data)
+        return write_result.update_time, reference
+
+class WriteBatch():
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def create(self, reference, document_data):
+        self._writes.append((u'create', reference, document_data, None))
+
+    def set(self, reference, document_data, merge=False):
+        self._writes.append((u'set', reference, document_data, merge))
+
+    def update(self, reference, field_updates, option=None):
+        self._writes.append((u'update', reference, field_updates, option))
+
+    def delete(self, reference, option=None):
+        self._writes.append((u'delete', reference, None, option))
+
+    def commit(self):
+        writes = self._writes
+        self._writes = []
+        if len(writes) > MAX_BATCH_WRITES:
+            raise InvalidArgument(u'maximum {0} writes allowed per request'.format(MAX_BATCH_WRITES))
+        return self._client._commit(writes)
+
+class Watch():
+    def __init__(self, client, query, callback):
+        self._client = client
+        self._query = query
+        self._callback = callback
+        self._paths = set()
+
+    def unsubscribe(self):
+        self._client._unwatch(self)
+
+class Client():
+    def __init__(self, path=u':memory:'):
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.executescript(u'''
+            CREATE TABLE IF NOT EXISTS documents (
+                path TEXT PRIMARY KEY,
+                collection_path TEXT NOT NULL,
+                collection_id TEXT NOT NULL,
+                data TEXT NOT NULL,
+                create_time REAL NOT NULL,
+                update_time REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS documents_collection_path ON documents (collection_path);
+            CREATE INDEX IF NOT EXISTS documents_collection_id ON documents (collection_id);
+            CREATE TABLE IF NOT EXISTS fields (
+                path TEXT NOT NULL,
+                collection_id TEXT NOT NULL,
+                field TEXT NOT NULL,
+                value
+            );
+            CREATE INDEX IF NOT EXISTS fields_lookup ON fields (collection_id, field, value);
+            CREATE INDEX IF NOT EXISTS fields_path ON fields (path);
+        ''')
+        self._last_time = 0.0
+        self._watches = []
+        self._events = None
+
+    def collection(self, collection_id):
+        return CollectionReference(self, collection_id)
+
+    def collection_group(self, collection_id):
+        return Query(self, collection_id=collection_id)
+
+    def document(self, document_path):
+        return DocumentReference(self, document_path)
+
+    def batch(self):
+        return WriteBatch(self)
+
+    def write_option(self, exists=None, last_update_time=None):
+        if last_update_time is not None:
+            return LastUpdateOption(last_update_time)
+        return ExistsOption(exists)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def _next_time(self):
+        # Commit times are strictly increasing, so they can be used as
+        # sync watermarks.
+        now = max(time.time(), self._last_time + 1e-6)
+        self._last_time = now
+        return now
+
+    def _load(self, path):
+        row = self._connection.execute(
+            u'SELECT data, create_time, update_time FROM documents WHERE path = ?', (path,)).fetchone()
+        if row is None:
+            return None
+        return _loads(row[0]), row[1], row[2]
+
+    def _snapshot(self, path, data, create_time, update_time, projection=None):
+        if projection is not None:
+            data = {field: data[field] for field in projection if field in data}
+        return DocumentSnapshot(DocumentReference(self, path), data,
+                                _now_datetime(create_time), _now_datetime(update_time))
+
+    def _get(self, reference):
+        with self._lock:
+            stored = self._load(reference.path)
+        if stored is None:
+            return DocumentSnapshot(reference, None)
+        return self._snapshot(reference.path, *stored)
+
+    def _candidate_rows(self, query):
+        # Use the fields index for the first filter it can answer and check
+        # the remaining filters in Python.
+        if query._collection_path is not None:
+            scope_sql, scope_value = u'd.collection_path = ?', query._collection_path
+        else:
+            scope_sql, scope_value = u'd.collection_id = ?', query._collection_id
+        collection_id = (query._collection_path or query._collection_id).rsplit(u'/', 1)[-1]
+
+        for field, op, value in query._filters:
+            sql_op = {u'==': u'=', u'array_contains': u'=', u'<': u'<', u'<=': u'<=', u'>': u'>', u'>=': u'>='}.get(op)
+            if sql_op is None or u'.' in field:
+                continue
+            index_value = _index_value(value)
+            if index_value is None:
+                continue
+            return self._connection.execute(
+                u'SELECT DISTINCT d.path, d.data, d.create_time, d.update_time FROM fields f '
+                u'JOIN documents d ON d.path = f.path '
+                u'WHERE f.collection_id = ? AND f.field = ? AND f.value ' + sql_op + u' ? AND ' + scope_sql,
+                (collection_id, field, index_value, scope_value)).fetchall()
+
+        return self._connection.execute(
+            u'SELECT d.path, d.data, d.create_time, d.update_time FROM documents d WHERE ' + scope_sql,
+            (scope_value,)).fetchall()
+
+    def _run_query(self, query):
+        with self._lock:
+            rows = self._candidate_rows(query)
+        results = []
+        for path, data, create_time, update_time in rows:
+            data = _loads(data)
+            if not query._matches(data):
+                continue
+            try:
+                key = query._sort_key(path, data)
+            except KeyError:
+                # Like Firestore, docs without an order_by field are left out.
+                continue
+            results.append((key, path, data, create_time, update_time))
+        results.sort(key=lambda result: result[0])
+
+        if query._cursor is not None:
+            cursor = query._cursor
+            if isinstance(cursor, DocumentSnapshot):
+                cursor_key = query._sort_key(cursor.reference.path, cursor._data or {})
+            else:
+                cursor_key = query._sort_key(u'', cursor)[:-1]
+            results = [result for result in results if result[0][:len(cursor_key)] > cursor_key]
+
+        if query._limit is not None:
+            results = results[:query._limit]
+        return [self._snapshot(path, data, create_time, update_time, query._projection)
+                for key, path, data, create_time, update_time in results]
+
+    def _apply(self, path, current, kind, document_data, merge):
+        # Returns the new data for a document, with transforms applied.
+        if kind == u'create' or kind == u'set' and not merge:
+            new_data = {}
+        else:
+            new_data = dict(current or {})
+
+        for field, value in document_data.items():
+            # As in Firestore, update takes dotted field paths into maps.
+            target = new_data
+            if kind == u'update':
+                parts = field.split(u'.')
+                for part in parts[:-1]:
+                    if not isinstance(target.get(part), dict):
+                        target[part] = {}
+                    else:
+                        target[part] = dict(target[part])
+                    target = target[part]
+                field = parts[-1]
+            if kind == u'set' and merge and isinstance(value, dict) and isinstance(target.get(field), dict):
+                merged = dict(target[field])
+                merged.update(value)
+                value = merged
+            target[field] = self._transform(target.get(field), value)
+        return new_data
+
+    def _transform(self, old_value, value):
+        if isinstance(value, ArrayUnion):
+            old_list = list(old_value) if isinstance(old_value, list) else []
+            return old_list + [item for item in value.values if item not in old_list]
+        if isinstance(value, ArrayRemove):
+            old_list = list(old_value) if isinstance(old_value, list) else []
+            return [item for item in old_list if item not in value.values]
+        if isinstance(value, Increment):
+            if isinstance(old_value, (int, float)) and not isinstance(old_value, bool):
+                return old_value + value.value
+            return value.value
+        if isinstance(value, _ServerTimestamp):
+            return _now_datetime(self._commit_time)
+        return value
+
+    def _write_fields(self, path, collection_id, data):
+        self._connection.execute(u'DELETE FROM fields WHERE path = ?', (path,))
+        rows = []
+        for field, value in data.items():
+            values = value if isinstance(value, list) else [value]
+            for item in values:
+                index_value = _index_value(item)
+                if index_value is not None:
+                    rows.append((path, collection_id, field, index_value))
+        self._connection.executemany(
+            u'INSERT INTO fields (path, collection_id, field, value) VALUES (?, ?, ?, ?)', rows)
+
+    def _commit(self, writes):
+        changed_paths = []
+        with self._lock:
+            self._commit_time = self._next_time()
+            try:
+                for kind, reference, document_data, option in writes:
+                    path = reference.path
+                    stored = self._load(path)
+                    current = stored[0] if stored is not None else None
+                    if isinstance(option, LastUpdateOption) and \
+                       (stored is None or _now_datetime(stored[2]) != option.last_update_time):
+                        raise FailedPrecondition(path)
+
+                    if kind == u'delete':
+                        if isinstance(option, ExistsOption) and option.exists and stored is None:
+                            raise NotFound(path)
+                        self._connection.execute(u'DELETE FROM documents WHERE path = ?', (path,))
+                        self._connection.execute(u'DELETE FROM fields WHERE path = ?', (path,))
+                    else:
+                        if kind == u'create' and stored is not None:
+                            raise AlreadyExists(path)
+                        if kind == u'update' and stored is None:
+                            raise NotFound(path)
+                        new_data = self._apply(path, current, kind, document_data, kind == u'set' and option)
+                        create_time = stored[1] if stored is not None else self._commit_time
+                        collection_path = path.rsplit(u'/', 1)[0]
+                        collection_id = collection_path.rsplit(u'/', 1)[-1]
+                        self._connection.execute(
+                            u'INSERT OR REPLACE INTO documents (path, collection_path, collection_id, data, create_time, update_time) '
+                            u'VALUES (?, ?, ?, ?, ?, ?)',
+                            (path, collection_path, collection_id, _dumps(new_data), create_time, self._commit_time))
+                        self._write_fields(path, collection_id, new_data)
+                    changed_paths.append((path, current))
+                self._connection.commit()
+            except Exception:
+                self._connection.rollback()
+                raise
+            commit_time = _now_datetime(self._commit_time)
+            if self._watches:
+                self._notify(changed_paths)
+        return [WriteResult(commit_time) for write in writes]
+
+    def _watch(self, query, callback):
+        watch = Watch(self, query, callback)
+        with self._lock:
+            if self._events is None:
+                # Listener callbacks run on their own thread, like Firestore's.
+                self._events = queue.Queue()
+                threading.Thread(target=self._dispatch, daemon=True).start()
+            snapshots = self._run_query(query._copy(orders=(), limit=None, cursor=None, projection=None))
+            watch._paths = {snapshot.reference.path for snapshot in snapshots}
+            self._watches.append(watch)
+            changes = [DocumentChange(ChangeType.ADDED, snapshot) for snapshot in snapshots]
+            self._events.put((watch, snapshots, changes))
+        return watch
+
+    def _unwatch(self, watch):
+        with self._lock:
+            if watch in self._watches:
+                self._watches.remove(watch)
+
+    def _notify(self, changed_paths):
+        # changed_paths holds (path, data before the commit) tuples.
+        previous_data = {}
+        for path, data in changed_paths:
+            previous_data.setdefault(path, data)
+        for watch in self._watches:
+            changes = []
+            for path in previous_data:
+                if not watch._query._in_scope(path):
+                    continue
+                stored = self._load(path)
+                matches = stored is not None and watch._query._matches(stored[0])
+                if matches:
+                    snapshot = self._snapshot(path, *stored)
+                    change_type = ChangeType.MODIFIED if path in watch._paths else ChangeType.ADDED
+                    watch._paths.add(path)
+                    changes.append(DocumentChange(change_type, snapshot))
+                elif path in watch._paths:
+                    watch._paths.discard(path)
+                    # Removed docs are reported with their last known data,
+                    # since callers read fields from change.document.
+                    snapshot = DocumentSnapshot(DocumentReference(self, path), previous_data[path] or {})
+                    changes.append(DocumentChange(ChangeType.REMOVED, snapshot))
+            if changes:
+                # Unlike Firestore, only the changed documents are passed as
+                # the snapshot list.
+                self._events.put((watch, [change.document for change in changes], changes))
+
+    def _dispatch(self):
+        while True:
+            watch, snapshots, changes = self._events.get()
+            if watch in self._watches:
+                watch._callback(snapshots, changes, _now_datetime(time.time()))
+
+class SqliteBackend():
+    # Runs Database against a local SQLite file (or memory), with no
+    # credentials or network round trips.
+    def __init__(self, path=u':memory:'):
+        self.client = Client(path)
+        self.name = u'sqlite:' + path
+        self.ArrayUnion = ArrayUnion
+        self.ArrayRemove = ArrayRemove
+        self.Increment = Increment
+        self.SERVER_TIMESTAMP = SERVER_TIMESTAMP
+        self.NotFound = NotFound
+        self.FailedPrecondition = FailedPrecondition
+        self.AlreadyExists = AlreadyExists
+        # A locked database file is worth retrying.
+        self.TRANSIENT_ERRORS = (sqlite3.OperationalError,)
@@ -0,0 +1,189 @@
+import json
+import threading
+import time
+from datetime import datetime
+
+class Counters():
+    fields = ('calls', 'reads', 'writes', 'round_trips', 'seconds')
+
+    def __init__(self):
+        self.calls = 0
+        self.reads = 0
+        self.writes = 0
+        self.round_trips = 0
+        self.seconds = 0.0
+
+    def __str__(self):
+        return u'reads: {0}, writes: {1}, round trips: {2}, time: {3:.1f} ms'.format(
+            self.reads, self.writes, self.round_trips, self.seconds * 1000)
+
+    def add(self, other):
+        for field in Counters.fields:
+            setattr(self, field, getattr(self, field) + getattr(other, field))
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in Counters.fields}
+
+class Stats():
+    # Counts documents read, documents written and round trips made by the
+    # backend, and groups them by shell command and by Database call.
+    # Counters are collected per thread, so reads made by snapshot listeners
+    # only show up in the totals.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.totals = Counters()
+            self.by_command = {}
+            self.by_call = {}
+            self.started = datetime.now()
+
+    def _active(self):
+        if not hasattr(self.local, 'active'):
+            self.local.active = []
+        return self.local.active
+
+    def record(self, reads=0, writes=0, round_trips=0):
+        with self.lock:
+            for counters in [self.totals] + [scope[1] for scope in self._active()]:
+                counters.reads += reads
+                counters.writes += writes
+                counters.round_trips += round_trips
+
+    def begin(self, table, name):
+        # table is 'command' or 'call'. A command that raised never reached
+        # end(), so drop whatever it left behind.
+        if table == u'command':
+            self.local.active = []
+        counters = Counters()
+        self._active().append((table, counters, name, time.perf_counter()))
+        return counters
+
+    def end(self):
+        table, counters, name, start = self._active().pop()
+        counters.calls = 1
+        counters.seconds = time.perf_counter() - start
+        with self.lock:
+            by_name = self.by_command if table == u'command' else self.by_call
+            if name not in by_name:
+                by_name[name] = Counters()
+            by_name[name].add(counters)
+            if table == u'command':
+                self.totals.calls += 1
+                self.totals.seconds += counters.seconds
+        return counters
+
+    def instrument(self, obj, method_names):
+        # Replace each method on obj with a wrapper that records a 'call'.
+        for name in method_names:
+            method = getattr(obj, name)
+            setattr(obj, name, self._timed(name, method))
+
+    def _timed(self, name, method):
+        def timed(*args, **kwargs):
+            self.begin(u'call', name)
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.end()
+        timed.__name__ = name
+        timed.__doc__ = method.__doc__
+        return timed
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                u'started': self.started.isoformat(),
+                u'exported': datetime.now().isoformat(),
+                u'totals': self.totals.to_dict(),
+                u'commands': {name: counters.to_dict() for name, counters in self.by_command.items()},
+                u'calls': {name: counters.to_dict() for name, counters in self.by_call.items()},
+            }
+
+    def export(self, path):
+        with open(path, 'w') as stats_file:
+            json.dump(self.to_dict(), stats_file, indent=2, sort_keys=True)
+
+class InstrumentedClient():
+    # Wraps a Firestore client (or anything returned by it) and reports reads,
+    # writes and round trips to a Stats object. Arguments are unwrapped before
+    # they reach the real client.
+
+    wrapped_types = ('Client', 'CollectionReference', 'DocumentReference', 'Query',
+                     'CollectionGroup', 'WriteBatch', 'DocumentSnapshot')
+
+    def __init__(self, target, stats):
+        self._target = target
+        self._stats = stats
+        self._pending_writes = 0
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if not callable(value):
+            return _wrap(value, self._stats)
+        def method(*args, **kwargs):
+            args = [_unwrap(arg) for arg in args]
+            kwargs = {key: _unwrap(arg) for key, arg in kwargs.items()}
+            return self._call(name, value, args, kwargs)
+        return method
+
+    def __eq__(self, other):
+        return self._target == _unwrap(other)
+
+    def __hash__(self):
+        return hash(self._target)
+
+    def _call(self, name, method, args, kwargs):
+        type_name = type(self._target).__name__
+        if type_name == u'WriteBatch':
+            if name in (u'set', u'update', u'delete', u'create'):
+                self._pending_writes += 1
+            elif name == u'commit':
+                self._stats.record(writes=self._pending_writes, round_trips=1)
+                self._pending_writes = 0
+            return _wrap(method(*args, **kwargs), self._stats)
+
+        if name == u'stream':
+            return self._stream(method(*args, **kwargs))
+        if name == u'get' and type_name != u'DocumentSnapshot':
+            result = method(*args, **kwargs)
+            if type_name == u'DocumentReference':
+                self._stats.record(reads=1, round_trips=1)
+                return _wrap(result, self._stats)
+            result = list(result)
+            self._stats.record(reads=len(result), round_trips=1)
+            return [_wrap(snapshot, self._stats) for snapshot in result]
+        if name in (u'add', u'set', u'update', u'delete', u'create'):
+            self._stats.record(writes=1, round_trips=1)
+            result = method(*args, **kwargs)
+            if name == u'add':
+                update_time, reference = result
+                return update_time, _wrap(reference, self._stats)
+            return result
+        if name == u'on_snapshot':
+            callback = args[0]
+            def counted_callback(snapshots, changes, read_time):
+                self._stats.record(reads=len(changes))
+                callback([_wrap(snapshot, self._stats) for snapshot in snapshots], changes, read_time)
+            return method(counted_callback, *args[1:], **kwargs)
+        return _wrap(method(*args, **kwargs), self._stats)
+
+    def _stream(self, snapshots):
+        self._stats.record(round_trips=1)
+        for snapshot in snapshots:
+            self._stats.record(reads=1)
+            yield _wrap(snapshot, self._stats)
+
+def _wrap(value, stats):
+    if type(value).__name__ in InstrumentedClient.wrapped_types:
+        return InstrumentedClient(value, stats)
+    return value
+
+def _unwrap(value):
+    if isinstance(value, InstrumentedClient):
+        return value._target
+    return value